@@ -0,0 +1,181 @@
+"""
+Kernels computing spectral index maps from bands in a single pass per
+pixel. If numba is installed, kernels are compiled and run in parallel over
+rows, so that memory is limited to the input bands and the output map.
+Otherwise an equivalent numpy version processes tiles of rows to bound the
+size of float32 temporaries.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+EPS = np.float32(1e-7)
+
+
+def _get_backend(backend):
+    """Resolve backend 'auto' to 'numba' if available, else 'numpy'."""
+
+    if backend == 'auto':
+        return 'numba' if NUMBA_AVAILABLE else 'numpy'
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError('backend numba requires numba to be installed')
+    if backend not in ['numba', 'numpy']:
+        raise ValueError(f'Unknown backend {backend}, use auto, numba or numpy')
+    return backend
+
+def _row_tiles(num_rows, row_bytes, max_block_bytes):
+    """Slices of rows using about max_block_bytes of temporaries."""
+
+    step = int(max(1, max_block_bytes // max(1, row_bytes)))
+    return [slice(r, r + step) for r in range(0, num_rows, step)]
+
+
+if NUMBA_AVAILABLE:
+
+    @numba.njit(parallel=True, cache=True)
+    def _rabd_numba(cube, w_left, w_right, out):
+        for r in numba.prange(cube.shape[1]):
+            for c in range(cube.shape[2]):
+                left = np.float32(cube[0, r, c]) + EPS
+                trough = np.float32(cube[1, r, c]) + EPS
+                right = np.float32(cube[2, r, c]) + EPS
+                out[r, c] = (left * w_left + right * w_right) / trough
+
+    @numba.njit(parallel=True, cache=True)
+    def _ratio_numba(cube, out):
+        for r in numba.prange(cube.shape[1]):
+            for c in range(cube.shape[2]):
+                out[r, c] = np.float32(cube[0, r, c]) / (np.float32(cube[1, r, c]) + EPS)
+
+    @numba.njit(parallel=True, cache=True)
+    def _raba_band_numba(first, last, band, i, num_bands, out):
+        for r in numba.prange(out.shape[0]):
+            for c in range(out.shape[1]):
+                line = (np.float32(last[r, c]) - np.float32(first[r, c])) / np.float32(num_bands)
+                out[r, c] += (np.float32(first[r, c]) + np.float32(i) * line) / (
+                    np.float32(band[r, c]) + EPS) - np.float32(1)
+
+
+def _get_rabd_weights(x_left, x_right):
+    """Weights of left and right bands in the continuum at the trough band.
+    Weights are nan if both distances are 0, as the resulting index."""
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w_left = np.float32(x_right) / np.float32(x_left + x_right)
+        w_right = np.float32(x_left) / np.float32(x_left + x_right)
+    return w_left, w_right
+
+def rabd_map(cube, x_left, x_right, backend='auto', max_block_bytes=2**26):
+    """Compute the RABD index map, i.e. the ratio of the continuum
+    interpolated between the left and right bands to the trough band.
+
+    Parameters
+    ----------
+    cube : array
+        Left, trough and right bands. Dims are (3, rows, cols).
+    x_left : int
+        Number of bands between left and trough bands.
+    x_right : int
+        Number of bands between trough and right bands.
+    backend : str, optional
+        'numba', 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+    max_block_bytes : int, optional
+        Approximate memory of temporaries of the numpy backend. Default is 2**26.
+
+    Returns
+    -------
+    out : array
+        float32 index map. Dims are (rows, cols).
+    """
+
+    out = np.empty(cube.shape[1:], dtype=np.float32)
+    w_left, w_right = _get_rabd_weights(x_left, x_right)
+    if _get_backend(backend) == 'numba':
+        _rabd_numba(np.ascontiguousarray(cube), w_left, w_right, out)
+        return out
+
+    for rows in _row_tiles(cube.shape[1], 3 * cube.shape[2] * 4, max_block_bytes):
+        tile = cube[:, rows].astype(np.float32)
+        tile += EPS
+        tile[0] *= w_left
+        tile[0] += tile[2] * w_right
+        np.divide(tile[0], tile[1], out=out[rows])
+    return out
+
+def ratio_map(cube, backend='auto', max_block_bytes=2**26):
+    """Compute the ratio index map of a numerator and a denominator band.
+
+    Parameters
+    ----------
+    cube : array
+        Numerator and denominator bands. Dims are (2, rows, cols).
+    backend : str, optional
+        'numba', 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+    max_block_bytes : int, optional
+        Approximate memory of temporaries of the numpy backend. Default is 2**26.
+
+    Returns
+    -------
+    out : array
+        float32 index map. Dims are (rows, cols).
+    """
+
+    out = np.empty(cube.shape[1:], dtype=np.float32)
+    if _get_backend(backend) == 'numba':
+        _ratio_numba(np.ascontiguousarray(cube), out)
+        return out
+
+    for rows in _row_tiles(cube.shape[1], cube.shape[2] * 4, max_block_bytes):
+        denominator = cube[1, rows].astype(np.float32)
+        denominator += EPS
+        np.divide(cube[0, rows], denominator, out=out[rows], dtype=np.float32)
+    return out
+
+def raba_map(first, last, bands, num_bands, backend='auto', max_block_bytes=2**26):
+    """Compute the RABA index map, i.e. the sum over bands between left and
+    right bands of the ratio of the linear continuum to the band, minus 1.
+    Bands are accumulated one at a time so that only one of them needs to
+    be in memory.
+
+    Parameters
+    ----------
+    first : array
+        Left band. Dims are (rows, cols).
+    last : array
+        Right band. Dims are (rows, cols).
+    bands : iterable of array
+        The num_bands bands from the left band included to the right band
+        excluded, e.g. a generator reading them. Dims are (rows, cols).
+    num_bands : int
+        Number of bands between left and right bands.
+    backend : str, optional
+        'numba', 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+    max_block_bytes : int, optional
+        Approximate memory of temporaries of the numpy backend. Default is 2**26.
+
+    Returns
+    -------
+    out : array
+        float32 index map. Dims are (rows, cols).
+    """
+
+    out = np.zeros(first.shape, dtype=np.float32)
+    use_numba = _get_backend(backend) == 'numba'
+    if use_numba:
+        first, last = np.ascontiguousarray(first), np.ascontiguousarray(last)
+    tiles = _row_tiles(first.shape[0], 3 * first.shape[1] * 4, max_block_bytes)
+    for i, band in enumerate(bands):
+        if use_numba:
+            _raba_band_numba(first, last, np.ascontiguousarray(band), i, num_bands, out)
+            continue
+        for rows in tiles:
+            first_tile = first[rows].astype(np.float32)
+            line = (last[rows].astype(np.float32) - first_tile) / np.float32(num_bands)
+            band_tile = band[rows].astype(np.float32)
+            band_tile += EPS
+            out[rows] += (first_tile + np.float32(i) * line) / band_tile - np.float32(1)
+    return out
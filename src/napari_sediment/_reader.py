@@ -5,6 +5,10 @@ It implements the Reader specification, but your plugin may choose to
 implement multiple readers or even other plugin contributions. see:
 https://napari.org/stable/plugins/guides.html?#readers
 """
+import mmap
+import os
+import threading
+from collections import OrderedDict
 import numpy as np
 from spectral import open_image
 import zarr
@@ -63,19 +67,80 @@ def reader_function(path):
     """
     # handle both a string and a list of strings
     #paths = [path] if isinstance(path, str) else path
-    # load all files into array
-    array, metadata = read_spectral(path)# for _path in paths]
+    # lazily open the file, napari only loads the bands being displayed
+    array, metadata = read_spectral_lazy(path)# for _path in paths]
     # stack arrays into single array
     #data = np.squeeze(np.stack(arrays))
 
     # optional kwargs for the corresponding viewer.add_* method
     add_kwargs = {'name': metadata['wavelength'], 'channel_axis': 2}
 
+    # use lower resolution levels of multiscale zarr files if available
+    layer_kwargs = {}
+    if Path(path).suffix == '.zarr':
+        pyramid = read_hyper_zarr_multiscale(path)
+        if len(pyramid) > 1:
+            import dask.array as da
+            array = [array] + [da.from_zarr(level) for level in pyramid[1:]]
+            layer_kwargs['multiscale'] = True
+
     layer_type = "image"  # optional, default is "image"
-    array = np.moveaxis(array, 2, 0)
-    return [(array, {}, layer_type)]
+    return [(array, layer_kwargs, layer_type)]
+
+def read_spectral_lazy(path):
+    """Open spectral data from an hdr or zarr file as a lazy dask array
+    with one chunk per band. No pixel data is read until the array is
+    indexed or computed.
+
+    Parameters
+    ----------
+    path: str
+        path to hdr or zarr file
+    
+    Returns
+    -------
+    data: dask array
+        spectral data with dims (bands, rows, cols)
+    metadata: dict
+        metadata with keys 'wavelength' (list of str), 'centers' (list of float)
+    """
+
+    import dask.array as da
+
+    path = Path(path)
+    if path.suffix == '.hdr':
+        img = open_image_cached(path)
+
+        metadata = dict(img.metadata)
+        metadata['centers'] = img.bands.centers
+
+        interleave = img.metadata['interleave'].lower()
+        raw = img.open_memmap(interleave='source')
+        if interleave == 'bil':
+            # each band is read line by line, avoid read-ahead of complete rows
+            raw_mmap = getattr(raw, '_mmap', None)
+            if (raw_mmap is not None) and hasattr(mmap, 'MADV_RANDOM'):
+                raw_mmap.madvise(mmap.MADV_RANDOM)
+        raw = raw.transpose({'bil': (1, 0, 2), 'bip': (2, 0, 1), 'bsq': (0, 1, 2)}[interleave])
+        data = da.from_array(raw, chunks=(1, -1, -1), asarray=True)
 
-def read_spectral(path, bands=None, row_bounds=None, col_bounds=None):
+        if not data.dtype.isnative:
+            data = data.astype(data.dtype.newbyteorder('='))
+        if getattr(img, 'scale_factor', 1) != 1:
+            data = data / float(img.scale_factor)
+
+    elif path.suffix == '.zarr':
+        zarr_image = read_hyper_zarr(path)
+        metadata = zarr_image.attrs['metadata']
+        data = da.from_zarr(zarr_image)
+
+    else:
+        raise ValueError(f'Unknown file format {path.suffix}')
+
+    return data, metadata
+
+def read_spectral(path, bands=None, row_bounds=None, col_bounds=None, backend='spectral',
+                  lazy=True):
     """Read spectral data from an hdr or zarr file.
 
     Parameters
@@ -88,26 +153,44 @@ def read_spectral(path, bands=None, row_bounds=None, col_bounds=None):
         (row_start, row_end)
     col_bounds: tuple of int
         (col_start, col_end)
+    backend: str
+        backend used to read hdr files, one of 'spectral' (read via
+        spectral.open_image), 'memmap' (single pass over a numpy.memmap of
+        the raw file) or 'dask' (lazy dask array on top of the memmap).
+        Ignored for zarr files.
+    lazy: bool
+        for zarr files, if True return a lazy dask array, otherwise read the
+        selection into memory, reading runs of consecutive bands with a single
+        slice, see read_zarr_bands. Ignored for hdr files. Default is True.
     
     Returns
     -------
-    data: ndarray
-        spectral data
+    data: ndarray or dask array
+        spectral data with dims (rows, cols, bands). Dask array for zarr
+        files with lazy=True
     metadata: dict
         metadata with keys 'wavelength' (list of str), 'centers' (list of float)
     """
 
     path = Path(path)
     if path.suffix == '.hdr':
-        img = open_image(path)
+        img = open_image_cached(path)
 
-        metadata = img.metadata
+        metadata = dict(img.metadata)
         metadata['centers'] = img.bands.centers
 
         if bands is None:
             bands = np.arange(0, len(metadata['wavelength']))
 
-        if (row_bounds is None) and (col_bounds is None):
+        if backend in ['memmap', 'dask']:
+            data = read_envi_memmap(
+                img, bands=bands, row_bounds=row_bounds, col_bounds=col_bounds,
+                lazy=backend == 'dask')
+
+        elif backend != 'spectral':
+            raise ValueError(f'Unknown backend {backend}')
+
+        elif (row_bounds is None) and (col_bounds is None):
             data = img.read_bands(bands)
         else:
             if row_bounds is None:
@@ -130,16 +213,230 @@ def read_spectral(path, bands=None, row_bounds=None, col_bounds=None):
         if col_bounds is None:
             col_bounds = (0, zarr_image.shape[2])
 
+        # use the copy chunked along pixels if it requires reading less data
+        spectra_image = read_hyper_zarr_spectra(path)
+        if spectra_image is not None:
+            if get_zarr_read_cost(spectra_image, bands, row_bounds, col_bounds) < \
+                get_zarr_read_cost(zarr_image, bands, row_bounds, col_bounds):
+                zarr_image = spectra_image
+
         #data = zarr_image.get_orthogonal_selection(
         #    (bands, slice(row_bounds[0], row_bounds[1]), slice(col_bounds[0],col_bounds[1])))
-        import dask.array as da
-        zarr_image = da.from_zarr(path)
-        data = zarr_image[bands, row_bounds[0]:row_bounds[1], col_bounds[0]:col_bounds[1]]
+        if lazy:
+            import dask.array as da
+            data = da.from_zarr(zarr_image)[
+                bands, row_bounds[0]:row_bounds[1], col_bounds[0]:col_bounds[1]]
+        else:
+            data = read_zarr_bands(zarr_image, bands, row_bounds, col_bounds)
             
         data = np.moveaxis(data, 0, 2)
         
     return data, metadata
 
+def get_contiguous_runs(bands):
+    """Split a sequence of band indices into runs of consecutive indices,
+    e.g. [2, 3, 4, 8, 9] gives [(2, 5), (8, 10)].
+
+    Parameters
+    ----------
+    bands: list of int
+        band indices
+
+    Returns
+    -------
+    runs: list of tuple
+        (start, stop) of each run, stop is excluded
+    """
+
+    bands = np.asarray(bands, dtype=int)
+    if len(bands) == 0:
+        return []
+    
+    breaks = np.where(np.diff(bands) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(bands)]])
+    runs = [(int(bands[s]), int(bands[e-1]) + 1) for s, e in zip(starts, ends)]
+
+    return runs
+
+def read_zarr_bands(zarr_image, bands, row_bounds, col_bounds):
+    """Read bands of a zarr image with dims (bands, rows, cols). Bands are
+    grouped into runs of consecutive indices read with a single slice each.
+
+    Parameters
+    ----------
+    zarr_image: zarr array
+        image with dims (bands, rows, cols)
+    bands: list of int
+        list of bands indices to read, in any order
+    row_bounds: tuple of int
+        (row_start, row_end)
+    col_bounds: tuple of int
+        (col_start, col_end)
+
+    Returns
+    -------
+    data: ndarray
+        spectral data with dims (bands, rows, cols)
+    """
+
+    bands = np.asarray(bands, dtype=int)
+    unique_bands, inverse = np.unique(bands, return_inverse=True)
+
+    # chunks contain multiple bands, read all bands at once to load each chunk once
+    if zarr_image.chunks[0] > 1:
+        data = zarr_image[
+            unique_bands[0]:unique_bands[-1]+1,
+            row_bounds[0]:row_bounds[1], col_bounds[0]:col_bounds[1]]
+        return data[bands - unique_bands[0]]
+
+    data = np.empty(
+        (len(unique_bands), row_bounds[1]-row_bounds[0], col_bounds[1]-col_bounds[0]),
+        dtype=zarr_image.dtype)
+    pos = 0
+    for start, stop in get_contiguous_runs(unique_bands):
+        data[pos:pos+stop-start] = zarr_image[
+            start:stop, row_bounds[0]:row_bounds[1], col_bounds[0]:col_bounds[1]]
+        pos += stop - start
+
+    if not np.array_equal(unique_bands, bands):
+        data = data[inverse]
+
+    return data
+
+def get_zarr_read_cost(zarr_image, bands, row_bounds, col_bounds):
+    """Estimate the number of bytes loaded from a zarr image to read
+    a selection, i.e. the total size of all chunks touched by the selection.
+
+    Parameters
+    ----------
+    zarr_image: zarr array
+        image with dims (bands, rows, cols)
+    bands: list of int
+        list of bands indices to read
+    row_bounds: tuple of int
+        (row_start, row_end)
+    col_bounds: tuple of int
+        (col_start, col_end)
+
+    Returns
+    -------
+    cost: int
+        number of bytes of chunks touched
+    """
+
+    chunks = zarr_image.chunks
+    num_band_chunks = len(np.unique(np.asarray(bands, dtype=int) // chunks[0]))
+    num_row_chunks = (row_bounds[1] - 1) // chunks[1] - row_bounds[0] // chunks[1] + 1
+    num_col_chunks = (col_bounds[1] - 1) // chunks[2] - col_bounds[0] // chunks[2] + 1
+    chunk_bytes = int(np.prod(chunks)) * zarr_image.dtype.itemsize
+    cost = num_band_chunks * num_row_chunks * num_col_chunks * chunk_bytes
+
+    return cost
+
+def read_envi_memmap(img, bands=None, row_bounds=None, col_bounds=None, lazy=False):
+    """Read a region of an ENVI image through a numpy.memmap of the raw file.
+    The selection is done directly in the interleave of the file (bil, bip or bsq)
+    and rows are gathered in blocks, so that the file is traversed only once
+    and only the requested bands and rows/cols are touched on disk. Within
+    each block, runs of consecutive bands are read with a single slice.
+
+    Parameters
+    ----------
+    img: spectral.SpyFile
+        image opened with spectral.open_image
+    bands: list of int
+        list of bands indices to read, None means all bands
+    row_bounds: tuple of int
+        (row_start, row_end), None means all rows
+    col_bounds: tuple of int
+        (col_start, col_end), None means all columns
+    lazy: bool
+        if True return a dask array reading from the memmap on demand,
+        otherwise load the data in a numpy array
+
+    Returns
+    -------
+    data: ndarray or dask array
+        spectral data with dims (rows, cols, bands)
+    """
+
+    if row_bounds is None:
+        row_bounds = (0, img.nrows)
+    if col_bounds is None:
+        col_bounds = (0, img.ncols)
+    if bands is None:
+        bands = np.arange(img.nbands)
+    bands = np.asarray(bands, dtype=int)
+    row_bounds = (int(row_bounds[0]), int(row_bounds[1]))
+    col_bounds = (int(col_bounds[0]), int(col_bounds[1]))
+
+    # position of rows, cols and bands axes in the raw file
+    interleave = img.metadata['interleave'].lower()
+    row_ax, col_ax, band_ax = {'bil': (0, 2, 1), 'bip': (0, 1, 2), 'bsq': (1, 2, 0)}[interleave]
+
+    raw = img.open_memmap(interleave='source')
+
+    # use a slice for contiguous bands to avoid fancy indexing
+    band_sel = bands
+    if len(bands) > 0 and np.array_equal(bands, np.arange(bands[0], bands[0] + len(bands))):
+        band_sel = slice(int(bands[0]), int(bands[0]) + len(bands))
+
+    selection = [None] * 3
+    selection[row_ax] = slice(*row_bounds)
+    selection[col_ax] = slice(*col_bounds)
+    selection[band_ax] = band_sel
+
+    if lazy:
+        import dask.array as da
+        chunks = [-1, -1, -1]
+        chunks[row_ax] = 'auto'
+        chunks[band_ax] = 1 if interleave == 'bsq' else -1
+        data = da.from_array(raw, chunks=tuple(chunks))[tuple(selection)]
+    else:
+        # in bil files each band is a short line within each row. When only
+        # few bands are needed, kernel read-ahead of complete rows is wasted
+        if (interleave == 'bil') and (len(bands) < 0.1 * img.nbands):
+            raw_mmap = getattr(raw, '_mmap', None)
+            if (raw_mmap is not None) and hasattr(mmap, 'MADV_RANDOM'):
+                raw_mmap.madvise(mmap.MADV_RANDOM)
+
+        unique_bands, inverse = np.unique(bands, return_inverse=True)
+        runs = get_contiguous_runs(unique_bands)
+
+        out_shape = [0, 0, 0]
+        out_shape[row_ax] = row_bounds[1] - row_bounds[0]
+        out_shape[col_ax] = col_bounds[1] - col_bounds[0]
+        out_shape[band_ax] = len(unique_bands)
+        data = np.empty(out_shape, dtype=raw.dtype)
+
+        # blocks of rows of ~64MB in the raw file
+        row_bytes = img.ncols * img.nbands * raw.dtype.itemsize
+        block = max(1, 2**26 // row_bytes)
+        out_selection = [slice(None)] * 3
+        for row_start in range(row_bounds[0], row_bounds[1], block):
+            row_end = min(row_start + block, row_bounds[1])
+            selection[row_ax] = slice(row_start, row_end)
+            out_selection[row_ax] = slice(row_start - row_bounds[0], row_end - row_bounds[0])
+            pos = 0
+            for start, stop in runs:
+                selection[band_ax] = slice(start, stop)
+                out_selection[band_ax] = slice(pos, pos + stop - start)
+                data[tuple(out_selection)] = raw[tuple(selection)]
+                pos += stop - start
+        
+        if not np.array_equal(unique_bands, bands):
+            data = np.take(data, inverse, axis=band_ax)
+    
+    data = data.transpose((row_ax, col_ax, band_ax))
+
+    if not data.dtype.isnative:
+        data = data.astype(data.dtype.newbyteorder('='))
+    if getattr(img, 'scale_factor', 1) != 1:
+        data = data / float(img.scale_factor)
+
+    return data
+
 def get_rgb_index(metadata=None, path=None, red=640, green=545, blue=460):
     
     if metadata is None:
@@ -155,7 +452,150 @@ def get_rgb_index(metadata=None, path=None, red=640, green=545, blue=460):
 
     return rgb_ch, rgb_wl
 
+def read_spectral_metadata(path):
+    """Read shape, data type and metadata of an hdr or zarr file from the
+    header or the zarr attributes only, without reading pixel data.
+
+    Parameters
+    ----------
+    path: str
+        path to hdr or zarr file
+
+    Returns
+    -------
+    shape: tuple of int
+        shape of the image as (rows, cols, bands)
+    dtype: numpy dtype
+        data type of the image
+    metadata: dict
+        metadata with keys 'wavelength' (list of str), 'centers' (list of float)
+    """
+
+    path = Path(path)
+    if path.suffix == '.hdr':
+        img = open_image_cached(path)
+        metadata = dict(img.metadata)
+        metadata['centers'] = img.bands.centers
+        shape = (img.nrows, img.ncols, img.nbands)
+        dtype = np.dtype(img.dtype)
+
+    elif path.suffix == '.zarr':
+        zarr_image = read_hyper_zarr(path)
+        metadata = dict(zarr_image.attrs['metadata'])
+        shape = (zarr_image.shape[1], zarr_image.shape[2], zarr_image.shape[0])
+        dtype = zarr_image.dtype
+
+    else:
+        raise ValueError(f'Unknown file format {path.suffix}')
+
+    return shape, dtype, metadata
+
+# open files, from least to most recently used, with their signature
+_handle_cache = OrderedDict()
+_handle_cache_lock = threading.Lock()
+MAX_CACHED_HANDLES = 32
+
+def _get_file_signature(path):
+    """Modification times of a file, or of a zarr folder and its metadata
+    files, used to detect that a cached handle is outdated."""
+
+    path = Path(path)
+    signature = [os.stat(path).st_mtime_ns]
+    if path.is_dir():
+        for name in ['.zgroup', '.zarray', '.zattrs']:
+            if path.joinpath(name).exists():
+                signature.append((name, os.stat(path.joinpath(name)).st_mtime_ns))
+    return tuple(signature)
+
+def _get_cached_handle(path, opener):
+    """Return the handle of path from the cache if the file didn't change
+    since it was opened, otherwise open it with opener and cache it."""
+
+    key = (opener.__name__, str(Path(path).resolve()))
+    signature = _get_file_signature(path)
+    with _handle_cache_lock:
+        if key in _handle_cache and _handle_cache[key][1] == signature:
+            _handle_cache.move_to_end(key)
+            return _handle_cache[key][0]
+
+    handle = opener(path)
+    with _handle_cache_lock:
+        _handle_cache[key] = (handle, signature)
+        _handle_cache.move_to_end(key)
+        while len(_handle_cache) > MAX_CACHED_HANDLES:
+            _handle_cache.popitem(last=False)
+    return handle
+
+def _open_zarr_read(path):
+    return zarr.open(path, mode='r')
+
+def open_image_cached(hdr_path):
+    """Open an hdr file with spectral.open_image, reusing the image of a
+    previous call if the header didn't change."""
+
+    return _get_cached_handle(hdr_path, open_image)
+
+def open_zarr_cached(zarr_path):
+    """Open a zarr file in read mode, reusing the handle of a previous call
+    if the zarr wasn't modified."""
+
+    return _get_cached_handle(zarr_path, _open_zarr_read)
+
+def clear_handle_cache():
+    """Discard all cached file handles."""
+
+    with _handle_cache_lock:
+        _handle_cache.clear()
+
 def read_hyper_zarr(zarr_path):
 
-    hyperzarr = zarr.open(zarr_path, mode='r')
+    hyperzarr = open_zarr_cached(zarr_path)
+    # multiscale zarr, use the full resolution level
+    if isinstance(hyperzarr, zarr.Group):
+        hyperzarr = hyperzarr['0']
     return hyperzarr
+
+def read_hyper_zarr_spectra(zarr_path):
+    """Open the copy of a multiscale zarr file chunked along pixels, i.e.
+    with chunks (all bands, tile, tile), if it exists. See save_spectra_copy_to_zarr.
+
+    Parameters
+    ----------
+    zarr_path: str
+        path to zarr file
+
+    Returns
+    -------
+    spectra: zarr array or None
+        full resolution image with dims (bands, rows, cols) chunked along
+        pixels, None if the zarr file doesn't contain such a copy.
+    """
+
+    hyperzarr = open_zarr_cached(zarr_path)
+    if isinstance(hyperzarr, zarr.Group) and ('spectra' in hyperzarr):
+        return hyperzarr['spectra']
+    return None
+
+def read_hyper_zarr_multiscale(zarr_path):
+    """Open all resolution levels of a zarr file. Multiscale zarr files
+    are groups with levels '0', '1', ... (OME-NGFF layout), for single
+    resolution zarr files a list with the only array is returned.
+
+    Parameters
+    ----------
+    zarr_path: str
+        path to zarr file
+
+    Returns
+    -------
+    pyramid: list of zarr arrays
+        resolution levels, from full resolution to lowest resolution
+    """
+
+    hyperzarr = open_zarr_cached(zarr_path)
+    if not isinstance(hyperzarr, zarr.Group):
+        return [hyperzarr]
+    
+    datasets = hyperzarr.attrs['multiscales'][0]['datasets']
+    pyramid = [hyperzarr[d['path']] for d in datasets]
+    return pyramid
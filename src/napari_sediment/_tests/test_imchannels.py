@@ -0,0 +1,128 @@
+import numpy as np
+from spectral.io.envi import save_image
+
+from napari_sediment.imchannels import ImChannels
+
+
+def create_image(tmp_path):
+
+    image = np.random.randint(0, 4000, (50, 40, 30)).astype(np.uint16)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, 30)]}
+    hdr_path = tmp_path.joinpath('image.hdr')
+    save_image(hdr_file=hdr_path, image=image, ext='raw', force=True,
+               metadata=metadata, interleave='bil')
+    return hdr_path, image
+
+
+def test_cache_budget(tmp_path):
+    """Check that least recently used channels are discarded when the
+    memory budget is exceeded and that counters are updated."""
+
+    hdr_path, image = create_image(tmp_path)
+    band_bytes = 50 * 40 * 2
+    imchannels = ImChannels(hdr_path, max_cache_bytes=3 * band_bytes)
+
+    cube = imchannels.get_image_cube(channels=[1, 2, 3])
+    np.testing.assert_array_equal(cube, np.moveaxis(image[:, :, [1, 2, 3]], 2, 0))
+    # no pixel data is read at init
+    assert imchannels.channel_array[0] is None
+    assert imchannels.cache_nbytes <= 3 * band_bytes
+
+    imchannels.get_image_cube(channels=[1])
+    imchannels.get_image_cube(channels=[4])
+    # band 2 is now the least recently used
+    assert imchannels.channel_array[2] is None
+    assert imchannels.channel_array[1] is not None
+
+    # requests larger than the budget are served and then trimmed
+    cube = imchannels.get_image_cube(channels=[5, 6, 7, 8, 9])
+    np.testing.assert_array_equal(cube, np.moveaxis(image[:, :, 5:10], 2, 0))
+    assert imchannels.cache_nbytes <= 3 * band_bytes
+
+    cache_info = imchannels.get_cache_info()
+    assert cache_info['hits'] == 1
+    assert cache_info['misses'] == 9
+    assert cache_info['evictions'] == 6
+
+
+def test_roi_reuse(tmp_path):
+    """Check that rois contained in the roi in memory are served from memory
+    and that partially overlapping rois are completed correctly."""
+
+    hdr_path, image = create_image(tmp_path)
+    imchannels = ImChannels(hdr_path)
+
+    assert imchannels.cache_nbytes == 0
+    assert (imchannels.nrows, imchannels.ncols) == (50, 40)
+
+    imchannels.get_image_cube(channels=[0])
+    cube = imchannels.get_image_cube(channels=[0], roi=[5, 20, 3, 30])
+    np.testing.assert_array_equal(cube[0], image[5:20, 3:30, 0])
+    assert imchannels.cache_misses == 1
+
+    imchannels.get_image_cube(channels=[1, 2], roi=[10, 30, 10, 30])
+    cube = imchannels.get_image_cube(channels=[1, 2], roi=[12, 25, 15, 20])
+    np.testing.assert_array_equal(cube, np.moveaxis(image[12:25, 15:20, 1:3], 2, 0))
+    assert imchannels.get_cache_info()['hits'] == 3
+    assert imchannels.get_cache_info()['misses'] == 3
+
+    for roi in [[0, 35, 5, 40], [20, 45, 0, 15], [0, 50, 0, 40]]:
+        cube = imchannels.get_image_cube(channels=[1, 2], roi=roi)
+        np.testing.assert_array_equal(
+            cube, np.moveaxis(image[roi[0]:roi[1], roi[2]:roi[3], 1:3], 2, 0))
+    
+    # full frame now in memory
+    assert imchannels.rois[1] is None
+    cube = imchannels.get_image_cube(channels=[2], roi=None)
+    np.testing.assert_array_equal(cube[0], image[:, :, 2])
+
+
+def test_prefetch_channels(tmp_path):
+    """Check that prefetched channels are served from memory within budget."""
+
+    hdr_path, image = create_image(tmp_path)
+    band_bytes = 50 * 40 * 2
+    imchannels = ImChannels(hdr_path, max_cache_bytes=10 * band_bytes)
+
+    loaded = imchannels.prefetch_channels(np.arange(5, 30))
+    assert loaded == list(range(5, 15))
+    assert imchannels.cache_nbytes <= 10 * band_bytes
+
+    misses = imchannels.cache_misses
+    cube = imchannels.get_image_cube(channels=[5, 9, 14])
+    np.testing.assert_array_equal(cube, np.moveaxis(image[:, :, [5, 9, 14]], 2, 0))
+    assert imchannels.cache_misses == misses
+
+
+def test_background_prefetch(tmp_path):
+    """Check that neighbouring bands are prefetched within budget and that
+    a new request cancels the pending prefetch."""
+
+    hdr_path, image = create_image(tmp_path)
+    band_bytes = 50 * 40 * 2
+    imchannels = ImChannels(hdr_path, max_cache_bytes=4 * band_bytes, prefetch_neighbours=2)
+
+    imchannels.get_image_cube(channels=[10])
+    imchannels._prefetch_future.result()
+    assert imchannels.cache_prefetched == 3
+    assert imchannels.cache_nbytes <= 4 * band_bytes
+
+    misses = imchannels.cache_misses
+    cube = imchannels.get_image_cube(channels=[11])
+    np.testing.assert_array_equal(cube[0], image[:, :, 11])
+    assert imchannels.cache_misses == misses
+
+    imchannels.get_image_cube(channels=[20], roi=[0, 10, 0, 10])
+    future = imchannels._prefetch_future
+    imchannels.cancel_prefetch()
+    assert imchannels._prefetch_future is None
+    if not future.cancelled():
+        future.result()
+    cube = imchannels.get_image_cube(channels=[21], roi=[0, 10, 0, 10])
+    np.testing.assert_array_equal(cube[0], image[:10, :10, 21])
+
+    # a budget is set by default, without budget nothing is prefetched
+    assert ImChannels(hdr_path).max_cache_bytes > 0
+    imchannels = ImChannels(hdr_path, max_cache_bytes=None, prefetch_neighbours=2)
+    imchannels.get_image_cube(channels=[10])
+    assert imchannels._prefetch_future is None
@@ -1,6 +1,14 @@
 import numpy as np
+import pytest
+import dask.array as da
+from spectral.io.envi import save_image
 
 from napari_sediment import napari_get_reader
+from napari_sediment._reader import (read_spectral, read_spectral_lazy, read_hyper_zarr_multiscale,
+                                     get_contiguous_runs, get_zarr_read_cost, read_spectral_metadata,
+                                     open_zarr_cached)
+from napari_sediment.io import create_multiscale_zarr, save_spectra_copy_to_zarr, ZARR_CODECS
+from napari_sediment.sediproc import save_to_pyramid, downsample_2x, convert_bil_raw_to_zarr
 
 
 # tmp_path is a pytest fixture
@@ -12,3 +20,192 @@ def test_reader(tmp_path):
 
 def test_get_reader_pass():
     pass
+
+
+@pytest.mark.parametrize("interleave", ['bil', 'bip', 'bsq'])
+@pytest.mark.parametrize("backend", ['memmap', 'dask'])
+def test_read_spectral_backends(tmp_path, interleave, backend):
+    """Check that memmap based backends return the same data as spectral."""
+
+    image = np.random.randint(0, 4000, (50, 40, 30)).astype(np.uint16)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, 30)]}
+    hdr_path = tmp_path.joinpath(f'image_{interleave}.hdr')
+    save_image(hdr_file=hdr_path, image=image, ext='raw', force=True,
+               metadata=metadata, interleave=interleave)
+
+    selections = [
+        (None, None, None),
+        ([3], None, None),
+        ([1, 5, 7], (3, 20), (4, 30)),
+        (np.arange(4, 9), (0, 10), None),
+        ([9, 2, 3, 4, 20, 2], (5, 45), (1, 39)),
+    ]
+    for bands, row_bounds, col_bounds in selections:
+        expected, _ = read_spectral(
+            hdr_path, bands=bands, row_bounds=row_bounds, col_bounds=col_bounds)
+        data, _ = read_spectral(
+            hdr_path, bands=bands, row_bounds=row_bounds, col_bounds=col_bounds,
+            backend=backend)
+        np.testing.assert_array_equal(np.asarray(data), expected)
+
+
+@pytest.mark.parametrize("interleave", ['bil', 'bip', 'bsq'])
+def test_read_spectral_lazy(tmp_path, interleave):
+    """Check that the lazy reader returns one chunk per band in (bands, rows, cols)."""
+
+    image = np.random.randint(0, 4000, (50, 40, 30)).astype(np.uint16)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, 30)]}
+    hdr_path = tmp_path.joinpath(f'image_{interleave}.hdr')
+    save_image(hdr_file=hdr_path, image=image, ext='raw', force=True,
+               metadata=metadata, interleave=interleave)
+
+    data, _ = read_spectral_lazy(hdr_path)
+    assert data.shape == (30, 50, 40)
+    assert data.chunks[0] == (1,) * 30
+    np.testing.assert_array_equal(data[5].compute(), image[:, :, 5])
+    np.testing.assert_array_equal(data.compute(), np.moveaxis(image, 2, 0))
+
+
+def test_multiscale_zarr(tmp_path):
+    """Check that pyramid levels are downsampled versions of the full
+    resolution image and that the full resolution is read from multiscale zarr."""
+
+    image = np.random.randint(0, 4000, (3, 37, 21)).astype(np.uint16)
+    zarr_path = tmp_path.joinpath('corrected.zarr')
+    pyramid = create_multiscale_zarr(
+        zarr_path, shape=image.shape, chunks=(1, 10, 10), dtype='u2', num_levels=3)
+    pyramid[0].attrs['metadata'] = {'wavelength': ['1', '2', '3'], 'centers': [1, 2, 3]}
+    for band in range(image.shape[0]):
+        save_to_pyramid(image[band], pyramid, (band, 0, 0))
+
+    levels = read_hyper_zarr_multiscale(zarr_path)
+    assert [level.shape for level in levels] == [(3, 37, 21), (3, 19, 11), (3, 10, 6)]
+    np.testing.assert_array_equal(levels[1][:], downsample_2x(image))
+    np.testing.assert_array_equal(levels[2][:], downsample_2x(downsample_2x(image)))
+
+    data, metadata = read_spectral(zarr_path, bands=[1], row_bounds=(5, 20))
+    np.testing.assert_array_equal(np.asarray(data)[:, :, 0], image[1, 5:20])
+    assert metadata['wavelength'] == ['1', '2', '3']
+
+
+def test_zarr_band_runs(tmp_path):
+    """Check that unordered and non-contiguous bands are read correctly from zarr."""
+
+    image = np.random.randint(0, 4000, (10, 20, 15)).astype(np.uint16)
+    zarr_path = tmp_path.joinpath('image.zarr')
+    pyramid = create_multiscale_zarr(zarr_path, shape=image.shape, chunks=(1, 10, 10), dtype='u2')
+    pyramid[0][:] = image
+    pyramid[0].attrs['metadata'] = {'wavelength': [str(x) for x in range(10)]}
+
+    assert get_contiguous_runs([2, 3, 4, 8, 9, 1]) == [(2, 5), (8, 10), (1, 2)]
+    bands = [7, 2, 3, 4, 9, 2]
+    data, _ = read_spectral(zarr_path, bands=bands, row_bounds=(3, 12), col_bounds=(1, 14), lazy=False)
+    assert isinstance(data, np.ndarray)
+    np.testing.assert_array_equal(data, np.moveaxis(image[bands, 3:12, 1:14], 0, 2))
+
+    # zarr data is lazy by default
+    data, _ = read_spectral(zarr_path, bands=bands, row_bounds=(3, 12), col_bounds=(1, 14))
+    assert isinstance(data, da.Array)
+    np.testing.assert_array_equal(data, np.moveaxis(image[bands, 3:12, 1:14], 0, 2))
+
+
+def test_spectra_copy(tmp_path):
+    """Check that the copy chunked along pixels is used for spectra and
+    gives the same data as the band chunked image."""
+
+    image = np.random.randint(0, 4000, (30, 40, 35)).astype(np.uint16)
+    zarr_path = tmp_path.joinpath('corrected.zarr')
+    pyramid = create_multiscale_zarr(zarr_path, shape=image.shape, chunks=(1, 20, 20), dtype='u2')
+    pyramid[0][:] = image
+    pyramid[0].attrs['metadata'] = {'wavelength': [str(x) for x in range(30)]}
+    spectra = save_spectra_copy_to_zarr(zarr_path, tile_size=8)
+    assert spectra.chunks == (30, 8, 8)
+
+    assert get_zarr_read_cost(spectra, np.arange(30), (5, 6), (7, 8)) < \
+        get_zarr_read_cost(pyramid[0], np.arange(30), (5, 6), (7, 8))
+    assert get_zarr_read_cost(spectra, [3], (0, 40), (0, 35)) > \
+        get_zarr_read_cost(pyramid[0], [3], (0, 40), (0, 35))
+
+    for bands, row_bounds, col_bounds in [(np.arange(30), (5, 6), (7, 8)), ([3, 1], None, None)]:
+        data, _ = read_spectral(zarr_path, bands=bands, row_bounds=row_bounds, col_bounds=col_bounds)
+        rows = slice(*row_bounds) if row_bounds else slice(None)
+        cols = slice(*col_bounds) if col_bounds else slice(None)
+        np.testing.assert_array_equal(data, np.moveaxis(image[bands][:, rows, cols], 0, 2))
+
+
+@pytest.mark.parametrize('codec', ZARR_CODECS)
+def test_zarr_codecs(tmp_path, codec):
+    """Check that all codecs round-trip data and that 'none' stores it uncompressed."""
+
+    image = np.random.randint(0, 4000, (5, 20, 15)).astype(np.uint16)
+    zarr_path = tmp_path.joinpath('image.zarr')
+    pyramid = create_multiscale_zarr(zarr_path, shape=image.shape, chunks=(1, 20, 15),
+                                     dtype='u2', codec=codec)
+    pyramid[0][:] = image
+    pyramid[0].attrs['metadata'] = {'wavelength': [str(x) for x in range(5)]}
+
+    if codec == 'none':
+        assert pyramid[0].compressor is None
+    data, _ = read_spectral(zarr_path)
+    np.testing.assert_array_equal(data, np.moveaxis(image, 0, 2))
+
+
+def test_codec_benchmark(tmp_path):
+    """Smoke test of the codec benchmark on a synthetic image."""
+
+    from napari_sediment.codec_benchmark import benchmark_codecs
+    from napari_sediment.data.synthetic import generate_synthetic_dataset
+
+    im_test, _, _, _ = generate_synthetic_dataset(
+        image_mean=1000, image_std=5, min_val=300, max_val=400, height=60, width=50,
+        ref_height=10, channels=8, white_ref_added_signal=2000, pattern_weight=10)
+    hdr_path = tmp_path.joinpath('synthetic.hdr')
+    save_image(hdr_file=hdr_path, image=im_test, ext='raw', force=True, interleave='bil',
+               metadata={'wavelength': [str(x) for x in np.linspace(400, 900, 8)]})
+
+    results = benchmark_codecs(hdr_path, num_rows=40, chunk_size=20)
+    assert [r['codec'] for r in results] == list(ZARR_CODECS)
+    for r in results:
+        assert r['ratio'] > 0 and r['write_MBps'] > 0 and r['read_MBps'] > 0
+    ratios = {r['codec']: r['ratio'] for r in results}
+    assert ratios['zstd'] > ratios['none']
+
+
+@pytest.mark.parametrize("interleave", ['bil', 'bip', 'bsq'])
+@pytest.mark.parametrize("nrows", [40, 45])
+def test_convert_raw_to_zarr(tmp_path, interleave, nrows):
+    """Check conversion of all interleaves, including a number of rows
+    multiple of the chunk size."""
+
+    image = np.random.randint(0, 4000, (nrows, 30, 6)).astype(np.uint16)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, 6)]}
+    hdr_path = tmp_path.joinpath(f'image_{interleave}.hdr')
+    save_image(hdr_file=hdr_path, image=image, ext='raw', force=True,
+               metadata=metadata, interleave=interleave)
+
+    convert_bil_raw_to_zarr(hdr_path, tmp_path, num_rows_chunk=10, multiscale=False,
+                            num_workers=3, max_blocks_in_flight=2)
+    data, _ = read_spectral(tmp_path.joinpath(f'image_{interleave}.zarr'))
+    np.testing.assert_array_equal(data, image)
+
+
+def test_read_spectral_metadata(tmp_path):
+    """Check that metadata is read without pixel data and that cached
+    zarr handles are renewed when the file is rewritten."""
+
+    image = np.random.randint(0, 4000, (4, 20, 15)).astype(np.uint16)
+    zarr_path = tmp_path.joinpath('image.zarr')
+    pyramid = create_multiscale_zarr(zarr_path, shape=image.shape, chunks=(1, 20, 15), dtype='u2')
+    pyramid[0].attrs['metadata'] = {'wavelength': ['1', '2', '3', '4'], 'centers': [1, 2, 3, 4]}
+
+    shape, dtype, metadata = read_spectral_metadata(zarr_path)
+    assert shape == (20, 15, 4)
+    assert dtype == np.uint16
+    assert metadata['wavelength'] == ['1', '2', '3', '4']
+    assert open_zarr_cached(zarr_path) is open_zarr_cached(zarr_path)
+
+    pyramid = create_multiscale_zarr(zarr_path, shape=(2, 10, 5), chunks=(1, 10, 5), dtype='f4')
+    pyramid[0].attrs['metadata'] = {'wavelength': ['1', '2'], 'centers': [1, 2]}
+    shape, dtype, _ = read_spectral_metadata(zarr_path)
+    assert shape == (10, 5, 2)
+    assert dtype == np.float32
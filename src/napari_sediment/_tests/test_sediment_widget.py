@@ -60,4 +60,28 @@ def test_select_file(make_napari_viewer, capsys):
     assert 'green' in viewer.layers
     assert 'blue' in viewer.layers
     assert 'imcube' in viewer.layers
-    assert len(self.imagechannels.channel_names) == 80, f"Expected 80 channels got {len(self.imagechannels.channel_names)}"
\ No newline at end of file
+    assert len(self.imagechannels.channel_names) == 80, f"Expected 80 channels got {len(self.imagechannels.channel_names)}"
+
+def test_mask_shape_multiscale(make_napari_viewer):
+    """Masks of a large image displayed as multiscale layer have full resolution."""
+
+    from napari_sediment.utils import add_or_update_image_layer
+
+    viewer = make_napari_viewer()
+    self = SedimentWidget(viewer)
+    self.row_bounds, self.col_bounds = [0, 40], [0, 2500]
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(100, 200, (3, 40, 2500)).astype(np.uint16)
+    layer = add_or_update_image_layer(viewer, image, name='imcube')
+    assert layer.multiscale
+
+    self._update_combo_layers_destripe()
+    self.combo_layer_mask.setCurrentText('imcube')
+
+    self._on_click_remove_borders()
+    assert viewer.layers['border-mask'].data.shape == (40, 2500)
+    self._on_click_intensity_threshold()
+    assert viewer.layers['intensity-mask'].data.shape == (40, 2500)
+    self._on_click_automated_threshold()
+    assert viewer.layers['intensity-mask'].data.shape == (40, 2500)
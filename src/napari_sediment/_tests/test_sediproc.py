@@ -0,0 +1,396 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import zarr
+from scipy.signal import savgol_filter
+from spectral.io.envi import save_image
+
+from napari_sediment._reader import read_spectral
+from napari_sediment import sediproc
+from napari_sediment.sediproc import (correct_save_to_zarr, load_reference_profile, preprocess_raw_to_zarr,
+                                      load_white_dark, white_dark_correct, savgol_destripe,
+                                      StreamingColumnMedian, fit_1dgaussian_without_outliers, custom_ppi,
+                                      phasor, spectral_clustering)
+
+
+def create_references(tmp_path, nrows=40, ncols=120, nbands=12):
+
+    rng = np.random.default_rng(0)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, nbands)]}
+    paths = []
+    for name, low, high, rows in [('image', 500, 3000, nrows), ('white', 3500, 4000, 10),
+                                  ('dark', 0, 300, 10)]:
+        data = rng.integers(low, high, (rows, ncols, nbands)).astype(np.uint16)
+        hdr_path = tmp_path.joinpath(f'{name}.hdr')
+        save_image(hdr_file=hdr_path, image=data, ext='raw', force=True,
+                   metadata=metadata, interleave='bil')
+        paths.append(hdr_path)
+    return paths
+
+
+def test_correct_band_blocks(tmp_path):
+    """Check that correction by blocks of bands doesn't depend on block size."""
+
+    im_path, white_path, dark_path = create_references(tmp_path)
+    band_indices = [0, 2, 3, 4, 7, 11]
+
+    results = []
+    for ind, max_block_bytes in enumerate([1, 40 * 120 * 8 * 4, 2**30]):
+        zarr_path = tmp_path.joinpath(f'corrected_{ind}.zarr')
+        correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path,
+                             band_indices=band_indices, destripe=True, chunk_size=16,
+                             max_block_bytes=max_block_bytes)
+        results.append(zarr.open(zarr_path, mode='r')['0'][:])
+
+    assert results[0].shape == (6, 40, 120)
+    np.testing.assert_array_equal(results[0], results[1])
+    np.testing.assert_array_equal(results[0], results[2])
+
+
+def test_reference_profile_cache(tmp_path):
+    """Check that reference profiles are cached in the given folder, reused
+    and recomputed when the reference changes."""
+
+    _, white_path, dark_path = create_references(tmp_path)
+    white, _ = read_spectral(white_path)
+    cache_folder = tmp_path.joinpath('export')
+    cache_folder.mkdir()
+
+    profile, rows_kept = load_reference_profile(white_path, cache_folder=cache_folder)
+    cache_paths = list(cache_folder.glob('white_*_profile.npz'))
+    assert len(cache_paths) == 1
+    assert not list(tmp_path.glob('*.npz'))
+    assert rows_kept.all()
+    np.testing.assert_array_equal(profile, white.mean(axis=0))
+
+    # same content with a new modification time is still valid
+    os.utime(tmp_path.joinpath('white.raw'), ns=(0, 0))
+    profile_reused, _ = load_reference_profile(white_path, cache_folder=cache_folder)
+    np.testing.assert_array_equal(profile_reused, profile)
+    with np.load(cache_paths[0]) as cache:
+        assert int(cache['mtime_ns']) == 0
+
+    new_white = np.full(white.shape, 3000, dtype=np.uint16)
+    save_image(hdr_file=white_path, image=new_white, ext='raw', force=True,
+               metadata={'wavelength': [str(x) for x in range(white.shape[2])]}, interleave='bil')
+    profile, _ = load_reference_profile(white_path, cache_folder=cache_folder)
+    np.testing.assert_array_equal(profile, 3000)
+
+    # profiles give the same correction as complete references, also when
+    # the white reference is cleaned within the selection
+    data = np.random.randint(0, 4000, (2, 7, 45)).astype(np.uint16)
+    for clean_white in [False, True]:
+        references = load_white_dark(white_path, dark_path, dark_path, channel_indices=[1, 4],
+                                     col_bounds=(5, 50), clean_white=clean_white,
+                                     use_cache=True, cache_folder=cache_folder)
+        full_references = load_white_dark(white_path, dark_path, dark_path, channel_indices=[1, 4],
+                                          col_bounds=(5, 50), clean_white=clean_white)
+        np.testing.assert_array_equal(white_dark_correct(data, *references),
+                                      white_dark_correct(data, *full_references))
+
+
+@pytest.mark.parametrize('nrows', [40, 41])
+@pytest.mark.parametrize('destripe', [False, True])
+def test_correct_row_tiles(tmp_path, nrows, destripe):
+    """Check that out-of-core correction by row tiles gives the same result
+    as in-memory correction, including the exact median used for destriping."""
+
+    im_path, white_path, dark_path = create_references(tmp_path, nrows=nrows)
+
+    results = []
+    for ind, num_rows_tile in enumerate([None, 7]):
+        zarr_path = tmp_path.joinpath(f'corrected_{ind}.zarr')
+        correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path,
+                             destripe=destripe, chunk_size=16, num_rows_tile=num_rows_tile)
+        results.append(zarr.open(zarr_path, mode='r')['0'][:])
+
+    np.testing.assert_array_equal(results[0], results[1])
+
+
+def test_correct_executors(tmp_path):
+    """Check that executors give the same result and that executors passed
+    by the caller are not closed."""
+
+    im_path, white_path, dark_path = create_references(tmp_path)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for ind, executor in enumerate(['serial', pool, pool, 'processes']):
+            zarr_path = tmp_path.joinpath(f'corrected_{ind}.zarr')
+            correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path,
+                                 chunk_size=16, max_block_bytes=2 * 40 * 120 * 24 * 5,
+                                 executor=executor, num_workers=2)
+            results.append(zarr.open(zarr_path, mode='r')['0'][:])
+
+    for result in results[1:]:
+        np.testing.assert_array_equal(results[0], result)
+
+
+@pytest.mark.parametrize('destripe', [False, True])
+def test_preprocess_raw_single_pass(tmp_path, destripe):
+    """Check that the single pass pipeline gives the same result as
+    correct_save_to_zarr and saves band statistics."""
+
+    im_path, white_path, dark_path = create_references(tmp_path)
+
+    correct_save_to_zarr(im_path, white_path, dark_path, dark_path, tmp_path.joinpath('ref.zarr'),
+                         band_indices=[2, 3, 4, 5], destripe=destripe, chunk_size=16)
+    preprocess_raw_to_zarr(im_path, white_path, dark_path, dark_path, tmp_path.joinpath('fused.zarr'),
+                           band_indices=[2, 3, 4, 5], destripe=destripe, chunk_size=16,
+                           max_block_bytes=3 * 4 * 120 * 24 * 16, num_workers=3)
+    expected = zarr.open(tmp_path.joinpath('ref.zarr'), mode='r')['0']
+    result = zarr.open(tmp_path.joinpath('fused.zarr'), mode='r')['0']
+    np.testing.assert_array_equal(result[:], expected[:])
+    assert result.attrs['metadata'] == expected.attrs['metadata']
+
+    statistics = result.attrs['statistics']
+    np.testing.assert_allclose(statistics['mean'], expected[:].mean(axis=(1, 2)))
+    np.testing.assert_allclose(statistics['std'], expected[:].std(axis=(1, 2)))
+    np.testing.assert_array_equal(statistics['max'], expected[:].max(axis=(1, 2)))
+
+
+def test_savgol_destripe():
+    """Check destriping of all bands against a float64 reference, in place
+    and by blocks of bands."""
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 65535, (30, 120, 5)).astype(np.uint16)
+    image[:, ::7] = 65535
+    profile = np.median(image, axis=0)
+    expected = np.clip(image + savgol_filter(profile, 100, 2, axis=0) - profile, 0, 65535)
+
+    destriped = savgol_destripe(image, width=100, order=2)
+    assert destriped.dtype == np.uint16
+    np.testing.assert_allclose(destriped, expected, atol=1)
+    np.testing.assert_array_equal(savgol_destripe(image[:, :, 2]), destriped[:, :, 2])
+
+    blocks = savgol_destripe(image, inplace=True, max_block_bytes=30 * 120 * 4 * 2)
+    assert blocks is image
+    np.testing.assert_array_equal(blocks, destriped)
+
+
+@pytest.mark.parametrize('tolerance', [1, 16, 100])
+def test_streaming_column_median(tolerance):
+    """Check that the streaming median is within tolerance of the exact
+    median for odd and even numbers of rows, and ignores NaNs."""
+
+    rng = np.random.default_rng(0)
+    image = rng.normal(3000, 800, (1001, 50, 3)).clip(0, 65535)
+    image[:, ::5] = rng.integers(0, 65535, (1001, 10, 3))
+    for num_rows in [1000, 1001]:
+        estimator = StreamingColumnMedian(50, 3, tolerance=tolerance)
+        for r in range(0, num_rows, 64):
+            estimator.update(image[r:min(r + 64, num_rows)].astype(np.uint16))
+        exact = np.median(image[:num_rows].astype(np.uint16), axis=0)
+        assert np.abs(estimator.median() - exact).max() <= tolerance
+
+    image[::3, 0] = np.nan
+    estimator = StreamingColumnMedian(50, 3, tolerance=tolerance)
+    estimator.update(image)
+    assert np.abs(estimator.median() - np.nanmedian(image, axis=0)).max() <= tolerance
+
+
+def test_destripe_approximate_median(tmp_path):
+    """Check that destriping with the approximate median by row tiles is
+    close to destriping with the exact median."""
+
+    im_path, white_path, dark_path = create_references(tmp_path, nrows=41)
+
+    # histograms of 3 bands per block with the smaller budget
+    hist_block_bytes = 3 * 120 * 2**16 * 4
+    results = []
+    for ind, (num_rows_tile, median_tolerance, max_block_bytes) in enumerate(
+            [(None, None, 2**30), (None, 1, 2**30), (7, 1, 2**30), (None, 1, hist_block_bytes),
+             (7, 1, hist_block_bytes)]):
+        zarr_path = tmp_path.joinpath(f'corrected_{ind}.zarr')
+        correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path,
+                             destripe=True, chunk_size=16, num_rows_tile=num_rows_tile,
+                             median_tolerance=median_tolerance, max_block_bytes=max_block_bytes)
+        results.append(zarr.open(zarr_path, mode='r')['0'][:].astype(float))
+
+    for result in results[2:]:
+        np.testing.assert_array_equal(results[1], result)
+    # offsets are a smoothed median minus the median, each within tolerance
+    assert np.abs(results[1] - results[0]).max() <= 3
+
+
+def test_resume_interrupted_run(tmp_path, monkeypatch):
+    """Check that a resumed run only processes unfinished blocks of bands and
+    gives the same result as an uninterrupted run."""
+
+    im_path, white_path, dark_path = create_references(tmp_path)
+    kwargs = dict(destripe=True, chunk_size=16, max_block_bytes=40 * 120 * 24 * 5)
+    correct_save_to_zarr(im_path, white_path, dark_path, dark_path, tmp_path.joinpath('ref.zarr'), **kwargs)
+
+    correct_band_block = sediproc.correct_band_block
+    processed = []
+    def interrupted(*args):
+        if args[5] >= 10:
+            raise MemoryError
+        processed.append(args[5])
+        correct_band_block(*args)
+
+    zarr_path = tmp_path.joinpath('corrected.zarr')
+    monkeypatch.setattr(sediproc, 'correct_band_block', interrupted)
+    with pytest.raises(MemoryError):
+        correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path, **kwargs)
+    assert zarr.open(zarr_path, mode='r')['0'].attrs['completed']['bands'] == list(range(10))
+
+    def resumed(*args):
+        processed.append(args[5])
+        correct_band_block(*args)
+    monkeypatch.setattr(sediproc, 'correct_band_block', resumed)
+    correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path, resume=True, **kwargs)
+    assert processed == [0, 5, 10]
+    np.testing.assert_array_equal(zarr.open(zarr_path, mode='r')['0'][:],
+                                  zarr.open(tmp_path.joinpath('ref.zarr'), mode='r')['0'][:])
+
+    # finished run is not processed again, other options start from scratch
+    correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path, resume=True, **kwargs)
+    assert processed == [0, 5, 10]
+    kwargs['destripe'] = False
+    correct_save_to_zarr(im_path, white_path, dark_path, dark_path, zarr_path, resume=True, **kwargs)
+    assert processed == [0, 5, 10, 0, 5, 10]
+
+    # other references start from scratch
+    other_dir = tmp_path.joinpath('other')
+    other_dir.mkdir()
+    _, other_white_path, _ = create_references(other_dir)
+    correct_save_to_zarr(im_path, other_white_path, dark_path, dark_path, zarr_path, resume=True, **kwargs)
+    assert processed == [0, 5, 10, 0, 5, 10, 0, 5, 10]
+
+    # a spectra copy with another tile size is saved again without processing bands
+    for tile_size in [8, 4]:
+        correct_save_to_zarr(im_path, other_white_path, dark_path, dark_path, zarr_path, resume=True,
+                             spectra_tile_size=tile_size, **kwargs)
+        assert zarr.open(zarr_path, mode='r')['spectra'].chunks[1:] == (tile_size, tile_size)
+    assert processed == [0, 5, 10, 0, 5, 10, 0, 5, 10]
+
+
+def test_fit_1dgaussian_without_outliers():
+    """Check the fast robust fit against sklearn's EllipticEnvelope, with
+    and without sampling, and that outliers are discarded."""
+
+    rng = np.random.default_rng(0)
+    data = np.concatenate([rng.normal(1000, 50, 200_000), rng.uniform(0, 4000, 20_000)])
+
+    expected = fit_1dgaussian_without_outliers(data, method='mcd')
+    full = fit_1dgaussian_without_outliers(data, max_samples=None)
+    sampled = fit_1dgaussian_without_outliers(data, max_samples=50_000)
+
+    # estimates agree within their statistical error, also across sklearn versions
+    np.testing.assert_allclose(full, expected, rtol=1e-2)
+    np.testing.assert_allclose(sampled, expected, rtol=2e-2)
+    np.testing.assert_allclose(full, (1000, 50), rtol=5e-2)
+    np.testing.assert_allclose(sampled, fit_1dgaussian_without_outliers(data, max_samples=50_000), rtol=0)
+
+
+@pytest.mark.parametrize('threshold', [0, 0.5])
+def test_custom_ppi(threshold):
+    """Check batched PPI against one skewer at a time, for different batch
+    sizes and numbers of threads."""
+
+    rng = np.random.default_rng(0)
+    image = rng.random((20, 15, 6))
+    X = (image - image.reshape(-1, 6).mean(axis=0)).reshape(-1, 6)
+
+    skewers = np.random.default_rng(42)
+    counts = np.zeros(len(X), dtype=np.uint32)
+    total_ppi = [0]
+    for _ in range(50):
+        r = skewers.random(6) - 0.5
+        s = X.dot(r / np.sqrt(np.sum(r * r)))
+        if threshold == 0:
+            counts[np.argmin(s)] += 1
+            counts[np.argmax(s)] += 1
+        else:
+            counts[s >= s.max() - threshold] += 1
+            counts[s <= s.min() + threshold] += 1
+        total_ppi.append(np.sum(counts > 0))
+
+    for batch_size, num_workers, block_size in [(1, 1, 4096), (7, 3, 16), (256, 4, 100)]:
+        result, result_total = custom_ppi(image, niters=50, threshold=threshold, batch_size=batch_size,
+                                          num_workers=num_workers, random_state=42, dtype=np.float64,
+                                          block_size=block_size)
+        np.testing.assert_array_equal(result, counts.reshape(20, 15))
+        assert result_total == total_ppi
+
+
+@pytest.mark.parametrize('threshold', [0, 0.5])
+def test_custom_ppi_out_of_core(tmp_path, threshold):
+    """Check PPI on a masked chunked zarr cube with bands first against the
+    in-memory image with masked pixels removed."""
+
+    rng = np.random.default_rng(0)
+    image = rng.random((20, 15, 6))
+    mask = np.zeros((20, 15), dtype=bool)
+    mask[:, :3] = True
+    cube = zarr.open(tmp_path.joinpath('denoised.zarr'), mode='w', shape=(6, 20, 15), chunks=(6, 4, 4))
+    cube[:] = np.moveaxis(image, 2, 0)
+
+    expected, expected_total = custom_ppi(image[:, 3:], niters=50, threshold=threshold,
+                                          random_state=1, dtype=np.float64)
+    for max_block_bytes in [2**28, 1]:
+        result, result_total = custom_ppi(cube, niters=50, threshold=threshold, random_state=1,
+                                          dtype=np.float64, block_size=30, mask=mask, channel_axis=0,
+                                          batch_size=16, max_block_bytes=max_block_bytes)
+        np.testing.assert_array_equal(result[:, 3:], expected)
+        assert not result[:, :3].any()
+        assert result_total == expected_total
+
+
+@pytest.mark.parametrize('harmonic', [1, 2])
+def test_phasor(tmp_path, harmonic):
+    """Check phasor components against the full FFT, reading all bands
+    lazily by tiles of rows."""
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4000, (40, 30, 25)).astype(np.uint16)
+    image[:, 0, 0] = 0
+
+    data = np.fft.fft(np.moveaxis(image, 2, 0), axis=0)
+    dc = data[0].real
+    dc = np.where(dc != 0, dc, int(np.mean(dc)))
+    expected = [data[harmonic].real / -dc, data[harmonic].imag / -dc,
+                np.abs(data[harmonic]) / dc, np.angle(data[harmonic], deg=True)]
+
+    save_image(hdr_file=tmp_path.joinpath('image.hdr'), image=image, ext='raw', force=True,
+               metadata={'wavelength': [str(x) for x in range(25)]}, interleave='bil')
+    lazy, _ = read_spectral(tmp_path.joinpath('image.hdr'), backend='dask')
+    for stack in [np.moveaxis(image, 2, 0), np.moveaxis(lazy, 2, 0)]:
+        result = phasor(stack, harmonic=harmonic, max_block_bytes=25 * 30 * 4 * 7)
+        for r, e in zip(result, expected):
+            np.testing.assert_allclose(r, e, rtol=1e-4, atol=1e-4)
+
+
+def test_spectral_clustering_binned():
+    """Check that binned clustering finds the same clusters as DBSCAN on all pixels."""
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 3, (4, 8))
+    pixels = np.concatenate([c + rng.normal(0, 0.4, (1000, 8)) for c in centers])
+
+    expected = spectral_clustering(pixels, dbscan_eps=0.3)
+    result = spectral_clustering(pixels, dbscan_eps=0.3, method='binned')
+    assert expected.max() >= 1
+    # same partition up to label permutation
+    pairs = np.unique(np.stack([expected, result]), axis=1)
+    assert pairs.shape[1] == len(np.unique(expected)) == len(np.unique(result))
+
+def test_spectral_clustering_non_finite():
+    """Check that pixels with NaN or inf are labelled -1 and don't change other labels."""
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 3, (4, 8))
+    pixels = np.concatenate([c + rng.normal(0, 0.4, (1000, 8)) for c in centers])
+    corrupted = pixels.copy()
+    corrupted[[5, 1500, 3999], [0, 3, 7]] = [np.nan, np.inf, -np.inf]
+    valid = np.ones(len(pixels), dtype=bool)
+    valid[[5, 1500, 3999]] = False
+
+    for method in ['dbscan', 'binned']:
+        expected = spectral_clustering(pixels[valid], dbscan_eps=0.3, method=method)
+        result = spectral_clustering(corrupted, dbscan_eps=0.3, method=method)
+        np.testing.assert_array_equal(result[~valid], -1)
+        np.testing.assert_array_equal(result[valid], expected)
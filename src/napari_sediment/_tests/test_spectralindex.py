@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from spectral.io.envi import save_image
+
+from napari_sediment.imchannels import ImChannels
+from napari_sediment.spectralindex import compute_index_RABD, compute_index_RABA, compute_index_ratio
+
+
+@pytest.fixture
+def imchannels(tmp_path):
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4000, (50, 40, 30)).astype(np.uint16)
+    metadata = {'wavelength': [str(x) for x in np.linspace(400, 900, 30)]}
+    hdr_path = tmp_path.joinpath('image.hdr')
+    save_image(hdr_file=hdr_path, image=image, ext='raw', force=True,
+               metadata=metadata, interleave='bil')
+    return ImChannels(hdr_path)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_index_kernels(imchannels, backend):
+    """Check fused index kernels against the formulas computed with float32 arrays."""
+
+    if backend == 'numba':
+        pytest.importorskip('numba')
+
+    row_bounds, col_bounds = [5, 45], [0, 35]
+    centers = imchannels.centers
+    cube = imchannels.get_image_cube(channels=np.arange(30), roi=row_bounds + col_bounds).astype(np.float32)
+
+    # RABD with bands 3, 10, 20
+    bands = cube[[3, 10, 20]] + 0.0000001
+    expected = ((bands[0] * 10 + bands[2] * 7) / 17) / bands[1]
+    result = compute_index_RABD(centers[3], centers[10], centers[20], row_bounds, col_bounds,
+                                imchannels, backend=backend)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-5)
+
+    # ratio of bands 4 and 12
+    expected = cube[4] / (cube[12] + 0.0000001)
+    result = compute_index_ratio(centers[4], centers[12], row_bounds, col_bounds, imchannels, backend=backend)
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+    # RABA between bands 5 and 15
+    line = (cube[15] - cube[5]) / 10
+    expected = np.sum([(cube[5] + i * line) / (cube[5 + i] + 0.0000001) - 1 for i in range(10)], axis=0)
+    result = compute_index_RABA(centers[5], centers[15], row_bounds, col_bounds, imchannels, backend=backend)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_rabd_same_bands(imchannels, backend):
+    """Check that RABD is nan when left, trough and right bands are the same."""
+
+    if backend == 'numba':
+        pytest.importorskip('numba')
+
+    centers = imchannels.centers
+    result = compute_index_RABD(centers[3], centers[3], centers[3], [5, 45], [0, 35],
+                                imchannels, backend=backend)
+    assert result.shape == (40, 35)
+    assert np.all(np.isnan(result))
@@ -1,11 +1,14 @@
 from pathlib import Path
 from .io import get_data_background_path
-from .sediproc import correct_save_to_zarr
+from .sediproc import correct_save_to_zarr, preprocess_raw_to_zarr
 from .imchannels import ImChannels
 from .parameters.parameters import Param
 
 def batch_preprocessing(folder_to_analyze, export_folder, background_text='_WR_',
-                        min_max_band=None, background_correction=True, destripe=True, use_dask=True, chunk_size=1000):
+                        min_max_band=None, background_correction=True, destripe=True, use_dask=True, chunk_size=1000,
+                        spectra_tile_size=None, codec='default', use_reference_cache=True,
+                        num_rows_tile=None, executor=None, single_pass=False,
+                        median_tolerance=None, resume=False):
 
     export_folder = Path(export_folder)
     _, _, white_file_path, dark_for_white_file_path, dark_for_im_file_path, imhdr_path = get_data_background_path(folder_to_analyze, background_text=background_text)
@@ -22,21 +25,47 @@ def batch_preprocessing(folder_to_analyze, export_folder, background_text='_WR_'
         dark_for_im_path=dark_for_im_file_path,
         dark_for_white_path=dark_for_white_file_path,
         main_roi=[],
-        rois=[])
+        rois=[],
+        codec=codec)
     
-    correct_save_to_zarr(
-        imhdr_path=imhdr_path,
-        white_file_path=white_file_path,
-        dark_for_im_file_path=dark_for_im_file_path,
-        dark_for_white_file_path=dark_for_white_file_path,
-        zarr_path=export_folder.joinpath('corrected.zarr'),
-        band_indices=None,
-        min_max_bands=min_max_band,
-        background_correction=background_correction,
-        destripe=destripe,
-        use_dask=use_dask,
-        chunk_size=chunk_size
-        )
+    if single_pass:
+        preprocess_raw_to_zarr(
+            imhdr_path=imhdr_path,
+            white_file_path=white_file_path,
+            dark_for_im_file_path=dark_for_im_file_path,
+            dark_for_white_file_path=dark_for_white_file_path,
+            zarr_path=export_folder.joinpath('corrected.zarr'),
+            band_indices=None,
+            min_max_bands=min_max_band,
+            background_correction=background_correction,
+            destripe=destripe,
+            chunk_size=chunk_size,
+            spectra_tile_size=spectra_tile_size,
+            codec=codec,
+            use_reference_cache=use_reference_cache,
+            resume=resume
+            )
+    else:
+        correct_save_to_zarr(
+            imhdr_path=imhdr_path,
+            white_file_path=white_file_path,
+            dark_for_im_file_path=dark_for_im_file_path,
+            dark_for_white_file_path=dark_for_white_file_path,
+            zarr_path=export_folder.joinpath('corrected.zarr'),
+            band_indices=None,
+            min_max_bands=min_max_band,
+            background_correction=background_correction,
+            destripe=destripe,
+            use_dask=use_dask,
+            chunk_size=chunk_size,
+            spectra_tile_size=spectra_tile_size,
+            codec=codec,
+            use_reference_cache=use_reference_cache,
+            num_rows_tile=num_rows_tile,
+            executor=executor,
+            median_tolerance=median_tolerance,
+            resume=resume
+            )
     imchannels = ImChannels(export_folder.joinpath('corrected.zarr'))
     param.main_roi = [[
         0, 0,
@@ -1,7 +1,7 @@
 from pathlib import Path
 import matplotlib.pyplot as plt
 from qtpy.QtWidgets import (QWidget, QVBoxLayout, QPushButton, QGridLayout, QLineEdit,
-                            QFileDialog, QCheckBox, QSpinBox, QLabel)
+                            QFileDialog, QCheckBox, QSpinBox, QLabel, QComboBox)
 from qtpy.QtCore import Qt
 from magicgui.widgets import FileEdit
 from napari.utils import progress
@@ -10,8 +10,8 @@ from napari_guitils.gui_structures import VHGroup
 
 from .imchannels import ImChannels
 from .folder_list_widget import FolderListWidget
-from .sediproc import correct_save_to_zarr
-from .io import get_data_background_path
+from .sediproc import correct_save_to_zarr, get_executor
+from .io import get_data_background_path, ZARR_CODECS
 from .widgets.channel_widget import ChannelWidget
 from .batch_preproc import batch_preprocessing
 
@@ -36,6 +36,8 @@ class BatchPreprocWidget(QWidget):
         Maximum band to crop
     chunk_size: int
         Chunk size for zarr saving
+    codec: str
+        Compression codec for zarr saving, one of io.ZARR_CODECS
 
     Attributes
     ----------
@@ -47,7 +49,7 @@ class BatchPreprocWidget(QWidget):
     
     def __init__(self, napari_viewer, 
                  destripe=False, background_correct=True, savgol_window=None,
-                 min_band=None, max_band=None, chunk_size=500):
+                 min_band=None, max_band=None, chunk_size=500, codec='default'):
         super().__init__()
         
         self.viewer = napari_viewer
@@ -134,11 +136,22 @@ class BatchPreprocWidget(QWidget):
         self.options_group.glayout.addWidget(QLabel('Chunk size'), 6, 0, 1, 1)
         self.options_group.glayout.addWidget(self.spin_chunksize, 6, 1, 1, 1)
 
-        self.check_use_dask = QCheckBox("Use dask")
+        self.combo_codec = QComboBox()
+        self.combo_codec.addItems(ZARR_CODECS)
+        self.combo_codec.setCurrentText(codec)
+        self.options_group.glayout.addWidget(QLabel('Compression'), 7, 0, 1, 1)
+        self.options_group.glayout.addWidget(self.combo_codec, 7, 1, 1, 1)
+
+        self.check_use_dask = QCheckBox("Parallel processing")
         self.check_use_dask.setChecked(True)
-        self.check_use_dask.setToolTip("Use dask to parallelize computation")
+        self.check_use_dask.setToolTip("Process blocks of bands in parallel threads")
         self.tabs.add_named_tab('&Preprocessing', self.check_use_dask)
 
+        self.check_resume = QCheckBox("Resume interrupted runs")
+        self.check_resume.setChecked(False)
+        self.check_resume.setToolTip("Keep finished bands of existing exports with the same options")
+        self.tabs.add_named_tab('&Preprocessing', self.check_resume)
+
         self.btn_preproc_folder = QPushButton("Preprocess")
         self.tabs.add_named_tab('&Preprocessing', self.btn_preproc_folder)
 
@@ -252,27 +265,39 @@ class BatchPreprocWidget(QWidget):
 
         main_folder = Path(self.file_list.folder_path)
 
+        # one pool reused for all folders of the batch
+        executor, close_executor = get_executor(
+            'threads' if self.check_use_dask.isChecked() else 'serial')
+
         self.viewer.window._status_bar._toggle_activity_dock(True)
-        with progress(range(self.file_list.count())) as pbr:
-            pbr.set_description("Batch processing folder")
-            for c in pbr:
-                f = self.file_list.item(c).text()
-                current_folder = main_folder.joinpath(f)
-
-                min_max_band = None
-                if self.check_do_min_max.isChecked():
-                    min_band = self.qspin_min_band.value()
-                    max_band = self.qspin_max_band.value()
-                    min_max_band = [min_band, max_band]
-
-                batch_preprocessing(
-                    folder_to_analyze=current_folder,
-                    export_folder=self.preproc_export_path_display.value,
-                    background_text=background_text,
-                    min_max_band=min_max_band,
-                    background_correction=self.check_do_background_correction.isChecked(),
-                    destripe=self.check_do_destripe.isChecked(),
-                    use_dask=self.check_use_dask.isChecked(),
-                    chunk_size=self.spin_chunksize.value()
-                )
-        self.viewer.window._status_bar._toggle_activity_dock(False)
+        try:
+            with progress(range(self.file_list.count())) as pbr:
+                pbr.set_description("Batch processing folder")
+                for c in pbr:
+                    f = self.file_list.item(c).text()
+                    current_folder = main_folder.joinpath(f)
+
+                    min_max_band = None
+                    if self.check_do_min_max.isChecked():
+                        min_band = self.qspin_min_band.value()
+                        max_band = self.qspin_max_band.value()
+                        min_max_band = [min_band, max_band]
+
+                    batch_preprocessing(
+                        folder_to_analyze=current_folder,
+                        export_folder=self.preproc_export_path_display.value,
+                        background_text=background_text,
+                        min_max_band=min_max_band,
+                        background_correction=self.check_do_background_correction.isChecked(),
+                        destripe=self.check_do_destripe.isChecked(),
+                        use_dask=self.check_use_dask.isChecked(),
+                        chunk_size=self.spin_chunksize.value(),
+                        codec=self.combo_codec.currentText(),
+                        executor=executor,
+                        resume=self.check_resume.isChecked()
+                    )
+        finally:
+            # also release the pool and the activity dock if a folder fails
+            if close_executor:
+                close_executor()
+            self.viewer.window._status_bar._toggle_activity_dock(False)
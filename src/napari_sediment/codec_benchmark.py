@@ -0,0 +1,111 @@
+"""
+Benchmark of zarr compression codecs on a sample of a spectral image.
+Run from the command line with:
+
+    python -m napari_sediment.codec_benchmark path/to/image.hdr
+
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import zarr
+from spectral import open_image
+
+from ._reader import read_spectral, read_hyper_zarr
+from .io import get_zarr_compressor_kwargs, ZARR_CODECS
+
+
+def benchmark_codecs(path, codecs=None, num_rows=1000, chunk_size=500, clevel=5):
+    """Measure compression ratio and write/read speed of zarr codecs on a
+    block of rows taken from the middle of an image.
+
+    Parameters
+    ----------
+    path : str
+        Path to hdr or zarr file.
+    codecs : list of str, optional
+        Codecs to test, see io.get_zarr_compressor_kwargs. If None, all
+        codecs in io.ZARR_CODECS are tested.
+    num_rows : int, optional
+        Number of rows of the sample. Default is 1000.
+    chunk_size : int, optional
+        Size of chunks along rows and cols, as in correct_save_to_zarr. Default is 500.
+    clevel : int, optional
+        Compression level for Blosc codecs. Default is 5.
+
+    Returns
+    -------
+    results : list of dict
+        One dict per codec with keys 'codec', 'ratio' (uncompressed size /
+        stored size), 'write_MBps' and 'read_MBps'.
+    """
+
+    path = Path(path)
+    if codecs is None:
+        codecs = ZARR_CODECS
+
+    if path.suffix == '.hdr':
+        nrows = open_image(path).nrows
+    else:
+        nrows = read_hyper_zarr(path).shape[1]
+    num_rows = min(num_rows, nrows)
+    row_start = (nrows - num_rows) // 2
+
+    data, _ = read_spectral(path, row_bounds=(row_start, row_start + num_rows), backend='memmap')
+    sample = np.ascontiguousarray(np.moveaxis(np.asarray(data), 2, 0))
+    size_MB = sample.nbytes / 2**20
+    # avoid padded edge chunks on small samples which would bias the ratio
+    chunks = (1, min(chunk_size, sample.shape[1]), min(chunk_size, sample.shape[2]))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec in codecs:
+            zarr_path = Path(tmp_dir).joinpath(f'{codec}.zarr')
+
+            t0 = time.perf_counter()
+            im_zarr = zarr.open(zarr_path, mode='w', shape=sample.shape,
+                                chunks=chunks, dtype=sample.dtype,
+                                **get_zarr_compressor_kwargs(codec, clevel=clevel))
+            im_zarr[:] = sample
+            t_write = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            _ = zarr.open(zarr_path, mode='r')[:]
+            t_read = time.perf_counter() - t0
+
+            results.append({
+                'codec': codec,
+                'ratio': sample.nbytes / im_zarr.nbytes_stored,
+                'write_MBps': size_MB / t_write,
+                'read_MBps': size_MB / t_read,
+            })
+
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare zarr compression codecs on a sample of a spectral image.')
+    parser.add_argument('path', help='path to hdr or zarr file')
+    parser.add_argument('--codecs', nargs='+', default=None, choices=ZARR_CODECS,
+                        help='codecs to test, default is all')
+    parser.add_argument('--rows', type=int, default=1000, help='number of rows of the sample')
+    parser.add_argument('--chunk-size', type=int, default=500, help='chunk size along rows and cols')
+    parser.add_argument('--clevel', type=int, default=5, help='compression level of Blosc codecs')
+    args = parser.parse_args()
+
+    results = benchmark_codecs(
+        args.path, codecs=args.codecs, num_rows=args.rows,
+        chunk_size=args.chunk_size, clevel=args.clevel)
+
+    print(f"{'codec':<10}{'ratio':>8}{'write MB/s':>14}{'read MB/s':>14}")
+    for r in results:
+        print(f"{r['codec']:<10}{r['ratio']:>8.2f}{r['write_MBps']:>14.1f}{r['read_MBps']:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
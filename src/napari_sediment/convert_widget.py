@@ -1,11 +1,12 @@
 from pathlib import Path
 from qtpy.QtWidgets import (QWidget, QVBoxLayout, QGridLayout, QPushButton,
-                            QLineEdit, QFileDialog)
+                            QLineEdit, QFileDialog, QComboBox, QLabel)
 from qtpy.QtCore import Qt
 
 from napari_guitils.gui_structures import TabSet, VHGroup
 from .parameters.parameters import Param
 from .sediproc import convert_bil_raw_to_zarr
+from .io import ZARR_CODECS
 
 class ConvertWidget(QWidget):
     
@@ -39,9 +40,15 @@ class ConvertWidget(QWidget):
         self.files_group.glayout.addWidget(self.btn_select_export_folder, 1, 0, 1, 1)
         self.files_group.glayout.addWidget(self.export_path_display, 1, 1, 1, 1)
 
+        self.combo_codec = QComboBox()
+        self.combo_codec.addItems(ZARR_CODECS)
+        self.combo_codec.setToolTip("Compression codec. zstd and lz4 use Blosc with bit-shuffle.")
+        self.files_group.glayout.addWidget(QLabel("Compression"), 2, 0, 1, 1)
+        self.files_group.glayout.addWidget(self.combo_codec, 2, 1, 1, 1)
+
         self.btn_convert = QPushButton("Convert")
         self.btn_convert.setToolTip("Convert .hdr to .zarr")
-        self.files_group.glayout.addWidget(self.btn_convert, 2, 0, 1, 2)
+        self.files_group.glayout.addWidget(self.btn_convert, 3, 0, 1, 2)
 
         self.add_connections()
 
@@ -78,7 +85,7 @@ class ConvertWidget(QWidget):
     def _on_click_convert(self, event=None):
         """Convert .hdr to .zarr"""
         
-        convert_bil_raw_to_zarr(self.imhdr_path, self.export_folder)
+        convert_bil_raw_to_zarr(self.imhdr_path, self.export_folder, codec=self.combo_codec.currentText())
         self.save_params()
 
     def save_params(self):
@@ -87,5 +94,6 @@ class ConvertWidget(QWidget):
         self.params.file_path = self.imhdr_path
         self.params.main_roi = []
         self.params.rois = []
+        self.params.codec = self.combo_codec.currentText()
         self.params.save_parameters()
 
@@ -17,14 +17,15 @@ def compute_vertical_correlations(image_mnfr):
 
     return all_coef
 
-def compute_end_members(pure, im_cube, im_cube_denoised, ppi_threshold, dbscan_eps):
+def compute_end_members(pure, im_cube, im_cube_denoised, ppi_threshold, dbscan_eps,
+                        clustering='dbscan'):
 
     # recover pixel vectors from denoised image and actual image
     vects = im_cube_denoised[:, pure > ppi_threshold]
     vects_image = im_cube[:,pure > ppi_threshold] 
     
-    # compute clustering
-    labels = spectral_clustering(pixel_vectors=vects.T, dbscan_eps=dbscan_eps)
+    # compute clustering, 'binned' scales to large sets of pure pixels
+    labels = spectral_clustering(pixel_vectors=vects.T, dbscan_eps=dbscan_eps, method=clustering)
 
     end_members = []
     for ind in range(0, labels.max()+1):
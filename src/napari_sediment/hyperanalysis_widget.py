@@ -3,7 +3,8 @@ import warnings
 import numpy as np
 from qtpy.QtWidgets import (QVBoxLayout, QPushButton, QWidget,
                             QLabel, QFileDialog, QSlider,
-                            QCheckBox, QLineEdit, QSpinBox, QDoubleSpinBox,)
+                            QCheckBox, QLineEdit, QSpinBox, QDoubleSpinBox,
+                            QComboBox)
 from qtpy.QtCore import Qt
 from superqt import QDoubleSlider
 
@@ -22,7 +23,7 @@ from .spectralplot import SpectralPlotter
 from .widgets.channel_widget import ChannelWidget
 from .io import load_mask, get_mask_path
 from .widgets.rgb_widget import RGBWidget
-from .utils import wavelength_to_rgb
+from .utils import wavelength_to_rgb, get_layer_data
 from .hyperanalysis import (compute_vertical_correlations, compute_end_members,
                             reduce_with_mnf, export_dim_reduction_data)
 from napari_guitils.gui_structures import TabSet, VHGroup
@@ -207,6 +208,11 @@ class HyperAnalysisWidget(QWidget):
         self.qspin_endm_eps.setValue(0.5)
         self.process_group_endmember.glayout.addWidget(QLabel('DBSCAN eps'), 1, 0, 1, 1)
         self.process_group_endmember.glayout.addWidget(self.qspin_endm_eps, 1, 1, 1, 1)
+        self.combo_endm_clustering = QComboBox()
+        self.combo_endm_clustering.addItems(['dbscan', 'binned'])
+        self.combo_endm_clustering.setToolTip("binned: faster clustering of large sets of pure pixels")
+        self.process_group_endmember.glayout.addWidget(QLabel('Clustering'), 2, 0, 1, 1)
+        self.process_group_endmember.glayout.addWidget(self.combo_endm_clustering, 2, 1, 1, 1)
 
         self.ppi_plot = SpectralPlotter(napari_viewer=self.viewer)
         self.tabs.add_named_tab('End Members', self.ppi_plot)
@@ -402,19 +408,29 @@ class HyperAnalysisWidget(QWidget):
         layer_names = ['mnf', 'denoised', 'pure', 'pure_members']
         for lname in layer_names:
             if lname in self.viewer.layers:
+                image = self.viewer.layers[lname].data
+                zarr_path = export_path.joinpath(f'{lname}.zarr')
+                # layer still backed by the file to write, nothing to save
+                if isinstance(image, zarr.Array) and Path(getattr(image.store, 'path', '')) == zarr_path.resolve():
+                    continue
                 save_image_to_zarr(
-                    image=self.viewer.layers[lname].data,
-                    zarr_path=export_path.joinpath(f'{lname}.zarr')
+                    image=image,
+                    zarr_path=zarr_path,
+                    codec=self.params.codec
                 )
     
     def load_stacks(self):
         """Load denoised and reduced staks from zarr"""
 
         export_path = Path(self.export_folder).joinpath(f'roi_{self.spin_selected_roi.value()}') 
-        for name in ['mnf', 'denoised']:
-            if export_path.joinpath(f'{name}.zarr').is_dir():
-                im = np.array(zarr.open_array(export_path.joinpath(f'{name}.zarr')))
-                self.viewer.add_image(im, name=name)
+        if export_path.joinpath('mnf.zarr').is_dir():
+            im = np.array(zarr.open_array(export_path.joinpath('mnf.zarr')))
+            self.viewer.add_image(im, name='mnf')
+
+        # keep denoised on disk, PPI reads it by blocks
+        if export_path.joinpath('denoised.zarr').is_dir():
+            im = zarr.open_array(export_path.joinpath('denoised.zarr'), mode='r')
+            self.viewer.add_image(im, name='denoised')
         
         if export_path.joinpath('pure.zarr').is_dir():
             im = np.array(zarr.open_array(export_path.joinpath('pure.zarr')))
@@ -486,7 +502,7 @@ class HyperAnalysisWidget(QWidget):
         self.viewer.window._status_bar._toggle_activity_dock(True)
         with progress(total=0) as pbr:
             pbr.set_description("Computing MNF")
-            data = np.asarray(np.moveaxis(self.viewer.layers['imcube'].data,0,2), np.float32)
+            data = np.asarray(np.moveaxis(get_layer_data(self.viewer.layers['imcube']),0,2), np.float32)
             signal = calc_stats(
                 image=data,
                 mask=self.viewer.layers['mask'].data,
@@ -512,7 +528,7 @@ class HyperAnalysisWidget(QWidget):
     def _compute_mnfr_bands(self):
         """Extract actual MNFR bands and plot them"""
 
-        data = np.asarray(np.moveaxis(self.viewer.layers['imcube'].data,0,2), np.float32)
+        data = np.asarray(np.moveaxis(get_layer_data(self.viewer.layers['imcube']),0,2), np.float32)
         self.image_mnfr = self.mnfr.reduce(data, num=data.shape[2])#, num=last_index)
 
         if 'mnf' in self.viewer.layers:
@@ -571,23 +587,23 @@ class HyperAnalysisWidget(QWidget):
     def _on_click_ppi(self):
         """Find pure pixels using PPI algorithm."""
 
-        if self.selected_bands is None:
+        if 'denoised' not in self.viewer.layers:
             raise ValueError('Must reduce bands first')
 
         self.viewer.window._status_bar._toggle_activity_dock(True)
         with progress(total=0) as pbr:
             pbr.set_description("Pure pixel detection")
-            # create image where masked pixels are set to 0. This avoids detecting masked pixels as pure pixels.
-            im_masked = np.moveaxis(self.selected_bands.copy(),2,0)
-            im_masked[:, self.viewer.layers['mask'].data == 1] = 0
-            im_masked = np.moveaxis(im_masked,0,2)
-
+            # masked pixels are skipped, which avoids detecting them as pure pixels
+            # without copying the image
             #pure = ppi(im_masked, niters=self.ppi_iterations.value(), display=0)
             from .sediproc import custom_ppi
+            # denoised is (bands, rows, cols), in memory or loaded from denoised.zarr
             pure, self.total_ppi_series = custom_ppi(
-                im_masked,
+                self.viewer.layers['denoised'].data,
                 niters=self.ppi_iterations.value(),
                 threshold=self.ppi_proj_threshold.value(),
+                mask=self.viewer.layers['mask'].data == 1,
+                channel_axis=0,
             )
             if 'pure' in self.viewer.layers:
                 self.viewer.layers['pure'].data = pure
@@ -612,15 +628,16 @@ class HyperAnalysisWidget(QWidget):
             pbr.set_description("Compute end-members")
         
             pure = np.asarray(self.viewer.layers['pure'].data)
-            imcube_data = np.asarray(self.viewer.layers['imcube'].data)
-            im_cube_denoised = self.viewer.layers['denoised'].data
+            imcube_data = np.asarray(get_layer_data(self.viewer.layers['imcube']))
+            im_cube_denoised = np.asarray(self.viewer.layers['denoised'].data)
 
             self.end_members_raw, self.end_members_labels = compute_end_members(
                 pure=pure, 
                 im_cube=imcube_data,
                 im_cube_denoised=im_cube_denoised, 
                 ppi_threshold=self.ppi_threshold.value(),
-                dbscan_eps=self.qspin_endm_eps.value())
+                dbscan_eps=self.qspin_endm_eps.value(),
+                clustering=self.combo_endm_clustering.currentText())
             
             self.update_endmembers()
             self.pure_members = np.zeros_like(pure)
@@ -694,7 +711,7 @@ class HyperAnalysisWidget(QWidget):
             #self.cursor_pos[2] = np.clip(self.cursor_pos[2], self.col_bounds[0],self.col_bounds[1]-1)
             self.cursor_pos[1] = np.clip(self.cursor_pos[1], 0,nrows-1)
             self.cursor_pos[2] = np.clip(self.cursor_pos[2], 0,ncols-1)
-            self.spectral_pixel = self.viewer.layers['imcube'].data[
+            self.spectral_pixel = get_layer_data(self.viewer.layers['imcube'])[
                 #:, self.cursor_pos[1]-self.row_bounds[0], self.cursor_pos[2]-self.col_bounds[0]
                 :, self.cursor_pos[1], self.cursor_pos[2]
             ]
@@ -1,8 +1,25 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from ._reader import read_spectral
+from ._reader import read_spectral, read_spectral_metadata
 from .sediproc import find_index_of_band
 
+# fraction of the available memory used by default for loaded channels
+DEFAULT_CACHE_FRACTION = 0.25
+
+
+def get_default_cache_bytes(fraction=DEFAULT_CACHE_FRACTION):
+    """Default memory budget of the channel cache, a fraction of the memory
+    currently available. None (no limit) if psutil is not installed."""
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return int(fraction * psutil.virtual_memory().available)
+
 
 @dataclass
 class ImChannels:
@@ -27,6 +44,26 @@ class ImChannels:
         number of columns in the image
     centers: array of float
         band centers of the channels
+    backend: str
+        backend used by read_spectral to read hdr files, one of
+        'spectral', 'memmap' or 'dask'
+    max_cache_bytes: int
+        memory budget in bytes for loaded channels. When exceeded, the least
+        recently used channels are discarded. None means no limit. Default
+        is a fraction DEFAULT_CACHE_FRACTION of the available memory
+    cache_hits: int
+        number of channel requests served from memory
+    cache_misses: int
+        number of channel requests that needed reading from disk
+    cache_evictions: int
+        number of channels discarded to respect max_cache_bytes
+    prefetch_neighbours: int
+        after get_image_cube, number n of bands k±1..k±n around each
+        requested band k loaded in the background for the same roi.
+        0 disables prefetching. No bands are prefetched without a budget
+        max_cache_bytes
+    cache_prefetched: int
+        number of channels loaded by background prefetching
     
     """
     imhdr_path: str = None
@@ -37,27 +74,42 @@ class ImChannels:
     nrows: int = None
     ncols: int = None
     centers: np.ndarray = None
+    backend: str = 'memmap'
+    max_cache_bytes: int = field(default_factory=get_default_cache_bytes)
+    cache_hits: int = 0
+    cache_misses: int = 0
+    cache_evictions: int = 0
+    prefetch_neighbours: int = 0
+    cache_prefetched: int = 0
 
     def __post_init__(self):
     
-        data, metadata = read_spectral(
-                path=self.imhdr_path,
-                bands=[0],
-                row_bounds=None,
-                col_bounds=None,
-            )
+        # only the header or zarr attributes are read, channels are loaded on demand
+        shape, dtype, metadata = read_spectral_metadata(self.imhdr_path)
         self.channel_names = metadata['wavelength']
         self.rois = [None] * len(self.channel_names)
         self.channel_array = [None] * len(self.channel_names)
-        self.channel_array[0] = data[:,:,0]
+        # channels currently in memory, from least to most recently used
+        self._cache_order = OrderedDict()
+        self._itemsize = np.dtype(dtype).itemsize
+        # protects the cache state, shared with the prefetching thread
+        self._lock = threading.RLock()
+        # spectral reads through a shared file handle, reads are serialized
+        self._read_lock = threading.Lock() if self.backend == 'spectral' else None
+        self._prefetch_executor = None
+        self._prefetch_generation = 0
+        self._prefetch_future = None
         self.metadata = metadata
-        self.nrows = data.shape[0]
-        self.ncols = data.shape[1]
+        self.nrows = shape[0]
+        self.ncols = shape[1]
         self.centers = np.array(metadata['centers'])
 
     def read_channels(self, channels=None, roi=None):
         """
-        Get channels from the image.
+        Get channels from the image. Channels already in memory for a roi
+        containing the requested roi are not read again. If the roi in memory
+        only partially overlaps the requested roi, only the uncovered area
+        is read from disk.
         
         Parameters
         ----------
@@ -71,45 +123,298 @@ class ImChannels:
         if channels is None:
             raise ValueError('channels must be provided')
         
-        channels_full_image = []
-        channels_partial_image = []
+        with self._lock:
+            self._read_channels(channels, roi)
+
+    def _read_channels(self, channels, roi):
+        """Implementation of read_channels, called with the cache lock held."""
+
+        bounds = self._get_roi_bounds(roi)
+
+        channels_to_load = []
+        # channels partially covered, grouped by roi in memory
+        channels_to_complete = {}
         for channel in channels:
-            if roi is None:
-                if self.rois[channel] is None:
-                    if self.channel_array[channel] is None:
-                        channels_full_image.append(channel)
-                else:
-                    channels_full_image.append(channel)
+            if self.channel_array[channel] is None:
+                channels_to_load.append(channel)
+                continue
+            self._cache_order.move_to_end(channel)
+            cached_bounds = self._get_roi_bounds(self.rois[channel])
+            if _roi_contains(cached_bounds, bounds):
+                continue
+            if _roi_overlaps(cached_bounds, bounds):
+                channels_to_complete.setdefault(tuple(cached_bounds), []).append(channel)
             else:
-                # if a new roi is provided, reload the channel even if full frame is already loaded
-                if self.rois[channel] is None:
-                    #if self.channel_array[channel] is None:
-                    channels_partial_image.append(channel)
-                else:
-                    if not np.array_equal(roi, self.rois[channel]):
-                        channels_partial_image.append(channel)
-                
-        if len(channels_full_image) > 0:
-            data, _ = read_spectral(
-                path=self.imhdr_path,
-                bands=channels_full_image,
-                row_bounds=None,
-                col_bounds=None,
-            )
-            for ind, c in enumerate(channels_full_image):
-                self.channel_array[c] = data[:,:,ind]
-                self.rois[c] = None
+                channels_to_load.append(channel)
+
+        num_to_read = len(channels_to_load) + sum([len(x) for x in channels_to_complete.values()])
+        self.cache_misses += num_to_read
+        self.cache_hits += len(channels) - num_to_read
+
+        stored_roi = None if bounds == self._get_roi_bounds(None) else bounds
+
+        if len(channels_to_load) > 0:
+            data = self._read_roi(channels_to_load, bounds)
+            for ind, c in enumerate(channels_to_load):
+                self._store_channel(c, data[:,:,ind], stored_roi)
         
-        if len(channels_partial_image) > 0:
-            data, _ = read_spectral(
-                path=self.imhdr_path,
-                bands=channels_partial_image,
-                row_bounds=[roi[0], roi[1]],
-                col_bounds=[roi[2], roi[3]],
-            )
-            for ind, c in enumerate(channels_partial_image):
-                self.channel_array[c] = data[:,:,ind]
-                self.rois[c] = roi
+        for cached_bounds, channels_group in channels_to_complete.items():
+            data = np.zeros(
+                shape=(bounds[1]-bounds[0], bounds[3]-bounds[2], len(channels_group)),
+                dtype=self.channel_array[channels_group[0]].dtype)
+            
+            # copy the part already in memory
+            overlap = [
+                max(bounds[0], cached_bounds[0]), min(bounds[1], cached_bounds[1]),
+                max(bounds[2], cached_bounds[2]), min(bounds[3], cached_bounds[3])]
+            for ind, c in enumerate(channels_group):
+                data[overlap[0]-bounds[0]:overlap[1]-bounds[0], overlap[2]-bounds[2]:overlap[3]-bounds[2], ind] = \
+                    self._slice_channel(c, overlap)
+            
+            # read the uncovered rectangles above, below, left and right of the overlap
+            uncovered = [
+                [bounds[0], overlap[0], bounds[2], bounds[3]],
+                [overlap[1], bounds[1], bounds[2], bounds[3]],
+                [overlap[0], overlap[1], bounds[2], overlap[2]],
+                [overlap[0], overlap[1], overlap[3], bounds[3]],
+            ]
+            for rect in uncovered:
+                if (rect[1] <= rect[0]) or (rect[3] <= rect[2]):
+                    continue
+                data[rect[0]-bounds[0]:rect[1]-bounds[0], rect[2]-bounds[2]:rect[3]-bounds[2], :] = \
+                    self._read_roi(channels_group, rect)
+            
+            for ind, c in enumerate(channels_group):
+                self._store_channel(c, data[:,:,ind], stored_roi)
+
+        # keep requested channels even if they exceed the budget, they
+        # are discarded at the next request if necessary
+        self._enforce_cache_budget(keep=channels)
+
+    def prefetch_channels(self, channels, roi=None):
+        """
+        Load channels into memory in bulk without building an image cube,
+        e.g. all bands needed for a series of indices. Channels are read
+        with one call, in which runs of consecutive bands are read as slices.
+        If max_cache_bytes is set, only the channels fitting in the budget
+        are loaded.
+
+        Parameters
+        ----------
+        channels: list of int
+            indices of channels to load
+        roi: array
+            [row_start, row_end, col_start, col_end], None means full image
+
+        Returns
+        -------
+        loaded: list of int
+            indices of channels loaded or already in memory
+        
+        """
+
+        channels = list(np.unique(np.asarray(channels, dtype=int)))
+        if self.max_cache_bytes is not None:
+            bounds = self._get_roi_bounds(roi)
+            channel_bytes = (bounds[1]-bounds[0]) * (bounds[3]-bounds[2]) * self._itemsize
+            channels = channels[:max(1, self.max_cache_bytes // channel_bytes)]
+        
+        with self._lock:
+            self._read_channels(channels, roi)
+            self._enforce_cache_budget(keep=channels)
+
+        return channels
+
+    def schedule_prefetch(self, channels, roi=None):
+        """
+        Load the neighbouring bands of channels for roi in the background,
+        nearest bands first. A previously scheduled prefetch is cancelled.
+        Prefetched bands never evict the requested channels and stop when
+        the memory budget is reached. Does nothing if prefetch_neighbours is 0
+        or if max_cache_bytes is None, as prefetched bands would accumulate
+        without limit.
+
+        Parameters
+        ----------
+        channels: list of int
+            indices of channels just requested
+        roi: array
+            [row_start, row_end, col_start, col_end], None means full image
+
+        Returns
+        -------
+        future: concurrent.futures.Future or None
+            future of the prefetch task, None if nothing is prefetched
+        
+        """
+
+        self.cancel_prefetch()
+        if (self.prefetch_neighbours <= 0) or (self.max_cache_bytes is None):
+            return None
+
+        channels = [int(c) for c in np.asarray(channels).ravel()]
+        neighbours = []
+        for distance in range(1, self.prefetch_neighbours + 1):
+            for c in channels:
+                for n in [c + distance, c - distance]:
+                    if (0 <= n < len(self.channel_names)) and (n not in channels) and (n not in neighbours):
+                        neighbours.append(n)
+
+        bounds = self._get_roi_bounds(roi)
+        channel_bytes = (bounds[1]-bounds[0]) * (bounds[3]-bounds[2]) * self._itemsize
+        neighbours = neighbours[:max(0, self.max_cache_bytes // channel_bytes - len(channels))]
+        if len(neighbours) == 0:
+            return None
+
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch_future = self._prefetch_executor.submit(
+            self._prefetch_worker, neighbours, bounds, channels, self._prefetch_generation)
+        return self._prefetch_future
+
+    def cancel_prefetch(self):
+        """Cancel the background prefetch, e.g. when the roi changes. Bands
+        being read are discarded."""
+
+        self._prefetch_generation += 1
+        if self._prefetch_future is not None:
+            self._prefetch_future.cancel()
+            self._prefetch_future = None
+
+    def _prefetch_worker(self, neighbours, bounds, requested, generation):
+        """Load neighbours one by one as long as the prefetch is not cancelled."""
+
+        stored_roi = None if bounds == self._get_roi_bounds(None) else bounds
+        keep = list(requested)
+        for channel in neighbours:
+            if generation != self._prefetch_generation:
+                return
+            with self._lock:
+                if (self.channel_array[channel] is not None) and \
+                    _roi_contains(self._get_roi_bounds(self.rois[channel]), bounds):
+                    keep.append(channel)
+                    continue
+            data = self._read_roi([channel], bounds)
+            with self._lock:
+                if generation != self._prefetch_generation:
+                    return
+                self._store_channel(channel, data[:,:,0], stored_roi)
+                # prefetched bands are less important than requested ones
+                self._cache_order.move_to_end(channel, last=False)
+                self.cache_prefetched += 1
+                keep.append(channel)
+                self._enforce_cache_budget(keep=keep)
+
+    def _read_roi(self, channels, bounds):
+        """Read channels in roi [row_start, row_end, col_start, col_end] from disk.
+        Returns array with dims (rows, cols, bands)"""
+
+        if self._read_lock is not None:
+            with self._read_lock:
+                data, _ = read_spectral(
+                    path=self.imhdr_path,
+                    bands=channels,
+                    row_bounds=[bounds[0], bounds[1]],
+                    col_bounds=[bounds[2], bounds[3]],
+                    backend=self.backend,
+                    lazy=False,
+                )
+                return np.asarray(data)
+
+        data, _ = read_spectral(
+            path=self.imhdr_path,
+            bands=channels,
+            row_bounds=[bounds[0], bounds[1]],
+            col_bounds=[bounds[2], bounds[3]],
+            backend=self.backend,
+            lazy=False,
+        )
+        return np.asarray(data)
+
+    def _get_roi_bounds(self, roi):
+        """Replace None (full image) or None elements of roi by image bounds.
+        Returns roi as list of int."""
+
+        full = [0, self.nrows, 0, self.ncols]
+        if roi is None:
+            return full
+        bounds = [full[ind] if r is None else int(r) for ind, r in enumerate(roi)]
+        return bounds
+
+    def _slice_channel(self, channel, bounds):
+        """Get roi [row_start, row_end, col_start, col_end] of a channel in memory.
+        The roi has to be contained in the roi of the channel in memory."""
+
+        cached_bounds = self._get_roi_bounds(self.rois[channel])
+        data = self.channel_array[channel][
+            bounds[0]-cached_bounds[0]:bounds[1]-cached_bounds[0],
+            bounds[2]-cached_bounds[2]:bounds[3]-cached_bounds[2]]
+        return data
+
+    def _store_channel(self, channel, data, roi):
+        """Keep a copy of a channel in memory as most recently used channel."""
+
+        # copy to avoid keeping the complete multi-band array alive
+        self.channel_array[channel] = np.ascontiguousarray(data)
+        self.rois[channel] = roi
+        self._cache_order[channel] = None
+        self._cache_order.move_to_end(channel)
+
+    def _enforce_cache_budget(self, keep=None):
+        """Discard least recently used channels until the memory used by
+        loaded channels is below max_cache_bytes.
+        
+        Parameters
+        ----------
+        keep: list of int
+            indices of channels that should not be discarded
+        
+        """
+
+        if self.max_cache_bytes is None:
+            return
+        keep = set() if keep is None else set(np.asarray(keep).tolist())
+        for channel in list(self._cache_order.keys()):
+            if self.cache_nbytes <= self.max_cache_bytes:
+                break
+            if channel in keep:
+                continue
+            self.channel_array[channel] = None
+            self.rois[channel] = None
+            del self._cache_order[channel]
+            self.cache_evictions += 1
+
+    @property
+    def cache_nbytes(self):
+        """Memory in bytes used by loaded channels."""
+
+        with self._lock:
+            return sum([self.channel_array[c].nbytes for c in self._cache_order])
+
+    def get_cache_info(self):
+        """
+        Get statistics of the channel cache, e.g. to tune max_cache_bytes.
+
+        Returns
+        -------
+        cache_info: dict
+            with keys 'hits', 'misses', 'evictions', 'prefetched', 'num_channels' (channels
+            currently in memory), 'nbytes' and 'max_cache_bytes'
+        
+        """
+
+        with self._lock:
+            num_channels = len(self._cache_order)
+        cache_info = {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'prefetched': self.cache_prefetched,
+            'num_channels': num_channels,
+            'nbytes': self.cache_nbytes,
+            'max_cache_bytes': self.max_cache_bytes,
+        }
+        return cache_info
 
     def get_image_cube(self, channels=None, roi=None):
         """
@@ -132,32 +437,21 @@ class ImChannels:
         if channels is None:
             raise ValueError('channels must be provided')
         
-        # make sure data is loaded
-        self.read_channels(channels, roi)
+        # a pending prefetch for another roi or bands is outdated
+        self.cancel_prefetch()
 
-        # get data
-        if roi is None:
-            data = np.stack([self.channel_array[c] for c in channels], axis=0)
-        else:
-            full = [0, self.nrows, 0, self.ncols]
-            data = []
-            for ind, r in enumerate(roi):
-                if r is None:
-                    roi[ind] = full[ind]
-            '''data = np.zeros(
-                shape=(len(channels), roi[1]-roi[0], roi[3]-roi[2]),
-                dtype=self.channel_array[channels[0]].dtype)
-            for ind, c in enumerate(channels):
-                if self.rois[c] is None:
-                    data[ind,:,:] = self.channel_array[c][roi[0]:roi[1], roi[2]:roi[3]]
-                else:
-                    data[ind,:,:] = self.channel_array[c]'''
-            for ind, c in enumerate(channels):
-                if self.rois[c] is None:
-                    data.append(self.channel_array[c][roi[0]:roi[1], roi[2]:roi[3]])
-                else:
-                    data.append(self.channel_array[c])
-            data = np.stack(data, axis=0)
+        with self._lock:
+            # make sure data is loaded
+            self._read_channels(channels, roi)
+
+            # get data
+            bounds = self._get_roi_bounds(roi)
+            data = np.stack([self._slice_channel(c, bounds) for c in channels], axis=0)
+
+            # channels kept for this request can now be discarded if over budget
+            self._enforce_cache_budget()
+
+        self.schedule_prefetch(channels, roi)
 
         return data
     
@@ -187,3 +481,14 @@ class ImChannels:
         bands_names = [self.channel_names[x] for x in bands_indices]
 
         return bands_indices, bands_names
+
+
+def _roi_contains(outer, inner):
+    """Check if roi outer contains roi inner. Rois are [row_start, row_end, col_start, col_end]"""
+
+    return (outer[0] <= inner[0]) and (outer[1] >= inner[1]) and (outer[2] <= inner[2]) and (outer[3] >= inner[3])
+
+def _roi_overlaps(roi1, roi2):
+    """Check if two rois [row_start, row_end, col_start, col_end] overlap"""
+
+    return (max(roi1[0], roi2[0]) < min(roi1[1], roi2[1])) and (max(roi1[2], roi2[2]) < min(roi1[3], roi2[3]))
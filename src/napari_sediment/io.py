@@ -21,7 +21,36 @@ def load_mask(filename):
     mask = tifffile.imread(filename)
     return mask
 
-def save_image_to_zarr(image, zarr_path):
+ZARR_CODECS = ['default', 'zstd', 'lz4', 'none']
+
+def get_zarr_compressor_kwargs(codec='default', clevel=5):
+    """Get keyword arguments selecting the compressor when creating a zarr.
+    
+    Parameters
+    ----------
+    codec : str, optional
+        One of ZARR_CODECS: 'default' (default compressor of zarr), 'zstd' or
+        'lz4' (Blosc with bit-shuffle) or 'none' (no compression). Default is 'default'.
+    clevel : int, optional
+        Compression level for Blosc codecs. Default is 5.
+    
+    Returns
+    -------
+    compressor_kwargs : dict
+        Keyword arguments for zarr.open.
+    """
+
+    if codec == 'default':
+        return {}
+    elif codec == 'none':
+        return {'compressor': None}
+    elif codec in ['zstd', 'lz4']:
+        from numcodecs import Blosc
+        return {'compressor': Blosc(cname=codec, clevel=clevel, shuffle=Blosc.BITSHUFFLE)}
+    else:
+        raise ValueError(f'Unknown codec {codec}, should be one of {ZARR_CODECS}')
+
+def save_image_to_zarr(image, zarr_path, codec='default'):
     """Create a zarr file and stores image in it.
     
     Parameters
@@ -30,6 +59,8 @@ def save_image_to_zarr(image, zarr_path):
         Image to save. Dims are (bands, rows, cols) or (rows, cols).
     zarr_path : str
         Path to save zarr to.
+    codec : str, optional
+        Compression codec, see get_zarr_compressor_kwargs. Default is 'default'.
     """
 
     if image.ndim == 2:
@@ -38,9 +69,107 @@ def save_image_to_zarr(image, zarr_path):
         chunks = (1, image.shape[1], image.shape[2])
 
     im_zarr = zarr.open(zarr_path, mode='w', shape=image.shape,
-               chunks=chunks, dtype=image.dtype)
+               chunks=chunks, dtype=image.dtype, **get_zarr_compressor_kwargs(codec))
     im_zarr[:] = image
 
+def create_multiscale_zarr(zarr_path, shape, chunks, dtype, num_levels=1, codec='default',
+                          synchronizer=None):
+    """Create a zarr group for a multiscale pyramid following the OME-NGFF
+    layout. Level '0' is the full resolution image and each following level is
+    downsampled by 2 along rows and cols.
+    
+    Parameters
+    ----------
+    zarr_path : str
+        Path to save zarr to.
+    shape : tuple of int
+        Shape of the full resolution image. Dims are (bands, rows, cols).
+    chunks : tuple of int
+        Chunks of the full resolution image.
+    dtype : str
+        Data type of the image.
+    num_levels : int, optional
+        Number of levels including full resolution. Default is 1.
+    codec : str, optional
+        Compression codec, see get_zarr_compressor_kwargs. Default is 'default'.
+    synchronizer : zarr synchronizer, optional
+        Synchronizer of the level arrays, needed when several threads write
+        to the same chunks. Default is None.
+
+    Returns
+    -------
+    pyramid : list of zarr arrays
+        Resolution levels, from full resolution to lowest resolution.
+    """
+
+    zarr_path = Path(zarr_path)
+    root = zarr.open_group(zarr_path, mode='w')
+
+    pyramid = []
+    datasets = []
+    for level in range(num_levels):
+        level_shape = (shape[0],) + tuple(int(np.ceil(s / 2**level)) for s in shape[1:])
+        level_chunks = tuple(min(c, s) for c, s in zip(chunks, level_shape))
+        pyramid.append(zarr.open(zarr_path.joinpath(str(level)), mode='w',
+                                 shape=level_shape, chunks=level_chunks, dtype=dtype,
+                                 synchronizer=synchronizer, **get_zarr_compressor_kwargs(codec)))
+        datasets.append({
+            'path': str(level),
+            'coordinateTransformations': [{'type': 'scale', 'scale': [1, 2**level, 2**level]}]
+            })
+
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'axes': [
+            {'name': 'c', 'type': 'channel'},
+            {'name': 'y', 'type': 'space'},
+            {'name': 'x', 'type': 'space'}
+            ],
+        'datasets': datasets
+        }]
+
+    return pyramid
+
+
+def save_spectra_copy_to_zarr(zarr_path, tile_size=64, num_rows_block=None):
+    """Add to a multiscale zarr a copy of the full resolution image chunked
+    along pixels, i.e. with chunks (all bands, tile, tile). Reading the spectra
+    of single pixels or small regions then requires loading a single chunk
+    instead of one chunk per band. The copy is saved as array 'spectra' in the
+    zarr group and is automatically used by read_spectral when cheaper. The
+    copy uses the same compressor as the full resolution image.
+    
+    Parameters
+    ----------
+    zarr_path : str
+        Path to multiscale zarr, see create_multiscale_zarr.
+    tile_size : int, optional
+        Size of chunks along rows and cols. Default is 64.
+    num_rows_block : int, optional
+        Number of rows copied at once, should be a multiple of tile_size. If
+        None, the row chunk size of the full resolution image rounded up to a
+        multiple of tile_size is used.
+    
+    Returns
+    -------
+    spectra : zarr array
+        Copy of the image chunked along pixels.
+    """
+
+    root = zarr.open_group(zarr_path, mode='r+')
+    image = root['0']
+
+    spectra = zarr.open(Path(zarr_path).joinpath('spectra'), mode='w', shape=image.shape,
+                        chunks=(image.shape[0], tile_size, tile_size), dtype=image.dtype,
+                        compressor=image.compressor)
+    
+    if num_rows_block is None:
+        num_rows_block = tile_size * int(np.ceil(image.chunks[1] / tile_size))
+    for row_start in range(0, image.shape[1], num_rows_block):
+        row_end = min(row_start + num_rows_block, image.shape[1])
+        spectra[:, row_start:row_end, :] = image[:, row_start:row_end, :]
+
+    return spectra
 
 def load_params_yml(params, file_name='Parameters.yml'):
     
@@ -32,6 +32,9 @@ class Param:
         location of the sample
     rgb: list
         list of rgb bands
+    codec: str
+        compression codec of zarr files of the project, see
+        io.get_zarr_compressor_kwargs
     
     """
     project_path: str = None
@@ -46,6 +49,7 @@ class Param:
     scale_units: str = 'mm'
     location: str = ''
     rgb: list = field(default_factory=list)
+    codec: str = 'default'
 
     def __post_init__(self):
         self.rgb = [640, 545, 460]
@@ -29,19 +29,19 @@ from spectral.algorithms import remove_continuum
 from scipy.signal import savgol_filter
 
 from napari_guitils.gui_structures import VHGroup, TabSet
-from ._reader import read_spectral
+from ._reader import read_spectral, read_spectral_lazy
 from .sediproc import (white_dark_correct, load_white_dark,
                        phasor, remove_top_bottom, remove_left_right,
                        fit_1dgaussian_without_outliers, correct_save_to_zarr,
                        savgol_destripe)
 from .imchannels import ImChannels
-from .io import save_mask, load_mask, load_project_params
+from .io import save_mask, load_mask, load_project_params, ZARR_CODECS
 from .parameters.parameters import Param
 from .spectralplot import SpectralPlotter
 from .widgets.channel_widget import ChannelWidget
 from .images import save_rgb_tiff_image
 from .widgets.rgb_widget import RGBWidget
-from .utils import update_contrast_on_layer
+from .utils import update_contrast_on_layer, get_layer_data, add_or_update_image_layer
 from .batch_preproc_widget import BatchPreprocWidget
 
 import napari
@@ -156,6 +156,15 @@ class SedimentWidget(QWidget):
         self.main_group.glayout.addWidget(self.check_sync_bands_rgb, 3, 0, 1, 2)
         self.qlist_channels.setEnabled(False)
 
+        ### Spinbox "Prefetch neighbouring bands" ###
+        self.main_group.glayout.addWidget(QLabel('Prefetch neighbouring bands'), 4, 0, 1, 1)
+        self.spin_prefetch_bands = QSpinBox()
+        self.spin_prefetch_bands.setRange(0, 20)
+        self.spin_prefetch_bands.setValue(0)
+        self.spin_prefetch_bands.setToolTip(
+            "Number of bands on each side of the displayed bands loaded in the background. 0 disables prefetching.")
+        self.main_group.glayout.addWidget(self.spin_prefetch_bands, 4, 1, 1, 1)
+
         # RGB widget
         self.rgb_widget = RGBWidget(viewer=self.viewer)
         self.tabs.add_named_tab('&Main', self.rgb_widget.rgbmain_group.gbox)
@@ -267,6 +276,19 @@ class SedimentWidget(QWidget):
         self.batch_group.glayout.addWidget(QLabel("Chunk size"), 3, 0, 1, 1)
         self.batch_group.glayout.addWidget(self.spin_chunk_size, 3, 1, 1, 1)
 
+        ### Checkbox "Save spectra copy" ###
+        self.check_save_spectra_copy = QCheckBox("Save spectra copy")
+        self.check_save_spectra_copy.setChecked(False)
+        self.check_save_spectra_copy.setToolTip("Save an additional copy chunked along pixels to speed up reading spectra of single pixels.")
+        self.batch_group.glayout.addWidget(self.check_save_spectra_copy, 3, 2, 1, 2)
+
+        ### Combobox "Compression" ###
+        self.combo_codec = QComboBox()
+        self.combo_codec.addItems(ZARR_CODECS)
+        self.combo_codec.setToolTip("Compression codec of saved zarr files. zstd and lz4 use Blosc with bit-shuffle.")
+        self.batch_group.glayout.addWidget(QLabel("Compression"), 1, 2, 1, 1)
+        self.batch_group.glayout.addWidget(self.combo_codec, 1, 3, 1, 1)
+
         ### Checkbox "Convert to integer" ###
         self.check_save_as_float = QCheckBox("Save as floats")
         self.check_save_as_float.setChecked(True)
@@ -286,10 +308,10 @@ class SedimentWidget(QWidget):
         self.multiexp_group.glayout.addWidget(self.btn_show_multiexp_batch, 0, 0, 1, 1)
         self.multiexp_batch = None
 
-        # Checkbox "Use dask"
-        self.check_use_dask = QCheckBox("Use dask")
+        # Checkbox "Parallel processing"
+        self.check_use_dask = QCheckBox("Parallel processing")
         self.check_use_dask.setChecked(True)
-        self.check_use_dask.setToolTip("Use dask to parallelize computation")
+        self.check_use_dask.setToolTip("Process blocks of bands in parallel threads")
         self.tabs.add_named_tab('Pro&cessing', self.check_use_dask)
   
     def _create_roi_tab(self):
@@ -611,6 +633,7 @@ class SedimentWidget(QWidget):
         self.rgb_widget.btn_RGB.clicked.connect(self._update_threshold_limits)
         self.btn_select_all.clicked.connect(self._on_click_select_all)
         self.check_sync_bands_rgb.stateChanged.connect(self._on_click_sync_RGB)
+        self.spin_prefetch_bands.valueChanged.connect(self._on_change_prefetch_bands)
         self.rgb_widget.btn_dislpay_as_rgb.clicked.connect(self._update_threshold_limits)
 
         # Elements of the "Processing" tab
@@ -679,8 +702,10 @@ class SedimentWidget(QWidget):
         if imhdr_path == '':
             return
         imhdr_path = Path(imhdr_path)
-        if imhdr_path.parent.suffix == '.zarr':
-            imhdr_path = imhdr_path.parent
+        # files of multiscale zarr are in sub-folders of the .zarr folder
+        zarr_parents = [p for p in imhdr_path.parents if p.suffix == '.zarr']
+        if len(zarr_parents) > 0:
+            imhdr_path = zarr_parents[0]
         self.set_paths(imhdr_path)
         self._on_select_file()
         self._on_click_add_main_roi()
@@ -720,6 +745,7 @@ class SedimentWidget(QWidget):
 
         # set defaults
         self.rgb_widget.set_rgb(self.params.rgb)
+        self.combo_codec.setCurrentText(self.params.codec)
 
         # load data
         self._on_select_file()
@@ -785,6 +811,14 @@ class SedimentWidget(QWidget):
         self.qlist_channels.selectAll()
         self.qlist_channels._on_change_channel_selection(self.row_bounds, self.col_bounds)
 
+    def _on_change_prefetch_bands(self, event=None):
+        """Set number of neighbouring bands prefetched in the background."""
+
+        if self.imagechannels is not None:
+            self.imagechannels.prefetch_neighbours = self.spin_prefetch_bands.value()
+            if self.imagechannels.prefetch_neighbours == 0:
+                self.imagechannels.cancel_prefetch()
+
     def _on_click_sync_RGB(self, event=None):
         """
         Select same channels for imcube as loaded for RGB
@@ -875,7 +909,7 @@ class SedimentWidget(QWidget):
 
             if (selected_layer == 'imcube') | (self.check_sync_bands_rgb.isChecked()):
                 im_corr = white_dark_correct(
-                    self.viewer.layers['imcube'].data, white_data, dark_data, dark_for_white_data)
+                    get_layer_data(self.viewer.layers['imcube']), white_data, dark_data, dark_for_white_data)
                 
                 if 'imcube_corrected' in self.viewer.layers:
                     self.viewer.layers['imcube_corrected'].data = im_corr
@@ -890,11 +924,11 @@ class SedimentWidget(QWidget):
                 rgb_sorted = [str(x) for x in rgb_sorted]
 
                 im_corr = white_dark_correct(
-                    np.stack([self.viewer.layers[x].data for x in rgb_sorted], axis=0), 
+                    np.stack([get_layer_data(self.viewer.layers[x]) for x in rgb_sorted], axis=0), 
                     white_data, dark_data, dark_for_white_data)
                 
                 for ind, c in enumerate(rgb_sorted):
-                    self.viewer.layers[c].data = im_corr[ind]
+                    add_or_update_image_layer(self.viewer, im_corr[ind], c)
                     update_contrast_on_layer(self.viewer.layers[c])
                     self.viewer.layers[c].refresh()
 
@@ -911,20 +945,21 @@ class SedimentWidget(QWidget):
 
         selected_layer = self.combo_layer_destripe.currentText()
         if (selected_layer == 'None') or (selected_layer == 'imcube'):
-            data_destripe = self.viewer.layers['imcube'].data.copy()
+            data_destripe = get_layer_data(self.viewer.layers['imcube']).copy()
         elif selected_layer == 'imcube_corrected':
             data_destripe = self.viewer.layers['imcube_corrected'].data.copy()
         elif selected_layer == 'RGB':
-            data_destripe = np.stack([self.viewer.layers[x].data for x in ['red', 'green', 'blue']], axis=0)
+            data_destripe = np.stack([get_layer_data(self.viewer.layers[x]) for x in ['red', 'green', 'blue']], axis=0)
         
-        for d in range(data_destripe.shape[0]):
-            #data_destripe[d] = pystripe.filter_streaks(data_destripe[d].T, sigma=[128, 256], level=7, wavelet='db2').T
-            width = self.qspin_destripe_width.value()
-            data_destripe[d] = savgol_destripe(data_destripe[d], width=width, order=2)
+        #data_destripe[d] = pystripe.filter_streaks(data_destripe[d].T, sigma=[128, 256], level=7, wavelet='db2').T
+        width = self.qspin_destripe_width.value()
+        # all bands at once, data_destripe is a copy and can be overwritten
+        data_destripe = np.moveaxis(savgol_destripe(
+            np.moveaxis(data_destripe, 0, 2), width=width, order=2, inplace=True), 2, 0)
 
         if (selected_layer == 'RGB') | (self.check_sync_bands_rgb.isChecked()):
             for ind, x in enumerate(['red', 'green', 'blue']):
-                self.viewer.layers[x].data = data_destripe[ind]
+                add_or_update_image_layer(self.viewer, data_destripe[ind], x)
         
         if (selected_layer == 'None') or (selected_layer == 'imcube') | (selected_layer == 'imcube_corrected') | (self.check_sync_bands_rgb.isChecked()):
             if 'imcube_destripe' in self.viewer.layers:
@@ -985,6 +1020,8 @@ class SedimentWidget(QWidget):
                 use_dask=self.check_use_dask.isChecked(),
                 chunk_size=self.spin_chunk_size.value(),
                 use_float=self.check_save_as_float.isChecked(),
+                spectra_tile_size=64 if self.check_save_spectra_copy.isChecked() else None,
+                codec=self.combo_codec.currentText(),
                 )
             self.save_params()
             
@@ -1008,6 +1045,7 @@ class SedimentWidget(QWidget):
                 min_band=self.slider_batch_wavelengths.value()[0],
                 max_band=self.slider_batch_wavelengths.value()[1],
                 chunk_size=self.spin_chunk_size.value(),
+                codec=self.combo_codec.currentText(),
             )
             self.multiexp_batch.setStyleSheet(get_current_stylesheet())
 
@@ -1091,7 +1129,7 @@ class SedimentWidget(QWidget):
         """
         selected_layer = self.combo_layer_mask.currentText()
         if selected_layer in self.viewer.layers:
-            im = np.mean(self.viewer.layers[selected_layer].data, axis=0)
+            im = np.mean(get_layer_data(self.viewer.layers[selected_layer]), axis=0)
             if 'border-mask' in self.viewer.layers:
                 im = im[self.viewer.layers['border-mask'].data == 0]
             self.slider_mask_threshold.setRange(im.min(), im.max())
@@ -1259,7 +1297,7 @@ class SedimentWidget(QWidget):
         Called: "IO" tab, button "Save RGB tiff"
         """
         rgb = ['red', 'green', 'blue']
-        image_list = [self.viewer.layers[c].data for c in rgb]
+        image_list = [get_layer_data(self.viewer.layers[c]) for c in rgb]
         contrast_list = [self.viewer.layers[c].contrast_limits for c in rgb]
         save_rgb_tiff_image(image_list, contrast_list, self.export_folder.joinpath(self.lineedit_rgb_tiff.text()))
 
@@ -1449,6 +1487,7 @@ class SedimentWidget(QWidget):
         self.params.scale = self.spinbox_metadata_scale.value()
         self.params.scale_units = self.metadata_scale_unit.text()
         self.params.rgb = self.rgb_widget.rgb
+        self.params.codec = self.combo_codec.currentText()
 
         self.params.main_roi = mainroi
         self.params.rois = rois
@@ -1464,7 +1503,7 @@ class SedimentWidget(QWidget):
         "_on_click_intensity_threshold" ("Mask" tab)
         """
         selected_layer = self.combo_layer_mask.currentText()
-        im = np.mean(self.viewer.layers[selected_layer].data, axis=0)
+        im = np.mean(get_layer_data(self.viewer.layers[selected_layer]), axis=0)
         return im
 
     def _add_roi_layer(self):
@@ -1565,6 +1604,7 @@ class SedimentWidget(QWidget):
             else:
                 self.imagechannels = ImChannels(self.imhdr_path)
 
+            self.imagechannels.prefetch_neighbours = self.spin_prefetch_bands.value()
             self.row_bounds = [0, self.imagechannels.nrows]
             self.col_bounds = [0, self.imagechannels.ncols]
             
@@ -1665,7 +1705,7 @@ class SedimentWidget(QWidget):
             #self.cursor_pos[2] = np.clip(self.cursor_pos[2], 0, self.col_bounds[1]-self.col_bounds[0]-1)
             self.cursor_pos[1] = np.clip(self.cursor_pos[1], self.row_bounds[0],self.row_bounds[1]-1)
             self.cursor_pos[2] = np.clip(self.cursor_pos[2], self.col_bounds[0],self.col_bounds[1]-1)
-            self.spectral_pixel = self.viewer.layers['imcube'].data[
+            self.spectral_pixel = get_layer_data(self.viewer.layers['imcube'])[
                 :, self.cursor_pos[1]-self.row_bounds[0], self.cursor_pos[2]-self.col_bounds[0]
             ]
             self.update_spectral_plot()
@@ -1716,13 +1756,19 @@ class SedimentWidget(QWidget):
         Compute phasor from image. Opens a new viewer with 2D histogram of 
         g, s values.
         """
-        data, _ = read_spectral(
-            self.imhdr_path,
-            bands=np.arange(0, len(self.imagechannels.channel_names),10),
-            row_bounds=self.row_bounds,
-            col_bounds=self.col_bounds
-        )
-        self.g, self.s, _, _ = phasor(np.moveaxis(data,2,0), harmonic=2)
+        # all bands are read lazily and streamed by tiles of rows
+        if self.imhdr_path.suffix == '.zarr':
+            data, _ = read_spectral_lazy(self.imhdr_path)
+            data = data[:, self.row_bounds[0]:self.row_bounds[1], self.col_bounds[0]:self.col_bounds[1]]
+        else:
+            data, _ = read_spectral(
+                self.imhdr_path,
+                row_bounds=self.row_bounds,
+                col_bounds=self.col_bounds,
+                backend='dask'
+            )
+            data = np.moveaxis(data,2,0)
+        self.g, self.s, _, _ = phasor(data, harmonic=2)
         out,_,_ = np.histogram2d(np.ravel(self.g), np.ravel(self.s), bins=[50,50])
         #phasor_points = np.stack([np.ravel(g), np.ravel(s)]).T
         if self.viewer2 is None:
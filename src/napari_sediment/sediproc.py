@@ -1,8 +1,13 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 import numpy as np
 from spectral import open_image
 from spectral.algorithms import calc_stats
-from ._reader import read_spectral
+from ._reader import read_spectral, read_spectral_metadata, get_contiguous_runs
+from .io import create_multiscale_zarr, save_spectra_copy_to_zarr, get_zarr_compressor_kwargs
+from .utils import get_pyramid_num_levels
 from sklearn.covariance import EllipticEnvelope
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import DBSCAN
@@ -11,12 +16,15 @@ import zarr
 from dask.distributed import Client
 from tqdm import tqdm
 from scipy.signal import savgol_filter
+from scipy.stats import chi2
 from napari.utils import progress
 #import pystripe
 
 
-def compute_average_in_roi(file_path, channel_indices, roi, white_path=None):
-    """Compute average reflectance in a region of interest (ROI).
+def compute_average_in_roi(file_path, channel_indices, roi, white_path=None,
+                           backend='memmap', max_block_bytes=2**28):
+    """Compute average reflectance in a region of interest (ROI). Runs of
+    consecutive channels are read together in blocks.
 
     Parameters
     ----------
@@ -31,6 +39,10 @@ def compute_average_in_roi(file_path, channel_indices, roi, white_path=None):
         List of bands to include in average. If None, all bands are included.
     white_path : str, optional
         Path to white reference image. If None, no white reference is applied.
+    backend : str, optional
+        Backend used by read_spectral to read hdr files. Default is 'memmap'.
+    max_block_bytes : int, optional
+        Maximum size in bytes of a block of channels read at once. Default is 256MB.
 
     Returns
     -------
@@ -39,24 +51,37 @@ def compute_average_in_roi(file_path, channel_indices, roi, white_path=None):
     """
     
     if white_path is not None:
-        img_white = open_image(white_path)
-        white_data = img_white.read_subregion(row_bounds=[0, img_white.nrows], col_bounds=roi[1], bands=channel_indices)
+        white_data, _ = read_spectral(
+            white_path, bands=channel_indices, col_bounds=roi[1], backend=backend)
         white_av = white_data.mean(axis=0)
         white_max = white_av.max()          
 
+    channel_indices = np.asarray(channel_indices, dtype=int)
     data_av = np.zeros((len(channel_indices), roi[0][1]-roi[0][0]))
-    for ind, ch in enumerate(channel_indices):
-
-        data, _ = read_spectral(
-            file_path,
-            bands=[ch],
-            row_bounds=(roi[0][0], roi[0][1]),
-            col_bounds=(roi[1][0], roi[1][1]),
-            )
-        
-        if white_path is not None:
-            data = white_max * (data / white_av[:,ind])
-        data_av[ind] = data.mean(axis=1)[:,0].copy()
+
+    # split runs of consecutive channels into blocks of limited size (assuming 8 bytes per pixel)
+    roi_bytes = 8 * (roi[0][1]-roi[0][0]) * (roi[1][1]-roi[1][0])
+    max_block = max(1, max_block_bytes // max(1, roi_bytes))
+    order = np.argsort(channel_indices, kind='stable')
+    pos = 0
+    for start, stop in get_contiguous_runs(channel_indices[order]):
+        for block_start in range(start, stop, max_block):
+            block_end = min(block_start + max_block, stop)
+            inds = order[pos:pos+block_end-block_start]
+            pos += block_end - block_start
+
+            data, _ = read_spectral(
+                file_path,
+                bands=channel_indices[inds],
+                row_bounds=(roi[0][0], roi[0][1]),
+                col_bounds=(roi[1][0], roi[1][1]),
+                backend=backend,
+                lazy=False,
+                )
+            
+            if white_path is not None:
+                data = white_max * (data / white_av[:,inds])
+            data_av[inds] = np.asarray(data).mean(axis=1).T
 
     return data_av
 
@@ -79,14 +104,131 @@ def get_rgb_channels(wavelengths, rgb=[640, 545, 460]):
     rgb_ch = [np.argmin(np.abs(np.array(wavelengths).astype(float) - x)) for x in rgb]
     return rgb_ch
 
+def get_file_hash(file_path, block_size=2**24):
+    """Compute the blake2b hash of a file's content, read in blocks."""
+
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def compute_reference_profile(file_path, clean_white=False, backend='memmap'):
+    """Average a reference image over rows, optionally after removing noisy
+    rows with clean_white_ref.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to hdr file of the reference image.
+    clean_white : bool, optional
+        If True, remove rows outside of the expected noise range before
+        averaging. Default is False.
+    backend : str, optional
+        Backend used by read_spectral to read hdr files. Default is 'memmap'.
+
+    Returns
+    -------
+    profile : array
+        Average of the reference over rows. Dims are (cols, bands).
+    rows_kept : array of bool
+        Rows used to compute the average.
+    """
+
+    image, _ = read_spectral(path=file_path, backend=backend)
+    image = np.asarray(image)
+    rows_kept = np.ones(image.shape[0], dtype=bool)
+    if clean_white:
+        rows_kept = get_clean_white_rows(image)
+    profile = image[rows_kept].mean(axis=0)
+
+    return profile, rows_kept
+
+def load_reference_profile(file_path, clean_white=False, cache_folder=None, backend='memmap'):
+    """Load the average profile of a reference image, see compute_reference_profile.
+    If cache_folder is given, e.g. the export folder of a project, the profile
+    is stored there in a .npz file and reused as long as the reference data file
+    has the same size and modification time, or the same content hash if only
+    the modification time changed (e.g. copied folders). If the folder is not
+    writable the profile is not stored.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to hdr file of the reference image.
+    clean_white : bool, optional
+        If True, remove noisy rows before averaging. Default is False.
+    cache_folder : str, optional
+        Folder where profiles are cached. Default is None, always computing
+        the profile.
+    backend : str, optional
+        Backend used by read_spectral to read hdr files. Default is 'memmap'.
+
+    Returns
+    -------
+    profile : array
+        Average of the reference over rows. Dims are (cols, bands).
+    rows_kept : array of bool
+        Rows used to compute the average.
+    """
+
+    if cache_folder is None:
+        return compute_reference_profile(file_path, clean_white=clean_white, backend=backend)
+
+    data_path = Path(open_image(file_path).filename)
+    suffix = '_profile_clean.npz' if clean_white else '_profile.npz'
+    # references of different folders often have the same name
+    path_hash = hashlib.sha1(str(data_path.resolve()).encode()).hexdigest()[:8]
+    cache_path = Path(cache_folder).joinpath(f'{data_path.stem}_{path_hash}{suffix}')
+    stat = os.stat(data_path)
+
+    if cache_path.exists():
+        # closed before the cache file may be replaced below
+        with np.load(cache_path) as cache_file:
+            cache = dict(cache_file)
+        if int(cache['size']) == stat.st_size:
+            if int(cache['mtime_ns']) == stat.st_mtime_ns:
+                return cache['profile'], cache['rows_kept']
+            if str(cache['hash']) == get_file_hash(data_path):
+                cache['mtime_ns'] = stat.st_mtime_ns
+                _save_reference_cache(cache_path, cache)
+                return cache['profile'], cache['rows_kept']
+
+    profile, rows_kept = compute_reference_profile(file_path, clean_white=clean_white, backend=backend)
+    _save_reference_cache(cache_path, {
+        'profile': profile, 'rows_kept': rows_kept, 'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns, 'hash': get_file_hash(data_path)})
+
+    return profile, rows_kept
+
+def _save_reference_cache(cache_path, cache):
+    """Save reference profile cache, writing to a temporary file first so
+    that parallel workers never read a partial file."""
+
+    tmp_path = cache_path.with_name(f'{cache_path.stem}_{os.getpid()}.tmp.npz')
+    try:
+        np.savez(tmp_path, **cache)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # e.g. read-only data folder, the profile is just not cached
+        if tmp_path.exists():
+            tmp_path.unlink()
+
 def load_white_dark(white_file_path, dark_for_im_file_path,
                     dark_for_white_file_path=None, channel_indices=None,
-                    col_bounds=None, clean_white=False):
+                    col_bounds=None, clean_white=False, backend='memmap',
+                    use_cache=False, cache_folder=None):
     """Load white and dark reference images. In case a separate white reference is used
     (not the one acquired at the same time as the image), the corresponding dark reference
     should be used to correct it. Optionally corrects the white reference by removing rows
     outside of the expected noise range.
 
+    As white_dark_correct only uses averages over rows, with use_cache the
+    references are loaded as their average profiles with a single row,
+    optionally cached in cache_folder (see load_reference_profile). A white
+    reference cleaned with clean_white is always loaded completely, as noisy
+    rows are found within the selected channels and columns.
+
     Parameters
     ----------
     white_file_path : str
@@ -102,6 +244,14 @@ def load_white_dark(white_file_path, dark_for_im_file_path,
         Tuple of (min, max) column indices to load. If None, all columns are loaded.
     clean_white : bool, optional
         If True, remove rows outside of the expected noise range from the white reference.
+    backend : str, optional
+        Backend used by read_spectral to read hdr files. Default is 'memmap'.
+    use_cache : bool, optional
+        If True, return average profiles with a single row instead of the
+        complete references. Default is False.
+    cache_folder : str, optional
+        Folder where profiles are cached if use_cache is True, e.g. the export
+        folder. Default is None, computing profiles without caching them.
 
     Returns
     -------
@@ -114,11 +264,30 @@ def load_white_dark(white_file_path, dark_for_im_file_path,
         
     """
 
-    im_white, _ = read_spectral(path=white_file_path, bands=channel_indices, col_bounds=col_bounds)
-    im_dark, _ = read_spectral(path=dark_for_im_file_path, bands=channel_indices, col_bounds=col_bounds)
+    if use_cache:
+        bands = slice(None) if channel_indices is None else np.asarray(channel_indices)
+        cols = slice(None) if col_bounds is None else slice(*col_bounds)
+        references = []
+        for file_path in [white_file_path, dark_for_im_file_path, dark_for_white_file_path]:
+            if (file_path is None) or (clean_white and file_path == white_file_path):
+                references.append(None)
+                continue
+            profile, _ = load_reference_profile(file_path, cache_folder=cache_folder, backend=backend)
+            references.append(profile[np.newaxis, cols][..., bands])
+        if clean_white:
+            im_white, _ = read_spectral(
+                path=white_file_path, bands=channel_indices, col_bounds=col_bounds, backend=backend)
+            references[0] = clean_white_ref(im_white)
+        return tuple(references)
+
+    im_white, _ = read_spectral(
+        path=white_file_path, bands=channel_indices, col_bounds=col_bounds, backend=backend)
+    im_dark, _ = read_spectral(
+        path=dark_for_im_file_path, bands=channel_indices, col_bounds=col_bounds, backend=backend)
     im_dark_for_white=None
     if dark_for_white_file_path is not None:
-        im_dark_for_white, _ = read_spectral(path=dark_for_white_file_path, bands=channel_indices, col_bounds=col_bounds)
+        im_dark_for_white, _ = read_spectral(
+            path=dark_for_white_file_path, bands=channel_indices, col_bounds=col_bounds, backend=backend)
     
     if clean_white:
         im_white = clean_white_ref(im_white)
@@ -173,6 +342,15 @@ def white_dark_correct(data, white_data, dark_for_im_data, dark_for_white_data=N
 def clean_white_ref(white_image):
     """Remove noise rows from white ref. Return clean white ref"""
 
+    # keep good rows
+    white_sel = white_image[get_clean_white_rows(white_image),:]
+
+    return white_sel
+
+def get_clean_white_rows(white_image):
+    """Find rows of white ref within the expected noise range. Return boolean
+    array of good rows"""
+
     white_mean = white_image.mean(axis=2)
     # compute mean over columns
     col_means = np.nanmean(white_mean, axis=0)
@@ -186,13 +364,14 @@ def clean_white_ref(white_image):
     # find rows with no negative number i.e. good samples
     rowpos = np.sum((submean < 0), axis=1) ==0
 
-    # keep good rows
-    white_sel = white_image[rowpos,:]
-
-    return white_sel
+    return rowpos
 
-def phasor(image_stack, harmonic=1):
-    """Compute phasor components from image stack.
+def phasor(image_stack, harmonic=1, max_block_bytes=2**27):
+    """Compute phasor components from image stack. Only the DC and the
+    selected harmonic of the Fourier transform along bands are needed, so
+    they are computed as dot products of the spectra with cos and sin
+    weights in float32, by tiles of rows. image_stack can be a numpy, zarr
+    or dask array, of which only a tile is loaded in memory at a time.
 
     Parameters
     ----------
@@ -200,6 +379,8 @@ def phasor(image_stack, harmonic=1):
         Image stack. Dims are (bands, rows, cols).
     harmonic : int, optional
         Harmonic to use. Default is 1.
+    max_block_bytes : int, optional
+        Approximate memory in bytes of a tile of rows. Default is 2**27.
     
     Returns
     -------
@@ -213,27 +394,51 @@ def phasor(image_stack, harmonic=1):
         Phase of the phasor. Dims are (rows, cols).
     """
 
-    data = np.fft.fft(image_stack, axis=0)
-    dc = data[0].real
+    nbands, nrows, ncols = image_stack.shape
+    # rows of DC, real and imaginary parts of the harmonic, as in np.fft.fft
+    angles = 2 * np.pi * harmonic * np.arange(nbands) / nbands
+    weights = np.stack([np.ones(nbands), np.cos(angles), -np.sin(angles)]).astype(np.float32)
+
+    components = np.empty((3, nrows, ncols), dtype=np.float32)
+    num_rows_tile = int(max(1, max_block_bytes // (nbands * ncols * 4)))
+    for row_start in range(0, nrows, num_rows_tile):
+        tile = np.asarray(image_stack[:, row_start:row_start+num_rows_tile, :], dtype=np.float32)
+        components[:, row_start:row_start+tile.shape[1], :] = (
+            weights @ tile.reshape(nbands, -1)).reshape(3, tile.shape[1], ncols)
+    dc, real, imag = components
+
     # change the zeros to the img average
     dc = np.where(dc != 0, dc, int(np.mean(dc)))
-    g = data[harmonic].real
-    g /= -dc
-    s = data[harmonic].imag
-    s /= -dc
+    g = real / -dc
+    s = imag / -dc
 
     md = np.sqrt(g ** 2 + s ** 2)
-    ph = np.angle(data[harmonic], deg=True)
+    ph = np.degrees(np.arctan2(imag, real))
     
     return g, s, md, ph
 
-def fit_1dgaussian_without_outliers(data):
+def fit_1dgaussian_without_outliers(data, method='fast', max_samples=10**6, random_state=0):
     """Fit a gaussian to data discarding outliers.
+
+    With method 'fast', the location and scale are estimated with a
+    reweighted one dimensional Minimum Covariance Determinant (MCD), i.e.
+    the mean and variance of the shortest half of the sorted data, corrected
+    for consistency at the normal distribution, followed by a reweighting
+    step discarding points beyond the 97.5% quantile. This is the estimator
+    computed by sklearn's EllipticEnvelope for 1D data (method 'mcd') without
+    its overhead, optionally on a random sample of the data.
     
     Parameters
     ----------
     data : array
-        Data to fit.
+        Data to fit. NaNs are ignored.
+    method : str, optional
+        'fast' or 'mcd' to use sklearn's EllipticEnvelope. Default is 'fast'.
+    max_samples : int, optional
+        With method 'fast', if data has more values, the fit uses a random
+        sample of max_samples values. None uses all values. Default is 10**6.
+    random_state : int, optional
+        Seed of the random sample. Default is 0.
     
     Returns
     -------
@@ -245,12 +450,48 @@ def fit_1dgaussian_without_outliers(data):
     """
 
     tofilter = np.ravel(data)
-    cov = EllipticEnvelope(random_state=0).fit(tofilter[:, np.newaxis])
-    std_val = np.sqrt(cov.covariance_)[0,0]
-    mean_val = cov.location_[0]
+    if method == 'mcd':
+        cov = EllipticEnvelope(random_state=random_state).fit(tofilter[:, np.newaxis])
+        std_val = np.sqrt(cov.covariance_)[0,0]
+        mean_val = cov.location_[0]
+        return mean_val, std_val
+    elif method != 'fast':
+        raise ValueError(f'Unknown method {method}, use fast or mcd')
+
+    tofilter = tofilter[~np.isnan(tofilter)].astype(np.float64)
+    if (max_samples is not None) and (len(tofilter) > max_samples):
+        rng = np.random.default_rng(random_state)
+        tofilter = tofilter[rng.choice(len(tofilter), max_samples, replace=False)]
+    num_values = len(tofilter)
+    num_support = min(int(np.ceil(0.5 * (num_values + 2))), num_values)
+
+    # raw MCD: middle of the shortest windows containing num_support points
+    sorted_vals = np.sort(tofilter)
+    if num_support < num_values:
+        widths = sorted_vals[num_support:] - sorted_vals[:num_values-num_support]
+        starts = np.flatnonzero(widths == widths.min())
+        location = 0.5 * (sorted_vals[starts + num_support] + sorted_vals[starts]).mean()
+        support = np.argpartition(np.abs(tofilter - location), num_support - 1)[:num_support]
+        raw_var = tofilter[support].var()
+    else:
+        location, raw_var = tofilter.mean(), tofilter.var()
+    if raw_var == 0:
+        raise ValueError('The variance of the support data is equal to 0')
+    raw_var *= _get_mcd_consistency_factor(num_support / num_values)
+
+    # reweighting
+    inliers = (tofilter - location)**2 / raw_var < chi2(1).isf(0.025)
+    mean_val = tofilter[inliers].mean()
+    std_val = np.sqrt(tofilter[inliers].var() * _get_mcd_consistency_factor(0.975))
 
     return mean_val, std_val
 
+def _get_mcd_consistency_factor(alpha):
+    """Factor making the variance of the fraction alpha of 1D normal data
+    closest to the mean consistent with the variance of all data."""
+
+    return alpha / chi2.cdf(chi2.ppf(alpha, df=1), 3)
+
 
 def remove_top_bottom(data, std_fact=3, split_min=20):
     """Remove bands around an image where intensity is too high or too low.
@@ -324,7 +565,8 @@ def remove_left_right(data):
     last_index = sel_split[-1]
     return first_index, last_index
 
-def savgol_destripe(image, width=100, order=2):
+def savgol_destripe(image, width=100, order=2, inplace=False, max_block_bytes=2**27,
+                    median_tolerance=None):
     """Perform Savitzky-Golay destriping.
 
     Adapted from https://github.com/tmiraglio/SUREHYP/blob/e7ab633e70f4bb995fc82e02985f231c34dd4818/src/surehyp/preprocess.py#L366
@@ -368,11 +610,22 @@ def savgol_destripe(image, width=100, order=2):
         Window width.
     order : int
         Order of polynomial to fit.
+    inplace : bool, optional
+        If True and image is uint16, the result is written into image to
+        avoid allocating a second image. Default is False.
+    max_block_bytes : int, optional
+        Bands are processed in blocks using about max_block_bytes of float32
+        temporaries. Default is 2**27.
+    median_tolerance : float, optional
+        If not None, the median column profile is estimated by rows tiles
+        within median_tolerance of the exact median, see StreamingColumnMedian.
+        Histograms are built per block of bands so that they use about
+        max_block_bytes. Default is None, using the exact median.
     
     Returns
     -------
     image : array
-        Destriped image. Dims are (rows, cols).
+        Destriped uint16 image. Dims are the same as input.
     """
 
     single_channel = False
@@ -380,31 +633,165 @@ def savgol_destripe(image, width=100, order=2):
         single_channel = True
         image = image[:,:,np.newaxis]
     
-    Pca=np.nanmedian(image,axis=0)
-
-    Pfit=[]
-    for b in np.arange(Pca.shape[1]):
-        Pfit.append(savgol_filter(Pca[:,b], width, order))
-    
-    Pfit=np.asarray(Pfit).T
-    diff=Pfit-Pca
-    # no need for tiling, broadcasting will take care of it
-    # diff=np.tile(diff,(image.shape[0],1,1))
+    Pca = np.empty(image.shape[1:])
+    if median_tolerance is not None:
+        # histograms per block of bands fitting in max_block_bytes
+        num_bins = StreamingColumnMedian.get_num_bins(tolerance=median_tolerance)
+        band_step = int(max(1, max_block_bytes // (image.shape[1] * num_bins * 4)))
+        for b in range(0, image.shape[2], band_step):
+            block = image[:, :, b:b+band_step]
+            estimator = StreamingColumnMedian(
+                image.shape[1], block.shape[2], tolerance=median_tolerance)
+            row_step = int(max(1, max_block_bytes // (image.shape[1] * block.shape[2] * 4)))
+            for r in range(0, image.shape[0], row_step):
+                estimator.update(block[r:r+row_step])
+            Pca[:, b:b+band_step] = estimator.median()
+            del estimator
+    else:
+        # median per block of bands to avoid a full copy of the image
+        band_step = _get_band_step(image, max_block_bytes)
+        median = np.nanmedian if np.issubdtype(image.dtype, np.inexact) else np.median
+        for b in range(0, image.shape[2], band_step):
+            Pca[:, b:b+band_step] = median(image[:, :, b:b+band_step], axis=0)
 
-    image=image.astype(np.float16)+diff.astype(np.float16)
-    image[image<0]=0
-    image = image.astype(np.uint16)
+    diff = get_destripe_offset(Pca, width=width, order=order)
+    out = image if (inplace and image.dtype == np.uint16) else None
+    image = apply_destripe_offset(image, diff, out=out, max_block_bytes=max_block_bytes)
 
     if single_channel:
         image = image[:,:,0]
     
     return image
+
+def _get_band_step(image, max_block_bytes):
+    """Number of bands of an image with dims (rows, cols, bands) fitting in
+    max_block_bytes as float32."""
+
+    return int(max(1, max_block_bytes // (image.shape[0] * image.shape[1] * 4)))
+
+def get_destripe_offset(column_profile, width=100, order=2):
+    """Compute the destriping offset of each column from the median column
+    profile, see savgol_destripe.
+
+    Parameters
+    ----------
+    column_profile : array
+        Median over rows of the image. Dims are (cols, bands).
+    width : int
+        Window width.
+    order : int
+        Order of polynomial to fit.
+
+    Returns
+    -------
+    diff : array
+        Offset to add to each row. Dims are (cols, bands).
+    """
+
+    # filter all bands at once along columns
+    Pfit = savgol_filter(column_profile, width, order, axis=0)
+    diff = Pfit - column_profile
+    return diff
+
+def apply_destripe_offset(image, diff, out=None, max_block_bytes=2**27):
+    """Add destriping offset to image in float32 by blocks of bands and
+    saturate to the uint16 range.
+    
+    Parameters
+    ----------
+    image : array
+        Image to destripe. Dims are (rows, cols, bands).
+    diff : array
+        Offset of each column, see get_destripe_offset. Dims are (cols, bands).
+    out : array, optional
+        uint16 array where the result is written, can be image itself.
+        Default is None, allocating a new array.
+    max_block_bytes : int, optional
+        Approximate memory in bytes of float32 temporaries. Default is 2**27.
+
+    Returns
+    -------
+    out : array
+        Destriped uint16 image. Dims are (rows, cols, bands).
+    """
+
+    if out is None:
+        out = np.empty(image.shape, dtype=np.uint16)
+    diff = diff.astype(np.float32)
+    band_step = _get_band_step(image, max_block_bytes)
+    for b in range(0, image.shape[2], band_step):
+        # broadcasting takes care of the rows
+        block = image[:, :, b:b+band_step].astype(np.float32)
+        block += diff[:, b:b+band_step]
+        np.nan_to_num(block, copy=False, nan=0)
+        np.clip(block, 0, 65535, out=block)
+        out[:, :, b:b+band_step] = block
+
+    return out
+
+def downsample_2x(image):
+    """Downsample an image by 2 along rows and cols by averaging
+    blocks of 2x2 pixels. Odd sizes are padded by repeating the last row/col.
+
+    Parameters
+    ----------
+    image : array
+        Image to downsample. Dims are (rows, cols) or (bands, rows, cols).
     
+    Returns
+    -------
+    downsampled : array
+        Downsampled image with same dtype as image.
+    """
+
+    pad = [(0, 0)] * (image.ndim - 2) + [(0, image.shape[-2] % 2), (0, image.shape[-1] % 2)]
+    image_pad = np.pad(image, pad, mode='edge')
+    new_shape = image_pad.shape[:-2] + (image_pad.shape[-2] // 2, 2, image_pad.shape[-1] // 2, 2)
+    downsampled = image_pad.reshape(new_shape).mean(axis=(-3, -1))
+
+    return downsampled.astype(image.dtype)
+
+def save_to_pyramid(image, pyramid, selection):
+    """Save an image to all levels of a multiscale pyramid. Lower resolution
+    levels are computed by successive 2x downsampling of image.
+
+    Parameters
+    ----------
+    image : array
+        Full resolution image. Dims are (rows, cols) or (bands, rows, cols).
+    pyramid : list of zarr arrays
+        Resolution levels, from full resolution to lowest resolution.
+    selection : tuple of (int or slice, int, int)
+        Band index (or slice of bands), first row and first col where image is
+        saved in the full resolution level. First row and col have to be
+        divisible by 2**(len(pyramid)-1).
+    
+    Returns
+    -------
+    None
+    """
+
+    band, row_start, col_start = selection
+    for level, level_zarr in enumerate(pyramid):
+        if level > 0:
+            image = downsample_2x(image)
+        row, col = row_start // 2**level, col_start // 2**level
+        level_zarr[band, row:row+image.shape[-2], col:col+image.shape[-1]] = image
+
+# white dark correction keeps about three float64 temporaries per value
+CORRECTION_BYTES_PER_VALUE = 24
+
+def _get_num_block_items(max_block_bytes, item_values, num_parallel=1):
+    """Number of items (e.g. bands or rows) of item_values values each that
+    num_parallel workers can white dark correct at the same time within
+    max_block_bytes. Can be 0 if a single item exceeds the budget."""
+
+    return int(max_block_bytes // (num_parallel * item_values * CORRECTION_BYTES_PER_VALUE))
 
 def correct_single_channel(
         im_path, white_path, dark_for_im_path, dark_for_white_path, im_zarr,
-        zarr_ind, band, background_correction=True, destripe=False, use_float=False
-        ):
+        zarr_ind, band, background_correction=True, destripe=False, use_float=False,
+        use_reference_cache=True, reference_cache_folder=None):
     """White dark correction and save to zarr
     
     Parameters
@@ -417,8 +804,9 @@ def correct_single_channel(
         Path to dark image for image
     dark_for_white_path : str
         Path to dark image for white ref
-    im_zarr : zarr
-        Zarr to save corrected image to
+    im_zarr : zarr or list of zarr
+        Zarr to save corrected image to. If a list, levels of a multiscale
+        pyramid, see save_to_pyramid
     band : int
         Channel to correct
     zarr_ind: int
@@ -429,6 +817,11 @@ def correct_single_channel(
         Whether to perform destriping. Default is True.
     use_float : bool, optional
         Whether to use float data type. Default is False.
+    use_reference_cache : bool, optional
+        Whether to use reference profiles, see load_white_dark. Default is True.
+    reference_cache_folder : str, optional
+        Folder where reference profiles are cached, see load_white_dark.
+        Default is None, no caching.
     
     Returns
     -------
@@ -436,76 +829,703 @@ def correct_single_channel(
     
     """
     
-    im_reg = open_image(im_path)
-    img_load = im_reg.read_band(band)
+    correct_band_block(
+        im_path, white_path, dark_for_im_path, dark_for_white_path, im_zarr,
+        zarr_start=zarr_ind, bands=[band], background_correction=background_correction,
+        destripe=destripe, use_float=use_float, use_reference_cache=use_reference_cache,
+        reference_cache_folder=reference_cache_folder)
+
+    return None
+
+def correct_band_block(
+        im_path, white_path, dark_for_im_path, dark_for_white_path, im_zarr,
+        zarr_start, bands, background_correction=True, destripe=False, use_float=False,
+        use_reference_cache=True, num_rows_tile=None, median_tolerance=None,
+        reference_cache_folder=None):
+    """White dark correct (and optionally destripe) a block of bands read in
+    a single pass and save it to zarr. Consecutive bands are read as slices
+    so that the raw file is traversed once per block instead of once per band.
+    If num_rows_tile is set, the block is processed out-of-core by tiles of
+    rows, see correct_band_block_tiled.
+    
+    Parameters
+    ----------
+    im_path : str
+        Path to image to be corrected
+    white_path : str
+        Path to white image
+    dark_for_im_path : str
+        Path to dark image for image
+    dark_for_white_path : str
+        Path to dark image for white ref. Can be None.
+    im_zarr : zarr or list of zarr
+        Zarr to save corrected image to. If a list, levels of a multiscale
+        pyramid, see save_to_pyramid
+    zarr_start : int
+        Index of zarr where the first band of the block is saved, following
+        bands are saved at consecutive indices
+    bands : list of int
+        Channels to correct
+    background_correction : bool, optional
+        Whether to perform white correction. Default is True.
+    destripe : bool, optional
+        Whether to perform destriping. Default is True.
+    use_float : bool, optional
+        Whether to use float data type. Default is False.
+    use_reference_cache : bool, optional
+        Whether to use reference profiles, see load_white_dark. Default is True.
+    reference_cache_folder : str, optional
+        Folder where reference profiles are cached, see load_white_dark.
+        Default is None, no caching.
+    num_rows_tile : int, optional
+        Number of rows per tile for out-of-core processing. Default is None,
+        processing the complete block in memory.
+    median_tolerance : float, optional
+        If not None, destripe with an approximate median within
+        median_tolerance of the exact one, see StreamingColumnMedian.
+        Default is None.
+    
+    Returns
+    -------
+    None
+    
+    """
 
-    corrected = img_load.copy()
+    if num_rows_tile is not None:
+        correct_band_block_tiled(
+            im_path, white_path, dark_for_im_path, dark_for_white_path, im_zarr,
+            zarr_start, bands, num_rows_tile=num_rows_tile,
+            background_correction=background_correction, destripe=destripe,
+            use_float=use_float, use_reference_cache=use_reference_cache,
+            median_tolerance=median_tolerance, reference_cache_folder=reference_cache_folder)
+        return None
+
+    references = None
     if background_correction:
+        references = load_white_dark(
+            white_file_path=white_path,
+            dark_for_im_file_path=dark_for_im_path,
+            dark_for_white_file_path=dark_for_white_path,
+            channel_indices=bands,
+            use_cache=use_reference_cache,
+            cache_folder=reference_cache_folder)
+    corrected = _read_correct_rows(im_path, bands, None, references, use_float)
 
-        white = open_image(white_path)
-        dark = open_image(dark_for_im_path)
-        dark_white = open_image(dark_for_white_path)
-        img_white_load = white.read_band(band)
-        img_dark_load = dark.read_band(band)
-        img_dark_white_load = dark_white.read_band(band)
+    if destripe:
+        corrected = np.moveaxis(
+            savgol_destripe(np.moveaxis(corrected, 0, 2), width=100, order=2, inplace=True,
+                            median_tolerance=median_tolerance), 2, 0)
+
+    selection = slice(zarr_start, zarr_start + len(bands))
+    if isinstance(im_zarr, list):
+        save_to_pyramid(corrected, im_zarr, (selection, 0, 0))
+    else:
+        im_zarr[selection, :,:] = corrected
+
+    return None
 
+def _read_correct_rows(im_path, bands, row_bounds, references, use_float):
+    """Read rows of bands and white dark correct them if references
+    (white, dark, dark for white) are given. Returns array (bands, rows, cols)."""
+
+    img_load, _ = read_spectral(im_path, bands=bands, row_bounds=row_bounds, backend='memmap')
+    corrected = np.moveaxis(np.asarray(img_load), 2, 0)
+    if references is not None:
         corrected = white_dark_correct(
-            data=img_load[np.newaxis,:,:],
-            white_data=img_white_load[:,:,np.newaxis], 
-            dark_for_im_data=img_dark_load[:,:,np.newaxis],
-            dark_for_white_data=img_dark_white_load[:,:,np.newaxis],
+            data=corrected,
+            white_data=references[0],
+            dark_for_im_data=references[1],
+            dark_for_white_data=references[2],
             use_float=use_float
-        )[0]
-    if destripe:
-    #    import pystripe
-    #    corrected = pystripe.filter_streaks(corrected.T, sigma=[128, 256], level=7, wavelet='db2').T
-        corrected = savgol_destripe(corrected, width=100, order=2)
+        )
+    return corrected
+
+def _update_byte_histogram(hist, tile, shift, bucket=None):
+    """Count byte (tile >> shift) & 255 of a uint16 tile with dims (bands, rows, cols)
+    per band and column into hist with dims (bands, cols, 256). If bucket with
+    dims (bands, cols) is given, only values with high byte equal to bucket
+    are counted."""
+
+    num_bands, _, num_cols = tile.shape
+    tile = tile.astype(np.int64)
+    offset = (np.arange(num_bands)[:, np.newaxis, np.newaxis] * num_cols
+              + np.arange(num_cols)[np.newaxis, np.newaxis, :]) * 256
+    index = offset + ((tile >> shift) & 255)
+    if bucket is not None:
+        index = index[(tile >> 8) == bucket[:, np.newaxis, :]]
+    hist += np.bincount(index.ravel(), minlength=hist.size).reshape(hist.shape)
+
+def _find_rank_in_histogram(hist, rank):
+    """Find bin of element of given rank along last axis of hist. Returns bin
+    and rank of the element within the bin."""
+
+    cumulative = np.cumsum(hist, axis=-1)
+    bins = np.argmax(cumulative > rank[..., np.newaxis], axis=-1)
+    below = np.take_along_axis(cumulative - hist, bins[..., np.newaxis], axis=-1)[..., 0]
+    return bins, rank - below
+
+class StreamingColumnMedian:
+    """Approximate median over rows of each column and band of an image
+    received by tiles of rows, e.g. for destriping images that do not fit
+    in memory.
+
+    Values of each column and band are counted in a histogram with bins of
+    width tolerance. The median is interpolated within the bins of the two
+    middle elements, so that it is within tolerance of the exact median
+    for values inside value_range. Values outside value_range are counted
+    in the first or last bin and NaNs are ignored. Memory is about
+    4 * cols * bands * (value_range width / tolerance) bytes.
 
-    im_zarr[zarr_ind, :,:] = corrected
+    Parameters
+    ----------
+    num_cols : int
+        Number of columns of the image.
+    num_bands : int
+        Number of bands of the image.
+    tolerance : float, optional
+        Maximum error of the median. Default is 16.
+    value_range : tuple of float, optional
+        Range (min, max) of values. Default is (0, 2**16), the range of uint16.
+    """
+
+    def __init__(self, num_cols, num_bands, tolerance=16, value_range=(0, 2**16)):
+
+        if tolerance <= 0:
+            raise ValueError('tolerance must be positive')
+        self.num_cols = num_cols
+        self.num_bands = num_bands
+        self.tolerance = tolerance
+        self.value_range = value_range
+        self.num_bins = self.get_num_bins(tolerance, value_range)
+        self.counts = np.zeros((num_bands, num_cols, self.num_bins), dtype=np.int32)
+
+    @staticmethod
+    def get_num_bins(tolerance=16, value_range=(0, 2**16)):
+        """Number of histogram bins per column and band, the histograms of
+        a band using 4 * cols * num_bins bytes."""
+
+        return int(np.ceil((value_range[1] - value_range[0]) / tolerance))
+
+    def update(self, tile):
+        """Add a tile of rows to the histograms.
+
+        Parameters
+        ----------
+        tile : array
+            Rows of the image. Dims are (rows, cols) or (rows, cols, bands).
+        """
+
+        if tile.ndim == 2:
+            tile = tile[:, :, np.newaxis]
+        offset = np.arange(self.num_cols) * self.num_bins
+        for b in range(self.num_bands):
+            bins = (tile[:, :, b].astype(np.float32) - self.value_range[0]) / self.tolerance
+            valid = ~np.isnan(bins)
+            bins[~valid] = 0
+            np.clip(bins, 0, self.num_bins - 1, out=bins)
+            index = offset + bins.astype(np.int64)
+            self.counts[b] += np.bincount(
+                index[valid], minlength=self.counts[b].size).reshape(self.counts[b].shape).astype(np.int32)
+
+    def median(self):
+        """Return the approximate median of the rows added so far.
+
+        Returns
+        -------
+        median : array
+            Median of each column. Dims are (cols, bands), NaN for
+            columns without values.
+        """
+
+        median = np.full((self.num_cols, self.num_bands), np.nan)
+        for b in range(self.num_bands):
+            counts = self.counts[b]
+            num_values = counts.sum(axis=-1)
+            values = []
+            for rank in [(num_values - 1) // 2, num_values // 2]:
+                bins, rank_in_bin = _find_rank_in_histogram(counts, np.maximum(rank, 0))
+                in_bin = np.take_along_axis(counts, bins[:, np.newaxis], axis=-1)[:, 0]
+                # elements assumed evenly spread within their bin
+                position = bins + (rank_in_bin + 0.5) / np.maximum(in_bin, 1)
+                values.append(self.value_range[0] + position * self.tolerance)
+            median[:, b] = np.where(num_values > 0, (values[0] + values[1]) / 2, np.nan)
+
+        return median
+
+def correct_band_block_tiled(
+        im_path, white_path, dark_for_im_path, dark_for_white_path, im_zarr,
+        zarr_start, bands, num_rows_tile=1000, background_correction=True, destripe=False,
+        use_float=False, use_reference_cache=True, median_tolerance=None,
+        reference_cache_folder=None):
+    """Out-of-core version of correct_band_block: rows are read, corrected and
+    written tile by tile so that memory is bounded by the tile size.
+
+    For destriping, the median column profile is needed before any tile can
+    be written. For uint16 data it is computed exactly from per column
+    histograms of the high and then the low byte of corrected values,
+    accumulated over two passes of tiles, and results are identical to
+    correct_band_block. For other data types it is computed from strips of
+    columns of the corrected image written in a first pass, in which case
+    memory also scales with rows * chunk width and values are rounded to
+    the zarr data type before destriping. If median_tolerance is set, an
+    approximate median is computed instead in a single pass of tiles for
+    any data type, see StreamingColumnMedian.
+
+    Parameters
+    ----------
+    im_path : str
+        Path to image to be corrected
+    white_path : str
+        Path to white image
+    dark_for_im_path : str
+        Path to dark image for image
+    dark_for_white_path : str
+        Path to dark image for white ref. Can be None.
+    im_zarr : zarr or list of zarr
+        Zarr to save corrected image to. If a list, levels of a multiscale
+        pyramid, see save_to_pyramid
+    zarr_start : int
+        Index of zarr where the first band of the block is saved
+    bands : list of int
+        Channels to correct
+    num_rows_tile : int, optional
+        Number of rows per tile, rounded up to a multiple of the pyramid
+        downsampling factor. Default is 1000.
+    background_correction : bool, optional
+        Whether to perform white correction. Default is True.
+    destripe : bool, optional
+        Whether to perform destriping. Default is False.
+    use_float : bool, optional
+        Whether to use float data type. Default is False.
+    use_reference_cache : bool, optional
+        Whether to use reference profiles, see load_white_dark. Default is True.
+    reference_cache_folder : str, optional
+        Folder where reference profiles are cached, see load_white_dark.
+        Default is None, no caching.
+    median_tolerance : float, optional
+        Maximum error of the approximate median used for destriping, in
+        uint16 units of the corrected image. Default is None, using the
+        exact median.
+    
+    Returns
+    -------
+    None
+    
+    """
+
+    pyramid = im_zarr if isinstance(im_zarr, list) else [im_zarr]
+    factor = 2**(len(pyramid)-1)
+    num_rows_tile = int(np.ceil(num_rows_tile / factor) * factor)
+    num_bands = len(bands)
+    _, num_rows, num_cols = pyramid[0].shape
+    selection = slice(zarr_start, zarr_start + num_bands)
+    row_tiles = [(r, min(r + num_rows_tile, num_rows)) for r in range(0, num_rows, num_rows_tile)]
+
+    references = None
+    if background_correction:
+        references = load_white_dark(
+            white_file_path=white_path,
+            dark_for_im_file_path=dark_for_im_path,
+            dark_for_white_file_path=dark_for_white_path,
+            channel_indices=bands,
+            use_cache=use_reference_cache,
+            cache_folder=reference_cache_folder)
+
+    def corrected_tiles():
+        for row_bounds in row_tiles:
+            yield row_bounds, _read_correct_rows(im_path, bands, row_bounds, references, use_float)
+
+    if not destripe:
+        for (row_start, _), tile in corrected_tiles():
+            save_to_pyramid(tile, pyramid, (selection, row_start, 0))
+        return None
+
+    if background_correction:
+        tile_dtype = np.dtype('f8') if use_float else np.dtype(np.uint16)
+    else:
+        tile_dtype = np.dtype(read_spectral_metadata(im_path)[1])
+
+    if median_tolerance is not None:
+        # approximate median from a single pass of tiles, float values
+        # are reflectances, i.e. uint16 values scaled by 2**-12
+        scale = 2**-12 if (background_correction and use_float) else 1
+        estimator = StreamingColumnMedian(
+            num_cols, num_bands, tolerance=median_tolerance * scale,
+            value_range=(0, 2**16 * scale))
+        for _, tile in corrected_tiles():
+            estimator.update(np.moveaxis(tile, 0, 2))
+        column_profile = estimator.median().T
+        tiles = corrected_tiles()
+    elif tile_dtype != np.uint16:
+        # median from strips of columns of the non-destriped image
+        for (row_start, row_end), tile in corrected_tiles():
+            pyramid[0][selection, row_start:row_end, :] = tile
+        strip_width = pyramid[0].chunks[2]
+        column_profile = np.zeros((num_bands, num_cols))
+        for col_start in range(0, num_cols, strip_width):
+            strip = pyramid[0][selection, :, col_start:col_start+strip_width]
+            column_profile[:, col_start:col_start+strip_width] = np.nanmedian(strip, axis=1)
+        tiles = ((row_bounds, pyramid[0][selection, row_bounds[0]:row_bounds[1], :])
+                 for row_bounds in row_tiles)
+    else:
+        # exact median of uint16 values from byte histograms
+        ranks = [np.full((num_bands, num_cols), (num_rows-1)//2), np.full((num_bands, num_cols), num_rows//2)]
+        hist_high = np.zeros((num_bands, num_cols, 256), dtype=np.int64)
+        for _, tile in corrected_tiles():
+            _update_byte_histogram(hist_high, tile, shift=8)
+        high = [_find_rank_in_histogram(hist_high, r) for r in ranks]
+        del hist_high
+
+        hist_low = [np.zeros((num_bands, num_cols, 256), dtype=np.int64) for _ in ranks]
+        for _, tile in corrected_tiles():
+            for hist, (bucket, _) in zip(hist_low, high):
+                _update_byte_histogram(hist, tile, shift=0, bucket=bucket)
+        values = []
+        for hist, (bucket, rank) in zip(hist_low, high):
+            low, _ = _find_rank_in_histogram(hist, rank)
+            values.append(bucket * 256 + low)
+        column_profile = (values[0] + values[1]) / 2
+        tiles = corrected_tiles()
+
+    diff = get_destripe_offset(column_profile.T, width=100, order=2)
+    for (row_start, _), tile in tiles:
+        tile = np.moveaxis(apply_destripe_offset(
+            np.moveaxis(tile, 0, 2), diff, out=np.moveaxis(tile, 0, 2) if tile.dtype == np.uint16 else None), 2, 0)
+        save_to_pyramid(tile, pyramid, (selection, row_start, 0))
 
     return None
 
-def correct_save_to_zarr(imhdr_path, white_file_path, dark_for_im_file_path,
-                         dark_for_white_file_path , zarr_path, band_indices=None,
-                         min_max_bands=None, background_correction=True, destripe=True,
-                         use_dask=False, chunk_size=500, use_float=False):
+def get_band_indices(img, band_indices=None, min_max_bands=None):
+    """Get indices of bands to process from a list of indices or a range of
+    wavelengths.
 
-    img = open_image(imhdr_path)
+    Parameters
+    ----------
+    img : spectral image
+        Image opened with spectral.open_image.
+    band_indices : list of int, optional
+        Indices of bands to process.
+    min_max_bands : list of float, optional
+        Minimum and maximum wavelength of bands to process. Cannot be used
+        together with band_indices.
 
-    samples = img.ncols
-    lines = img.nrows
+    Returns
+    -------
+    band_indices : array of int
+        Indices of bands to process, all bands if both options are None.
+    """
 
     if band_indices is not None:
         band_indices = np.array(band_indices)
-        bands = len(band_indices)
         if min_max_bands is not None:
             raise ValueError('band_indices and min_max_bands cannot be provided together')
     elif min_max_bands is not None:
         min_band = np.argmin(np.abs(np.array(img.bands.centers) - min_max_bands[0]))
         max_band = np.argmin(np.abs(np.array(img.bands.centers) - min_max_bands[1]))
         band_indices = np.arange(min_band, max_band+1)
-        bands = len(band_indices)
     else:
-        bands = img.nbands
-        band_indices = np.arange(bands)
-    
+        band_indices = np.arange(img.nbands)
+    return band_indices
+
+def create_corrected_zarr(zarr_path, shape, chunk_size=500, use_float=False, multiscale=True,
+                          codec='default', synchronizer=None):
+    """Create the zarr of a corrected image with chunks (1, chunk_size, chunk_size).
+
+    Parameters
+    ----------
+    zarr_path : str
+        Path to save zarr to.
+    shape : tuple of int
+        Shape of the image. Dims are (bands, rows, cols).
+    chunk_size : int, optional
+        Size of chunks along rows and cols. Default is 500.
+    use_float : bool, optional
+        Whether to use float data type. Default is False.
+    multiscale : bool, optional
+        If True, create a multiscale pyramid, see io.create_multiscale_zarr.
+        Default is True.
+    codec : str, optional
+        Compression codec, see io.get_zarr_compressor_kwargs. Default is 'default'.
+    synchronizer : zarr synchronizer, optional
+        Synchronizer of the arrays for parallel writes. Default is None.
+
+    Returns
+    -------
+    pyramid : list of zarr arrays
+        Resolution levels, a single level if multiscale is False.
+    """
+
     if use_float:
         dtype = 'f4'
     else:
         dtype = 'u2'
-    z1 = zarr.open(zarr_path, mode='w', shape=(bands, lines,samples),
-               #chunks=(1, lines, samples), dtype='u2')
-                   chunks=(1, chunk_size, chunk_size), dtype=dtype)
+    if multiscale:
+        pyramid = create_multiscale_zarr(
+            zarr_path, shape=shape, chunks=(1, chunk_size, chunk_size),
+            dtype=dtype, num_levels=get_pyramid_num_levels(shape[1:]), codec=codec,
+            synchronizer=synchronizer)
+    else:
+        pyramid = [zarr.open(zarr_path, mode='w', shape=shape,
+                    chunks=(1, chunk_size, chunk_size), dtype=dtype,
+                    synchronizer=synchronizer, **get_zarr_compressor_kwargs(codec))]
+    return pyramid
+
+def _describe_image_file(imhdr_path):
+    """Path, size and modification time of the data file of an image."""
+
+    stat = os.stat(open_image(imhdr_path).filename)
+    return {
+        'path': str(Path(imhdr_path).resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns}
+
+def get_preprocessing_key(imhdr_path, band_indices, reference_paths=None, **options):
+    """Describe a preprocessing run by its input image and references (path,
+    size and modification time), bands and options, used to check that a
+    partially preprocessed zarr can be resumed.
+
+    Parameters
+    ----------
+    imhdr_path : str
+        Path to hdr file of image to correct.
+    band_indices : list of int
+        Indices of processed bands.
+    reference_paths : list of str, optional
+        Paths to hdr files of references used for correction, e.g. white,
+        dark and dark for white references. None entries are kept as None.
+        Default is None, for runs without background correction.
+    options : dict
+        Options affecting the result, e.g. destripe=True.
 
-    if use_dask:
-        client = Client()
+    Returns
+    -------
+    key : dict
+        JSON serializable description of the run.
+    """
+
+    image = _describe_image_file(imhdr_path)
+    key = {
+        'image': image['path'],
+        'size': image['size'],
+        'mtime_ns': image['mtime_ns'],
+        'band_indices': [int(b) for b in band_indices],
+        'references': [None if ref is None else _describe_image_file(ref)
+                       for ref in (reference_paths or [])],
+        **options}
+    return key
+
+def open_resumable_zarr(zarr_path, key, shape, chunk_size=500, use_float=False, multiscale=True,
+                        codec='default', synchronizer=None, resume=False):
+    """Open the zarr of a corrected image to continue an interrupted run, or
+    create it, see create_corrected_zarr. The run is described by key (see
+    get_preprocessing_key) saved in the attributes of the full resolution
+    level, together with completion markers in attribute 'completed' with
+    keys 'bands' (indices in the zarr of finished bands) and 'spectra'
+    (tile size of the saved copy chunked along pixels, None if not saved).
+
+    Parameters
+    ----------
+    zarr_path : str
+        Path of zarr.
+    key : dict
+        Description of the run, see get_preprocessing_key.
+    shape, chunk_size, use_float, multiscale, codec, synchronizer :
+        See create_corrected_zarr.
+    resume : bool, optional
+        If True and the zarr exists with the same key, it is opened for
+        writing and its markers are kept. Otherwise a new zarr is
+        created. Default is False.
+
+    Returns
+    -------
+    pyramid : list of zarr arrays
+        Resolution levels, a single level if multiscale is False.
+    completed : dict
+        Completion markers of the run.
+    """
+
+    zarr_path = Path(zarr_path)
+    if resume and zarr_path.exists():
+        try:
+            if multiscale:
+                datasets = zarr.open_group(zarr_path, mode='r').attrs['multiscales'][0]['datasets']
+                paths = [zarr_path.joinpath(d['path']) for d in datasets]
+            else:
+                paths = [zarr_path]
+            pyramid = [zarr.open_array(p, mode='r+', synchronizer=synchronizer) for p in paths]
+        except (KeyError, ValueError, zarr.errors.PathNotFoundError, zarr.errors.ArrayNotFoundError,
+                zarr.errors.ContainsGroupError, zarr.errors.GroupNotFoundError):
+            pyramid = None
+        if (pyramid is not None) and (pyramid[0].attrs.get('preprocessing') == key):
+            return pyramid, pyramid[0].attrs.get('completed', {'bands': [], 'spectra': None})
+
+    pyramid = create_corrected_zarr(
+        zarr_path, shape=shape, chunk_size=chunk_size, use_float=use_float,
+        multiscale=multiscale, codec=codec, synchronizer=synchronizer)
+    completed = {'bands': [], 'spectra': None}
+    pyramid[0].attrs.update({'preprocessing': key, 'completed': completed})
+    return pyramid, completed
+
+def correct_save_to_zarr(imhdr_path, white_file_path, dark_for_im_file_path,
+                         dark_for_white_file_path , zarr_path, band_indices=None,
+                         min_max_bands=None, background_correction=True, destripe=True,
+                         use_dask=False, chunk_size=500, use_float=False, multiscale=True,
+                         spectra_tile_size=None, codec='default', max_block_bytes=2**30,
+                         use_reference_cache=True, num_rows_tile=None, executor=None,
+                         median_tolerance=None, resume=False, num_workers=None):
+    """White and dark correct (and optionally destripe) an image by blocks of
+    bands and save it to zarr. Each block is read once and corrected in a
+    single vectorised pass, see correct_band_block. Finished blocks are
+    recorded in the zarr attributes so that an interrupted run can be
+    resumed, see open_resumable_zarr.
+
+    Parameters
+    ----------
+    imhdr_path : str
+        Path to hdr file of image to correct.
+    white_file_path : str
+        Path to white reference image.
+    dark_for_im_file_path : str
+        Path to dark reference image for image.
+    dark_for_white_file_path : str
+        Path to dark reference image for white reference.
+    zarr_path : str
+        Path to save zarr to.
+    band_indices : list of int, optional
+        Indices of bands to process. If None, all bands are processed.
+    min_max_bands : list of float, optional
+        Minimum and maximum wavelength of bands to process. Cannot be used
+        together with band_indices.
+    background_correction : bool, optional
+        Whether to perform white correction. Default is True.
+    destripe : bool, optional
+        Whether to perform destriping. Default is True.
+    use_dask : bool, optional
+        Whether to process blocks of bands in parallel. Only used if executor
+        is None, in which case a thread pool is used. Default is False.
+    chunk_size : int, optional
+        Size of chunks along rows and cols. Default is 500.
+    use_float : bool, optional
+        Whether to use float data type. Default is False.
+    multiscale : bool, optional
+        If True, the zarr is a multiscale pyramid (OME-NGFF layout) with 2x
+        downsampled levels written in the same pass. Default is True.
+    spectra_tile_size : int, optional
+        If not None, also save a copy of the image chunked along pixels with
+        chunks (all bands, spectra_tile_size, spectra_tile_size), used to read
+        spectra of single pixels or small regions. Requires multiscale=True.
+        Default is None.
+    codec : str, optional
+        Compression codec of the zarr, one of 'default', 'zstd', 'lz4' or
+        'none', see io.get_zarr_compressor_kwargs. Default is 'default'.
+    max_block_bytes : int, optional
+        Approximate memory in bytes used to process blocks of bands, which
+        sets the number of bands per block. White dark correction keeps about
+        three float64 temporaries, so a block of n bands uses about
+        n * rows * cols * 24 bytes. With parallel executors the budget is
+        shared between the num_workers blocks processed at the same time.
+        Default is 2**30.
+    use_reference_cache : bool, optional
+        Whether to use reference profiles cached in the folder containing
+        zarr_path, e.g. the export folder, see load_reference_profile.
+        Default is True.
+    num_rows_tile : int, optional
+        If not None, blocks of bands are processed out-of-core by tiles of
+        num_rows_tile rows, see correct_band_block_tiled, and max_block_bytes
+        applies to a tile instead of complete bands. Default is None.
+    executor : object or str, optional
+        Executor processing blocks of bands in parallel, see get_executor.
+        Executor objects passed by the caller, e.g. a dask distributed Client,
+        are not closed so that they can be reused for several images.
+        Default is None, using threads if use_dask is True and processing
+        blocks serially otherwise.
+    median_tolerance : float, optional
+        If not None, destripe with an approximate median within
+        median_tolerance (in uint16 units of the corrected image) of the
+        exact median, which saves a pass over the raw file when num_rows_tile
+        is set, see StreamingColumnMedian. In that case blocks of bands are
+        also limited so that their histograms fit in max_block_bytes.
+        Default is None.
+    resume : bool, optional
+        If True and zarr_path holds an interrupted run of the same image with
+        the same bands and options, only unfinished blocks of bands are
+        processed. Default is False, overwriting zarr_path.
+    num_workers : int, optional
+        Number of workers of the executor created here, and number of blocks
+        assumed to be processed at the same time by executors passed by the
+        caller. Default is None, using min(4, number of cpus).
+    
+    Returns
+    -------
+    None
+    """
+
+    img = open_image(imhdr_path)
+
+    samples = img.ncols
+    lines = img.nrows
+
+    band_indices = get_band_indices(img, band_indices, min_max_bands)
+    bands = len(band_indices)
+    
+    if (spectra_tile_size is not None) and (not multiscale):
+        raise ValueError('spectra_tile_size requires multiscale=True')
+
+    key = get_preprocessing_key(
+        imhdr_path, band_indices,
+        reference_paths=[white_file_path, dark_for_im_file_path, dark_for_white_file_path]
+        if background_correction else None,
+        background_correction=background_correction,
+        destripe=destripe, use_float=use_float, chunk_size=chunk_size, multiscale=multiscale,
+        codec=codec, median_tolerance=median_tolerance)
+    pyramid, completed = open_resumable_zarr(
+        zarr_path, key, shape=(bands, lines, samples), chunk_size=chunk_size,
+        use_float=use_float, multiscale=multiscale, codec=codec, resume=resume)
+    z1 = pyramid[0]
+    if not multiscale:
+        pyramid = z1
+
+    if executor is None:
+        executor = 'threads' if use_dask else 'serial'
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    blocks_in_parallel = 1 if executor == 'serial' else num_workers
+
+    block_rows = lines if num_rows_tile is None else min(lines, num_rows_tile)
+    bands_per_block = max(1, _get_num_block_items(max_block_bytes, block_rows * samples, blocks_in_parallel))
+    if destripe and (median_tolerance is not None) and (num_rows_tile is not None):
+        # histograms of the approximate median of a block are kept during
+        # the pass over its tiles
+        hist_bytes = samples * StreamingColumnMedian.get_num_bins(tolerance=median_tolerance) * 4
+        bands_per_block = int(max(1, min(bands_per_block, max_block_bytes // (blocks_in_parallel * hist_bytes))))
+    # a block is skipped only if all its bands were finished, blocks of the
+    # interrupted run may have had another size
+    block_starts = [ind for ind in range(0, bands, bands_per_block)
+                    if not set(range(ind, min(ind + bands_per_block, bands))).issubset(completed['bands'])]
+
+    def mark_completed(ind):
+        completed['bands'] = sorted(set(completed['bands']).union(range(ind, min(ind + bands_per_block, bands))))
+        z1.attrs['completed'] = completed
+
+    reference_cache_folder = Path(zarr_path).parent if use_reference_cache else None
+    if background_correction and use_reference_cache:
+        # create cached profiles once before blocks are processed in parallel
+        for ref_path in [white_file_path, dark_for_im_file_path, dark_for_white_file_path]:
+            if ref_path is not None:
+                load_reference_profile(ref_path, cache_folder=reference_cache_folder)
+
+    executor, close_executor = get_executor(executor, num_workers=num_workers)
+
+    if executor is not None:
         process = []
-        for ind, c in enumerate(band_indices):
-            process.append(client.submit(
-                correct_single_channel,
+        for ind in block_starts:
+            process.append(executor.submit(
+                correct_band_block,
                 imhdr_path, white_file_path,
                 dark_for_im_file_path, dark_for_white_file_path,
-                z1, ind, c, background_correction, destripe, use_float))
+                pyramid, ind, band_indices[ind:ind+bands_per_block],
+                background_correction, destripe, use_float, use_reference_cache,
+                num_rows_tile, median_tolerance, reference_cache_folder))
         
         #for k in tqdm(range(len(process)), "correcting and saving to zarr"):
         with progress(range(len(process))) as pbr2:
@@ -513,27 +1533,261 @@ def correct_save_to_zarr(imhdr_path, white_file_path, dark_for_im_file_path,
             for k in pbr2:
                 future = process[k]
                 out = future.result()
+                mark_completed(block_starts[k])
                 future.cancel()
                 del future
     else:
-        for ind, c in enumerate(tqdm(band_indices, "Preprocessing bands")):
-            correct_single_channel(
+        for ind in tqdm(block_starts, "Preprocessing blocks of bands"):
+            correct_band_block(
                 imhdr_path, white_file_path,
                 dark_for_im_file_path, dark_for_white_file_path,
-                z1, ind, c, background_correction, destripe, use_float)
+                pyramid, ind, band_indices[ind:ind+bands_per_block],
+                background_correction, destripe, use_float, use_reference_cache,
+                num_rows_tile, median_tolerance, reference_cache_folder)
+            mark_completed(ind)
 
     z1.attrs['metadata'] = {
         'wavelength': list(np.array(img.metadata['wavelength'])[band_indices]),
         'centers': list(np.array(img.bands.centers)[band_indices])
         }
 
-    if use_dask:
-        client.close()
+    if (spectra_tile_size is not None) and (block_starts or completed['spectra'] != spectra_tile_size):
+        save_spectra_copy_to_zarr(zarr_path, tile_size=spectra_tile_size)
+        completed['spectra'] = spectra_tile_size
+        z1.attrs['completed'] = completed
+
+    if close_executor:
+        close_executor()
+
+def get_executor(executor='threads', num_workers=None):
+    """Get an executor to run preprocessing tasks in parallel.
+
+    Parameters
+    ----------
+    executor : object or str, optional
+        'serial' (no executor), 'threads' (thread pool, suited to I/O bound
+        work, numpy releasing the GIL), 'processes' (process pool) or 'dask'
+        (local dask distributed cluster). Any other object with a
+        submit(fn, *args) method returning futures, e.g. a
+        concurrent.futures executor or an existing dask distributed Client,
+        is returned as is. Default is 'threads'.
+    num_workers : int, optional
+        Number of workers of created pools. Default is None, using
+        min(4, number of cpus) to bound the memory of blocks processed
+        at the same time.
 
-def convert_bil_raw_to_zarr(hdr_path, export_folder, num_rows_chunk=2000, force=False):
+    Returns
+    -------
+    executor : object or None
+        Executor, None for 'serial'.
+    close : callable or None
+        Function to call to close the executor if it was created here,
+        None if the executor belongs to the caller.
     """
-    Convert an original raw image in bil format to zarr. The exported zarr has format
-    XYC with C saved as partial chunks.
+
+    if not isinstance(executor, str):
+        return executor, None
+    if executor == 'serial':
+        return None, None
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    if executor == 'threads':
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+        return executor, executor.shutdown
+    elif executor == 'processes':
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        return executor, executor.shutdown
+    elif executor == 'dask':
+        executor = Client(n_workers=num_workers)
+        return executor, executor.close
+    else:
+        raise ValueError(f'Unknown executor {executor}')
+
+def preprocess_raw_to_zarr(imhdr_path, white_file_path, dark_for_im_file_path,
+                           dark_for_white_file_path, zarr_path, band_indices=None,
+                           min_max_bands=None, background_correction=True, destripe=True,
+                           chunk_size=500, use_float=False, multiscale=True,
+                           spectra_tile_size=None, codec='default', use_reference_cache=True,
+                           max_block_bytes=2**28, num_workers=None, resume=False):
+    """Preprocess a raw image to zarr reading the raw file only once. Blocks of
+    rows with all selected bands are read in parallel, white and dark corrected
+    and written to the full resolution level. If destripe is True (default),
+    destriping needs the median of complete columns, so this is not a single
+    pass over the data: blocks of bands are then read back from the zarr,
+    destriped and written again with their pyramid levels. Otherwise pyramid
+    levels are written in the first pass and the zarr is written once.
+    Per band statistics are saved in the zarr attributes as 'statistics'
+    with keys 'min', 'max', 'mean' and 'std'. Results are the same as with
+    correct_save_to_zarr.
+
+    Parameters
+    ----------
+    imhdr_path : str
+        Path to hdr file of image to correct.
+    white_file_path : str
+        Path to white reference image.
+    dark_for_im_file_path : str
+        Path to dark reference image for image.
+    dark_for_white_file_path : str
+        Path to dark reference image for white reference.
+    zarr_path : str
+        Path to save zarr to.
+    band_indices : list of int, optional
+        Indices of bands to process. If None, all bands are processed.
+    min_max_bands : list of float, optional
+        Minimum and maximum wavelength of bands to process. Cannot be used
+        together with band_indices.
+    background_correction : bool, optional
+        Whether to perform white correction. Default is True.
+    destripe : bool, optional
+        Whether to perform destriping. Default is True.
+    chunk_size : int, optional
+        Size of chunks along rows and cols. Default is 500.
+    use_float : bool, optional
+        Whether to use float data type. Default is False.
+    multiscale : bool, optional
+        If True, the zarr is a multiscale pyramid (OME-NGFF layout). Default is True.
+    spectra_tile_size : int, optional
+        If not None, also save a copy of the image chunked along pixels, see
+        save_spectra_copy_to_zarr. Requires multiscale=True. Default is None.
+    codec : str, optional
+        Compression codec of the zarr, see io.get_zarr_compressor_kwargs.
+        Default is 'default'.
+    use_reference_cache : bool, optional
+        Whether to use reference profiles cached in the folder containing
+        zarr_path, see load_reference_profile. Default is True.
+    max_block_bytes : int, optional
+        Approximate memory in bytes used to process blocks of rows or of
+        bands, shared between the num_workers blocks processed at the same
+        time. A block of n rows uses about n * bands * cols * 24 bytes, see
+        correct_save_to_zarr. Default is 2**28.
+    num_workers : int, optional
+        Number of threads processing blocks. Default is None, using
+        min(4, number of cpus).
+    resume : bool, optional
+        If True and zarr_path holds a finished run of this function for the
+        same image, references, bands and options, nothing is done. Runs of
+        correct_save_to_zarr, which saves no statistics, and interrupted runs,
+        in which rows of all bands are processed together, are processed
+        again completely. Default is False.
+    
+    Returns
+    -------
+    None
+    """
+
+    img = open_image(imhdr_path)
+    lines, samples = img.nrows, img.ncols
+    band_indices = get_band_indices(img, band_indices, min_max_bands)
+    bands = len(band_indices)
+
+    if (spectra_tile_size is not None) and (not multiscale):
+        raise ValueError('spectra_tile_size requires multiscale=True')
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+
+    # chunks of downsampled levels are shared between row blocks
+    key = get_preprocessing_key(
+        imhdr_path, band_indices,
+        reference_paths=[white_file_path, dark_for_im_file_path, dark_for_white_file_path]
+        if background_correction else None,
+        background_correction=background_correction,
+        destripe=destripe, use_float=use_float, chunk_size=chunk_size, multiscale=multiscale,
+        codec=codec, median_tolerance=None)
+    pyramid, completed = open_resumable_zarr(
+        zarr_path, key, shape=(bands, lines, samples), chunk_size=chunk_size,
+        use_float=use_float, multiscale=multiscale, codec=codec,
+        synchronizer=zarr.ThreadSynchronizer(), resume=resume)
+    z1 = pyramid[0]
+    if ((len(completed['bands']) == bands) and ('statistics' in z1.attrs)
+            and (spectra_tile_size is None or completed['spectra'] == spectra_tile_size)):
+        return None
+
+    references = None
+    if background_correction:
+        references = load_white_dark(
+            white_file_path=white_file_path,
+            dark_for_im_file_path=dark_for_im_file_path,
+            dark_for_white_file_path=dark_for_white_file_path,
+            channel_indices=band_indices,
+            use_cache=use_reference_cache,
+            cache_folder=Path(zarr_path).parent if use_reference_cache else None)
+
+    # row blocks aligned to the downsampling factor, and to chunks if the
+    # budget allows it to avoid partial chunk writes
+    factor = 2**(len(pyramid)-1)
+    row_step = int(np.lcm(z1.chunks[1], factor))
+    max_rows = _get_num_block_items(max_block_bytes, bands * samples, num_workers)
+    if max_rows < row_step:
+        row_step = factor
+    num_rows_block = max(1, max_rows // row_step) * row_step
+
+    def correct_row_block(row_start):
+        row_bounds = (row_start, min(row_start + num_rows_block, lines))
+        corrected = _read_correct_rows(imhdr_path, band_indices, row_bounds, references, use_float)
+        if destripe:
+            z1[:, row_bounds[0]:row_bounds[1], :] = corrected
+            return None
+        save_to_pyramid(corrected, pyramid, (slice(None), row_start, 0))
+        return _get_band_statistics(corrected)
+
+    statistics = list(map_bounded(
+        correct_row_block, range(0, lines, num_rows_block), num_workers=num_workers))
+
+    if destripe:
+        bands_per_block = max(1, _get_num_block_items(max_block_bytes, lines * samples, num_workers))
+
+        def destripe_band_block(band_start):
+            selection = slice(band_start, band_start + bands_per_block)
+            corrected = np.moveaxis(
+                savgol_destripe(np.moveaxis(z1[selection], 0, 2), width=100, order=2, inplace=True), 2, 0)
+            save_to_pyramid(corrected, pyramid, (selection, 0, 0))
+            statistics = np.full((4, bands), np.nan)
+            statistics[:, selection] = _get_band_statistics(corrected)
+            return statistics
+
+        statistics = list(map_bounded(
+            destripe_band_block, range(0, bands, bands_per_block), num_workers=num_workers))
+    
+    statistics = np.stack(statistics)
+    num_pixels = lines * samples
+    mean = np.nansum(statistics[:, 2], axis=0) / num_pixels
+    z1.attrs['statistics'] = {
+        'min': list(np.nanmin(statistics[:, 0], axis=0)),
+        'max': list(np.nanmax(statistics[:, 1], axis=0)),
+        'mean': list(mean),
+        'std': list(np.sqrt(np.maximum(np.nansum(statistics[:, 3], axis=0) / num_pixels - mean**2, 0))),
+    }
+    z1.attrs['metadata'] = {
+        'wavelength': list(np.array(img.metadata['wavelength'])[band_indices]),
+        'centers': list(np.array(img.bands.centers)[band_indices])
+        }
+    completed = {'bands': list(range(bands)), 'spectra': None}
+    z1.attrs['completed'] = completed
+
+    if spectra_tile_size is not None:
+        save_spectra_copy_to_zarr(zarr_path, tile_size=spectra_tile_size)
+        completed['spectra'] = spectra_tile_size
+        z1.attrs['completed'] = completed
+
+def _get_band_statistics(image):
+    """Compute min, max, sum and sum of squares of each band of an image
+    with dims (bands, rows, cols). Returns array with dims (4, bands)."""
+
+    image = image.reshape(image.shape[0], -1)
+    image_float = image.astype(np.float64)
+    return np.stack([
+        image.min(axis=1), image.max(axis=1),
+        image_float.sum(axis=1), (image_float**2).sum(axis=1)])
+
+def convert_bil_raw_to_zarr(hdr_path, export_folder, num_rows_chunk=2000, force=False,
+                            multiscale=True, codec='default', num_workers=None,
+                            max_blocks_in_flight=None):
+    """
+    Convert an original raw image in bil, bip or bsq format to zarr. The exported
+    zarr has format CXY with C saved as partial chunks. Blocks of rows are read,
+    transposed and written in parallel by a thread pool, with a bounded number of
+    blocks in memory at any time.
 
     Parameters
     ----------
@@ -543,6 +1797,22 @@ def convert_bil_raw_to_zarr(hdr_path, export_folder, num_rows_chunk=2000, force=
         Path to folder where to save the zarr.
     num_rows_chunk : int, optional
         Number of rows per chunk. Default is 2000.
+    force : bool, optional
+        Not used anymore as all interleaves are supported. Kept for compatibility.
+    multiscale : bool, optional
+        If True, the zarr is a multiscale pyramid (OME-NGFF layout) with 2x
+        downsampled levels written in the same pass. The number of levels is
+        limited so that num_rows_chunk remains divisible by the downsampling
+        factor. Default is True.
+    codec : str, optional
+        Compression codec of the zarr, one of 'default', 'zstd', 'lz4' or
+        'none', see io.get_zarr_compressor_kwargs. Default is 'default'.
+    num_workers : int, optional
+        Number of threads. Default is None, using min(4, number of cpus).
+    max_blocks_in_flight : int, optional
+        Maximum number of row blocks submitted but not yet written. Peak memory
+        is about max_blocks_in_flight * num_rows_chunk * ncols * nbands * itemsize.
+        Default is None, using 2 * num_workers.
     
     Returns
     -------
@@ -552,45 +1822,92 @@ def convert_bil_raw_to_zarr(hdr_path, export_folder, num_rows_chunk=2000, force=
     
     hdr_path = Path(hdr_path)
     img = open_image(hdr_path)
-    if (not img.metadata['interleave'] == 'bil') and (not force):
-        raise ValueError('Image is not in bil format, cannot convert')
-    
-    #num_rows_chunk = 2000
-    shape = (img.shape[2], img.shape[0], img.shape[1])
-    chunks = (1, num_rows_chunk, img.shape[1])
+    if img.metadata['interleave'].lower() not in ['bil', 'bip', 'bsq']:
+        raise ValueError(f'Unknown interleave {img.metadata["interleave"]}, cannot convert')
+
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    if max_blocks_in_flight is None:
+        max_blocks_in_flight = 2 * num_workers
+
+    # (bands, rows, cols) view of the raw file whatever its interleave
+    raw = img.open_memmap(interleave='bsq')
+    dtype = raw.dtype.newbyteorder('=')
+
+    shape = (img.nbands, img.nrows, img.ncols)
+    chunks = (1, num_rows_chunk, img.ncols)
 
     new_name = hdr_path.with_suffix('.zarr').name
     zarr_path = Path(export_folder).joinpath(new_name)
-    im_zarr = zarr.open(zarr_path, mode='w', shape=shape,
-                chunks=chunks, dtype=img.dtype)
+    if multiscale:
+        num_levels = get_pyramid_num_levels(shape)
+        while num_rows_chunk % 2**(num_levels-1) != 0:
+            num_levels -= 1
+        # chunks of downsampled levels are shared between row blocks
+        pyramid = create_multiscale_zarr(
+            zarr_path, shape=shape, chunks=chunks, dtype=dtype, num_levels=num_levels,
+            codec=codec, synchronizer=zarr.ThreadSynchronizer())
+        im_zarr = pyramid[0]
+    else:
+        im_zarr = zarr.open(zarr_path, mode='w', shape=shape,
+                    chunks=chunks, dtype=dtype, **get_zarr_compressor_kwargs(codec))
+        pyramid = [im_zarr]
     
     im_zarr.attrs['metadata'] = {
         'wavelength': list(np.array(img.metadata['wavelength'])),
         'centers': list(np.array(img.bands.centers))
         }
 
-    num_chunks = (img.nrows // num_rows_chunk) + 1
-    for i in range(num_chunks):
+    def convert_row_block(row_start):
+        row_end = min(row_start + num_rows_chunk, img.nrows)
+        block = np.ascontiguousarray(raw[:, row_start:row_end], dtype=dtype)
+        save_to_pyramid(block, pyramid, (slice(None), row_start, 0))
 
-        band = 0
-        offset = img.offset + band * img.sample_size * img.ncols
-        f = img.fid
+    for _ in map_bounded(convert_row_block, range(0, img.nrows, num_rows_chunk),
+                         num_workers=num_workers, max_in_flight=max_blocks_in_flight):
+        pass
 
-        starting_row = i * num_rows_chunk
-        max_rows = num_rows_chunk
-        if i==num_chunks-1:
-            max_rows = img.nrows % num_rows_chunk
-        
-        pos = offset + starting_row * img.sample_size * img.nbands * img.ncols
-        count = img.ncols * img.nbands * max_rows
-        arr = np.fromfile(hdr_path.with_suffix('.raw') , dtype=img.dtype, offset=pos, count=count)
-        arr_resh = np.reshape(arr, (max_rows, img.nbands, img.ncols))
-        
-        arr_resh = np.moveaxis(arr_resh, 1,0)
-        im_zarr[:, num_rows_chunk*i:num_rows_chunk*i+max_rows, :] = arr_resh
+def map_bounded(func, items, num_workers=4, max_in_flight=None):
+    """Apply func to items in a thread pool, submitting new items only when
+    less than max_in_flight are pending so that memory stays bounded.
 
+    Parameters
+    ----------
+    func : callable
+        Function of one item.
+    items : iterable
+        Items to process.
+    num_workers : int, optional
+        Number of threads. If 1, items are processed serially. Default is 4.
+    max_in_flight : int, optional
+        Maximum number of pending items. Default is None, using 2 * num_workers.
+
+    Yields
+    ------
+    result
+        Results of func in order of completion.
+    """
 
-def spectral_clustering(pixel_vectors, dbscan_eps=0.5):
+    if num_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = set()
+        for item in items:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            in_flight.add(executor.submit(func, item))
+        for future in in_flight:
+            yield future.result()
+
+
+def spectral_clustering(pixel_vectors, dbscan_eps=0.5, method='dbscan', bin_fraction=0.25):
     """Perform spectral clustering on pixel vectors
     
     Parameters
@@ -599,21 +1916,49 @@ def spectral_clustering(pixel_vectors, dbscan_eps=0.5):
         Array of pixel vectors. Dims are (n_pixels, n_bands).
     dbscan_eps : float, optional
         Epsilon parameter for DBSCAN. Default is 0.5.
+    method : str, optional
+        'dbscan' to cluster all pixels, or 'binned' for large sets of pixels:
+        pixels are grouped in cells of a grid of width bin_fraction * dbscan_eps,
+        and the mean points of cells are clustered with DBSCAN using the number
+        of pixels per cell as sample weight. Memory and time then scale with
+        the number of occupied cells. Default is 'dbscan'.
+    bin_fraction : float, optional
+        Width of grid cells relative to dbscan_eps for method 'binned'.
+        Smaller values give results closer to 'dbscan'. Default is 0.25.
     
     Returns
     -------
     labels : array
-        Cluster labels for each pixel.
+        Cluster labels for each pixel, -1 for noise and for pixels
+        with non-finite values.
     """
 
     pixel_vectors = pixel_vectors.astype(np.float32)
-    X = StandardScaler().fit_transform(pixel_vectors)
+    # pixels with NaN or inf are not clustered
+    finite = np.isfinite(pixel_vectors).all(axis=1)
+    labels = np.full(len(pixel_vectors), -1, dtype=np.int64)
+    if not finite.any():
+        return labels
+
+    X = StandardScaler().fit_transform(pixel_vectors[finite])
     dbscan = DBSCAN(eps=dbscan_eps)
 
     # cluster the three first components
-    dbscan.fit(X=X[:,0:3])
-
-    labels = dbscan.labels_
+    if method == 'dbscan':
+        dbscan.fit(X=X[:,0:3])
+        labels[finite] = dbscan.labels_
+    elif method == 'binned':
+        X = X[:, 0:3]
+        cells = np.floor(X / (bin_fraction * dbscan_eps)).astype(np.int64)
+        cells -= cells.min(axis=0)
+        cell_index = np.ravel_multi_index(cells.T, cells.max(axis=0) + 1)
+        _, inverse, counts = np.unique(cell_index, return_inverse=True, return_counts=True)
+        centers = np.stack([np.bincount(inverse, weights=x) for x in X.T], axis=1) / counts[:, np.newaxis]
+        dbscan.set_params(algorithm='kd_tree')
+        dbscan.fit(X=centers, sample_weight=counts)
+        labels[finite] = dbscan.labels_[inverse]
+    else:
+        raise ValueError(f'Unknown method {method}, use dbscan or binned')
 
     return labels
 
@@ -650,34 +1995,161 @@ def find_index_of_band(band_list, band_value):
     return band_index
 
 
-def custom_ppi(X, niters=1000, threshold=0, centered=False):
-
-    if not centered:
-        stats = calc_stats(X)
-        X = X - stats.mean
+def custom_ppi(X, niters=1000, threshold=0, centered=False, batch_size=256,
+               num_workers=None, random_state=None, dtype=np.float32,
+               block_size=4096, max_block_bytes=2**28, mask=None, channel_axis=-1):
+    """Pixel Purity Index (PPI). Pixels are projected on random unit vectors
+    (skewers) and the pixels with extreme projections are counted. Skewers
+    are processed in batches, and for each batch blocks of rows are read,
+    projected and reduced to extreme candidates in parallel threads, which
+    are then merged. X can be a numpy, zarr or dask array, in which case
+    only blocks are loaded in memory so that the cube doesn't need to fit in
+    RAM, but it is read once per batch (twice if threshold is not 0 and
+    projections don't fit in max_block_bytes). Results only depend on
+    random_state and dtype, not on batch_size, num_workers or block_size.
 
-    shape = X.shape
-    X = X.reshape(-1, X.shape[-1])
-    nbands = X.shape[-1]
+    Parameters
+    ----------
+    X : array
+        Image. Dims are (rows, cols, bands), or (bands, rows, cols) if
+        channel_axis is 0.
+    niters : int, optional
+        Number of skewers. Default is 1000.
+    threshold : float, optional
+        If 0, only the pixels with minimum and maximum projection are
+        counted for each skewer. Otherwise all pixels within threshold of
+        the extreme projections are counted. Default is 0.
+    centered : bool, optional
+        Whether X is already centered on the mean spectrum. Default is False.
+    batch_size : int, optional
+        Maximum number of skewers per batch. Default is 256.
+    num_workers : int, optional
+        Number of threads. Default is None, using min(4, number of cpus).
+    random_state : int or numpy Generator, optional
+        Seed of the random skewers. Default is None.
+    dtype : numpy dtype, optional
+        Data type of projections. Default is np.float32.
+    block_size : int, optional
+        Approximate number of pixels per block, rounded to complete rows.
+        Default is 4096.
+    max_block_bytes : int, optional
+        If threshold is not 0, projections of a batch are kept in memory
+        if they use less than max_block_bytes, otherwise they are computed
+        again to count pixels. Default is 2**28.
+    mask : array, optional
+        Pixels to ignore are True. Dims are (rows, cols). Default is None.
+    channel_axis : int, optional
+        Axis of bands, -1 (or 2) or 0. Default is -1.
 
-    counts = np.zeros(X.shape[0], dtype=np.uint32)
-    total_ppi = [0]
-    for i in range(niters):
-        r = np.random.rand(nbands) - 0.5
-        r /= np.sqrt(np.sum(r * r))
-        s = X.dot(r)
-        imin = np.argmin(s)
-        imax = np.argmax(s)
+    Returns
+    -------
+    counts : array
+        Number of times each pixel was counted, 0 for masked pixels.
+        Dims are (rows, cols).
+    total_ppi : list of int
+        Number of pixels counted at least once after each skewer, starting
+        with 0 before the first skewer.
+    """
 
-        updating = True
-        if threshold == 0:
-            # Only the two extreme pixels are incremented
-            counts[imin] += 1
-            counts[imax] += 1
+    if channel_axis == 0:
+        nbands, nrows, ncols = X.shape
+    elif channel_axis in [-1, 2]:
+        nrows, ncols, nbands = X.shape
+    else:
+        raise ValueError('channel_axis must be 0 or -1')
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    rng = np.random.default_rng(random_state)
+
+    block_rows = int(max(1, block_size // ncols))
+    blocks = [(r, min(r + block_rows, nrows)) for r in range(0, nrows, block_rows)]
+
+    def read_block(block):
+        """Return flat indices and spectra (pixels, bands) of unmasked pixels of a block of rows."""
+        if channel_axis == 0:
+            data = np.asarray(X[:, block[0]:block[1], :]).reshape(nbands, -1).T
         else:
-            # All pixels within threshold distance from the two extremes
-            counts[s >= (s[imax] - threshold)] += 1
-            counts[s <= (s[imin] + threshold)] += 1
-        total_ppi.append(np.sum(counts > 0))
-    
-    return counts.reshape(shape[:2]), total_ppi
+            data = np.asarray(X[block[0]:block[1]]).reshape(-1, nbands)
+        indices = np.arange(block[0] * ncols, block[1] * ncols)
+        if mask is not None:
+            keep = ~np.asarray(mask[block[0]:block[1]], dtype=bool).ravel()
+            data, indices = data[keep], indices[keep]
+        return indices, data.astype(dtype)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+
+        def sum_block(block):
+            data = read_block(block)[1]
+            return data.sum(axis=0, dtype=np.float64), len(data)
+
+        mean = np.zeros(nbands)
+        if not centered:
+            sums, sizes = zip(*executor.map(sum_block, blocks))
+            mean = np.sum(sums, axis=0) / max(1, sum(sizes))
+        mean = mean.astype(dtype)
+
+        def project_block(block, R):
+            indices, data = read_block(block)
+            proj = R @ (data - mean).T
+            if proj.shape[1] == 0:
+                return indices, proj, None
+            extremes = (proj.min(axis=1), indices[proj.argmin(axis=1)],
+                        proj.max(axis=1), indices[proj.argmax(axis=1)])
+            return indices, proj, extremes
+
+        def count_block(projected, R, proj_min, proj_max):
+            indices, proj, _ = projected if projected[1] is not None else project_block(projected[0], R)
+            above = proj >= proj_max[:, np.newaxis] - threshold
+            below = proj <= proj_min[:, np.newaxis] + threshold
+            hit = above | below
+            # per pixel: number of counts and first skewer of the batch counting it
+            first_skewer = np.where(hit.any(axis=0), np.argmax(hit, axis=0), -1)
+            return indices, above.sum(axis=0) + below.sum(axis=0), first_skewer
+
+        counts = np.zeros(nrows * ncols, dtype=np.uint32)
+        total_ppi = [0]
+        num_pixels = nrows * ncols if mask is None else int(np.sum(~np.asarray(mask, dtype=bool)))
+        if num_pixels == 0:
+            return counts.reshape(nrows, ncols), [0] * (niters + 1)
+        for start in range(0, niters, batch_size):
+            # draw skewers one per row so that the sequence is independent of batch_size
+            R = rng.random((min(batch_size, niters - start), nbands)) - 0.5
+            R /= np.sqrt(np.sum(R * R, axis=1, keepdims=True))
+            R = R.astype(dtype)
+            keep_projections = (threshold != 0) and (num_pixels * len(R) * R.itemsize <= max_block_bytes)
+            projected = []
+            for block, (indices, proj, extremes) in zip(
+                    blocks, executor.map(lambda block: project_block(block, R), blocks)):
+                if extremes is not None:
+                    projected.append(((indices, proj, extremes) if keep_projections
+                                      else (block, None, extremes)))
+
+            # merge extreme candidates of blocks, first occurrence in case of ties
+            mins, argmins, maxs, argmaxs = [np.stack(e) for e in zip(*[p[2] for p in projected])]
+            skewers = np.arange(len(R))
+            imin = argmins[np.argmin(mins, axis=0), skewers]
+            imax = argmaxs[np.argmax(maxs, axis=0), skewers]
+
+            if threshold == 0:
+                # Only the two extreme pixels are incremented
+                hits = np.stack([imin, imax], axis=1).ravel()
+                pixels, first, pixel_hits = np.unique(hits, return_index=True, return_counts=True)
+                first_skewer = first // 2
+                new = counts[pixels] == 0
+                counts[pixels] += pixel_hits.astype(np.uint32)
+            else:
+                # All pixels within threshold distance from the two extremes
+                proj_min, proj_max = mins.min(axis=0), maxs.max(axis=0)
+                pixels, block_counts, first_skewer = [np.concatenate(c) for c in zip(*executor.map(
+                    lambda p: count_block(p, R, proj_min, proj_max), projected))]
+                hit = first_skewer >= 0
+                pixels, first_skewer = pixels[hit], first_skewer[hit]
+                new = counts[pixels] == 0
+                counts[pixels] += block_counts[hit].astype(np.uint32)
+            del projected
+
+            # number of counted pixels after each skewer of the batch
+            total_ppi.extend((total_ppi[-1] + np.cumsum(np.bincount(
+                first_skewer[new], minlength=len(R)))).tolist())
+
+    return counts.reshape(nrows, ncols), total_ppi
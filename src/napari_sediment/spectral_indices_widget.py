@@ -31,7 +31,7 @@ from .spectralindex import (SpectralIndex, compute_index_projection,
                             clean_index_map, save_tif_cmap, create_index, export_index_series,
                             compute_index, batch_create_plots, compute_normalized_index_params)
 from .io import load_mask, get_mask_path
-from .utils import wavelength_to_rgb
+from .utils import wavelength_to_rgb, get_layer_data
 from .folder_list_widget import FolderListWidget
 
 class SpectralIndexWidget(QWidget):
@@ -725,7 +725,7 @@ class SpectralIndexWidget(QWidget):
                 roi=[
                     self.cursor_pos[0]+self.row_bounds[0], self.cursor_pos[0]+self.row_bounds[0]+1,
                     self.cursor_pos[1]+self.col_bounds[0], self.cursor_pos[1]+self.col_bounds[0]+1]
-                    ).compute().ravel()
+                    ).ravel()
         
         self.em_boundaries_range.setRange(min=self.endmember_bands[0],max=self.endmember_bands[-1])
         self.em_boundaries_range.setValue(
@@ -1106,7 +1106,7 @@ class SpectralIndexWidget(QWidget):
         self.params.location = self.metadata_location.text()
         self.params.scale = self.spinbox_metadata_scale.value()
         # get rgb image and index image to plot
-        rgb_image = [self.viewer.layers[c].data for c in ['red', 'green', 'blue']]
+        rgb_image = [get_layer_data(self.viewer.layers[c]) for c in ['red', 'green', 'blue']]
         if isinstance(rgb_image[0], da.Array):
             rgb_image = [x.compute() for x in rgb_image]
         
@@ -1528,7 +1528,7 @@ class SpectralIndexWidget(QWidget):
     ### Helper functions
     def get_rgb_array(self):
 
-        rgb_image = [self.viewer.layers[c].data for c in ['red', 'green', 'blue']]
+        rgb_image = [get_layer_data(self.viewer.layers[c]) for c in ['red', 'green', 'blue']]
         if isinstance(rgb_image[0], da.Array):
             rgb_image = [x.compute() for x in rgb_image]
         return rgb_image
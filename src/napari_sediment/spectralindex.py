@@ -14,6 +14,7 @@ from .sediproc import find_index_of_band
 from .io import load_project_params, load_plots_params, load_mask, get_mask_path
 from .imchannels import ImChannels
 from .spectralplot import plot_spectral_profile, plot_multi_spectral_profile
+from ._index_kernels import rabd_map, raba_map, ratio_map
 
 @dataclass
 class SpectralIndex:
@@ -93,7 +94,7 @@ class SpectralIndex:
         return dict_to_save
     
 
-def compute_index_RABD(left, trough, right, row_bounds, col_bounds, imagechannels):
+def compute_index_RABD(left, trough, right, row_bounds, col_bounds, imagechannels, backend='auto'):
     """Compute the index RABD.
     
     Parameters
@@ -110,6 +111,8 @@ def compute_index_RABD(left, trough, right, row_bounds, col_bounds, imagechannel
         (col_start, col_end)
     imagechannels: ImageChannels
         image channels object
+    backend: str
+        'auto', 'numba' or 'numpy', see _index_kernels
 
     Returns
     -------
@@ -134,14 +137,12 @@ def compute_index_RABD(left, trough, right, row_bounds, col_bounds, imagechannel
     roi = np.concatenate([row_bounds, col_bounds])
     ltr_cube = imagechannels.get_image_cube(
         channels=ltr_stack_indices, roi=roi)
-    ltr_cube = ltr_cube.astype(np.float32)+0.0000001
 
-    # compute indices
-    RABD = ((ltr_cube[0] * X_right + ltr_cube[2] * X_left) / (X_left + X_right)) / ltr_cube[1] 
-    RABD = np.asarray(RABD, np.float32)
+    # compute indices in a single pass
+    RABD = rabd_map(ltr_cube, X_left, X_right, backend=backend)
     return RABD
 
-def compute_index_RABA(left, right, row_bounds, col_bounds, imagechannels):
+def compute_index_RABA(left, right, row_bounds, col_bounds, imagechannels, backend='auto'):
     """Compute the index RABA.
     
     Parameters
@@ -156,6 +157,8 @@ def compute_index_RABA(left, right, row_bounds, col_bounds, imagechannels):
         (col_start, col_end)
     imagechannels: ImageChannels
         image channels object
+    backend: str
+        'auto', 'numba' or 'numpy', see _index_kernels
 
     Returns
     -------
@@ -168,23 +171,15 @@ def compute_index_RABA(left, right, row_bounds, col_bounds, imagechannels):
     ltr_stack_indices = [find_index_of_band(imagechannels.centers, x) for x in ltr]
     # main roi
     roi = np.concatenate([row_bounds, col_bounds])
-    # number of bands between edges and trough
     R0_RN_cube = imagechannels.get_image_cube(channels=ltr_stack_indices, roi=roi)
-    R0_RN_cube = R0_RN_cube.astype(np.float32)
     num_bands = ltr_stack_indices[1] - ltr_stack_indices[0]
-    line = (R0_RN_cube[1] - R0_RN_cube[0])/num_bands
-    RABA_array = None
-    for i in range(num_bands):
-        Ri = imagechannels.get_image_cube(channels=[ltr_stack_indices[0]+i], roi=roi)
-        Ri = Ri.astype(np.float32) + 0.0000001
-        if RABA_array is None:
-            RABA_array = ((R0_RN_cube[0] + i*line) / Ri[0] ) - 1
-        else:
-            RABA_array += ((R0_RN_cube[0] + i*line) / Ri[0] ) - 1
-    RABA_array = np.asarray(RABA_array, np.float32)
+    # bands between edges are read and accumulated one at a time
+    bands = (imagechannels.get_image_cube(channels=[ltr_stack_indices[0]+i], roi=roi)[0]
+             for i in range(num_bands))
+    RABA_array = raba_map(R0_RN_cube[0], R0_RN_cube[1], bands, num_bands, backend=backend)
     return RABA_array
     
-def compute_index_ratio(left, right, row_bounds, col_bounds, imagechannels):
+def compute_index_ratio(left, right, row_bounds, col_bounds, imagechannels, backend='auto'):
     """Compute the index ratio.
         
     Parameters
@@ -199,6 +194,8 @@ def compute_index_ratio(left, right, row_bounds, col_bounds, imagechannels):
         (col_start, col_end)
     imagechannels: ImageChannels
         image channels object
+    backend: str
+        'auto', 'numba' or 'numpy', see _index_kernels
 
     Returns
     -------
@@ -211,9 +208,7 @@ def compute_index_ratio(left, right, row_bounds, col_bounds, imagechannels):
     # main roi
     roi = np.concatenate([row_bounds, col_bounds])
     numerator_denominator = imagechannels.get_image_cube(channels=ltr_stack_indices, roi=roi)
-    numerator_denominator = numerator_denominator.astype(np.float32)
-    ratio = numerator_denominator[0] / (numerator_denominator[1] + 0.0000001)
-    ratio = np.asarray(ratio, np.float32)
+    ratio = ratio_map(numerator_denominator, backend=backend)
     return ratio
 
 def compute_index_RMean(left, right, row_bounds, col_bounds, imagechannels):
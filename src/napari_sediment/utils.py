@@ -9,6 +9,103 @@ def update_contrast_on_layer(napari_layer):
     napari_layer.contrast_limits_range = (data.min(), data.max())
     napari_layer.contrast_limits = np.percentile(data, (2,98))
 
+def get_pyramid_num_levels(shape, max_size=2048):
+    """Number of levels of a multiscale pyramid with 2x downsampling such
+    that the lowest resolution level is smaller than max_size along rows and cols.
+    
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the image. The last two dimensions are rows and cols.
+    max_size : int, optional
+        Maximum size of the lowest resolution level. Default is 2048.
+    
+    Returns
+    -------
+    num_levels : int
+        Number of levels including full resolution.
+    """
+
+    num_levels = 1
+    size = max(shape[-2:])
+    while size > max_size:
+        size = int(np.ceil(size / 2))
+        num_levels += 1
+    
+    return num_levels
+
+def get_multiscale_views(image, max_size=2048):
+    """Create a multiscale pyramid of an image for display in napari.
+    Levels are views of the image with 2x subsampling along rows and cols
+    so that no data is copied.
+
+    Parameters
+    ----------
+    image : array
+        Image to display. Dims are (bands, rows, cols) or (rows, cols).
+    max_size : int, optional
+        Maximum size of the lowest resolution level. Default is 2048.
+    
+    Returns
+    -------
+    pyramid : list of arrays
+        Resolution levels, from full resolution to lowest resolution.
+    """
+
+    num_levels = get_pyramid_num_levels(image.shape, max_size=max_size)
+    pyramid = [image[..., ::2**level, ::2**level] for level in range(num_levels)]
+
+    return pyramid
+
+def get_layer_data(napari_layer):
+    """Get full resolution data of a layer, also for multiscale layers."""
+
+    if napari_layer.multiscale:
+        return napari_layer.data[0]
+    return napari_layer.data
+
+def add_or_update_image_layer(viewer, image, name, **kwargs):
+    """Add image to viewer or update data of existing layer with the same name.
+    Large images are displayed as multiscale layers. As napari can't switch
+    an existing layer between single and multiscale, the layer is replaced
+    in that case.
+
+    Parameters
+    ----------
+    viewer : napari.Viewer
+        Viewer to add the layer to.
+    image : array
+        Image to display. Dims are (bands, rows, cols) or (rows, cols).
+    name : str
+        Name of the layer.
+    kwargs : dict
+        Additional arguments passed to viewer.add_image when the layer is created.
+    
+    Returns
+    -------
+    layer : napari.layers.Image
+        Added or updated layer.
+    """
+
+    pyramid = get_multiscale_views(image)
+    multiscale = len(pyramid) > 1
+    data = pyramid if multiscale else image
+
+    if name in viewer.layers:
+        layer = viewer.layers[name]
+        if layer.multiscale == multiscale:
+            layer.data = data
+            layer.refresh()
+            return layer
+        layer_index = viewer.layers.index(layer)
+        viewer.layers.remove(layer)
+        layer = viewer.add_image(data, name=name, multiscale=multiscale, **kwargs)
+        viewer.layers.move(len(viewer.layers)-1, layer_index)
+        return layer
+    
+    layer = viewer.add_image(data, name=name, multiscale=multiscale, **kwargs)
+    return layer
+
 def wavelength_to_rgb(min_wavelength, max_wavelength, width):
 
     min_wavelength = int(min_wavelength)
@@ -5,6 +5,8 @@ from qtpy.QtCore import Qt
 import numpy as np
 from napari.utils import progress
 
+from ..utils import add_or_update_image_layer
+
 class ChannelWidget(QListWidget):
     """Widget to handle channel selection and display. Works only i parent widget
     has:
@@ -51,15 +53,12 @@ class ChannelWidget(QListWidget):
             self.bands = self.imagechannels.centers[np.array(self.channel_indices).astype(int)]
             
             layer_name = 'imcube'
-            if layer_name in self.viewer.layers:
-                self.viewer.layers[layer_name].data = new_cube
-                self.viewer.layers[layer_name].refresh()
-            else:
-                self.viewer.add_image(
-                    new_cube,
-                    name=layer_name,
-                    rgb=False,
-                )
+            add_or_update_image_layer(
+                self.viewer,
+                new_cube,
+                name=layer_name,
+                rgb=False,
+            )
             if self.translate:
                 self.viewer.layers[layer_name].translate = (0, row_bounds[0], col_bounds[0])
 
@@ -7,7 +7,7 @@ import dask.array as da
 from napari_guitils.gui_structures import VHGroup, TabSet
 from superqt import QDoubleRangeSlider
 
-from ..utils import update_contrast_on_layer
+from ..utils import update_contrast_on_layer, get_layer_data, add_or_update_image_layer
 
 class RGBWidget(QWidget):
     """Widget to handle channel selection and display. Works only i parent widget
@@ -116,7 +116,7 @@ class RGBWidget(QWidget):
 
     def get_current_rgb_cube(self):
 
-        rgb_cube = np.array([self.viewer.layers[c].data for c in ['red', 'green', 'blue']])
+        rgb_cube = np.array([get_layer_data(self.viewer.layers[c]) for c in ['red', 'green', 'blue']])
         return rgb_cube
     
     def _on_change_contrast(self, event=None):
@@ -156,7 +156,7 @@ class RGBWidget(QWidget):
             channels = [0, 1, 2]
 
         layer_name = self.combo_layer_to_rgb.currentText()
-        rgb_cube = np.array([self.viewer.layers[layer_name].data[ind] for ind in channels])
+        rgb_cube = np.array([get_layer_data(self.viewer.layers[layer_name])[ind] for ind in channels])
 
         self.add_rgb_cube_to_viewer(rgb_cube)
 
@@ -164,15 +164,14 @@ class RGBWidget(QWidget):
         
         cmaps = ['red', 'green', 'blue']
         for ind, cmap in enumerate(cmaps):
-            if cmap not in self.viewer.layers:
-                self.viewer.add_image(
-                    rgb_cube[ind],
-                    name=cmap,
-                    colormap=cmap,
-                    blending='additive')
-            else:
-                self.viewer.layers[cmap].data = rgb_cube[ind]
-                if self.translate:
-                    self.viewer.layers[cmap].translate = (self.row_bounds[0], self.col_bounds[0])
+            layer_exists = cmap in self.viewer.layers
+            add_or_update_image_layer(
+                self.viewer,
+                rgb_cube[ind],
+                name=cmap,
+                colormap=cmap,
+                blending='additive')
+            if layer_exists and self.translate:
+                self.viewer.layers[cmap].translate = (self.row_bounds[0], self.col_bounds[0])
             
             update_contrast_on_layer(self.viewer.layers[cmap])
\ No newline at end of file